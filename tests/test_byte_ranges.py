@@ -0,0 +1,108 @@
+"""
+Reading a results file in byte ranges (as aggregate.py and parse_results_json.py do in parallel) must give exactly
+the records of reading it serially, whatever the number of ranges
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vcomp"))
+
+import aggregate
+import parse_results_json
+
+CALLERS = ("gatk-hc", "freebayes", "platypus")
+NORMALIZERS = ("nonorm", "vt", "vap_leftalign")
+COMPARATORS = ("raw", "vgraph", "vcfeval")
+RESULTS = ("Variants matched", "Variants did not match", "No variants identified", "Error")
+
+#Range counts to check, from a single range to more ranges than there are bytes
+RANGE_COUNTS = range(1, 40) + [50, 64, 100, 128, 255, 500, 1000, 2000, 5000]
+
+
+def random_variants(rng, count):
+    variants = []
+    for i in range(count):
+        ref = rng.choice(["A", "C", "GT", "TTAG"])
+        alt = rng.choice(["G", "T", "GTCA", "C"])
+        variants.append(" ".join([str(rng.randint(1, 22)), str(1000 + 37 * i), ".", ref, alt]))
+    return variants
+
+
+class ByteRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rng = random.Random(11)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_json(self, variants):
+        path = os.path.join(self.tmpdir, "results.json")
+        with open(path, "w") as fh:
+            for i, variant in enumerate(variants):
+                if i % 17 == 0:
+                    fh.write("#metrics " + json.dumps({"batch": "batch" + str(i), "tools": []}) + "\n")
+                #Callers with varying numbers of cells, so lines have very different lengths
+                results = dict((caller, dict((norm, dict((comp, self.rng.choice(RESULTS)) for comp in COMPARATORS[0:self.rng.randint(1, 3)])) for norm in NORMALIZERS)) for caller in CALLERS[0:self.rng.randint(1, 3)])
+                quals = dict((caller, self.rng.random() * 100) for caller in results)
+                fh.write(json.dumps({"variant": variant, "caller_quals": quals, "bamstats": {"total_reads": i}, "results": results}) + "\n")
+        return path
+
+    def write_legacy(self, variants):
+        path = os.path.join(self.tmpdir, "results.txt")
+        with open(path, "w") as fh:
+            for i, variant in enumerate(variants):
+                fh.write("Processing batch containing " + variant + "\n")
+                #From a single line to many lines per variant, so groups often straddle range boundaries
+                for j in range(self.rng.choice([1, 1, 2, 5, 12, 27])):
+                    caller, norm, comp = CALLERS[j % 3], NORMALIZERS[(j / 3) % 3], COMPARATORS[(j / 9) % 3]
+                    fh.write("Result for " + variant + ": " + caller + " / " + norm + " / " + comp + " " + self.rng.choice(RESULTS) + "\n")
+                    if self.rng.random() < 0.1:
+                        fh.write("Log line between results\n")
+        return path
+
+    def check_ranges(self, reader, path):
+        serial = list(reader(path))
+        self.assertTrue(len(serial) > 0)
+        for count in RANGE_COUNTS:
+            chunked = []
+            for start, end in parse_results_json.chunk_ranges(path, count):
+                chunked.extend(reader(path, start, end))
+            self.assertEqual(serial, chunked, "Results differ when read in " + str(count) + " ranges")
+
+    def test_json(self):
+        path = self.write_json(random_variants(self.rng, 200))
+        self.check_ranges(parse_results_json.read_results, path)
+
+    def test_legacy(self):
+        path = self.write_legacy(random_variants(self.rng, 200))
+        self.check_ranges(aggregate.read_legacy, path)
+
+    def test_legacy_single_variant(self):
+        #Every range but the first starts inside the one group of lines
+        path = os.path.join(self.tmpdir, "single.txt")
+        with open(path, "w") as fh:
+            for i in range(30):
+                fh.write("Result for 1 1000 . A G: " + CALLERS[i % 3] + " / " + NORMALIZERS[i / 10] + " / raw " + RESULTS[i % 4] + "\n")
+        self.check_ranges(aggregate.read_legacy, path)
+
+    def test_chunk_ranges_cover_file(self):
+        path = self.write_json(random_variants(self.rng, 20))
+        size = os.path.getsize(path)
+        for count in RANGE_COUNTS:
+            ranges = parse_results_json.chunk_ranges(path, count)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(size, ranges[-1][1])
+            for (start1, end1), (start2, end2) in zip(ranges, ranges[1:]):
+                self.assertEqual(end1, start2)
+
+
+if __name__ == "__main__":
+    unittest.main()
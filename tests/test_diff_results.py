@@ -0,0 +1,96 @@
+"""
+Merge joining of sorted cell streams and sorting of sources in chunks by diff_results.py
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vcomp"))
+
+import diff_results
+
+MISSING = diff_results.MISSING
+
+
+def cell(variant, caller, result, normalizer="nonorm", comparator="vgraph", scenario=""):
+    return (variant, scenario, caller, normalizer, comparator, result)
+
+
+def joined(cells1, cells2):
+    return list(diff_results.join(iter(cells1), iter(cells2)))
+
+
+class JoinTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], joined([], []))
+
+    def test_one_side_empty(self):
+        cells = [cell("1 10 . A G", "gatk", "Match"), cell("1 20 . A G", "gatk", "No match")]
+        self.assertEqual([(c[0:5], c[5], MISSING) for c in cells], joined(cells, []))
+        self.assertEqual([(c[0:5], MISSING, c[5]) for c in cells], joined([], cells))
+
+    def test_matching_keys(self):
+        cells1 = [cell("1 10 . A G", "freebayes", "Match"), cell("1 10 . A G", "gatk", "Match")]
+        cells2 = [cell("1 10 . A G", "freebayes", "No match"), cell("1 10 . A G", "gatk", "Match")]
+        self.assertEqual([(cells1[0][0:5], "Match", "No match"), (cells1[1][0:5], "Match", "Match")], joined(cells1, cells2))
+
+    def test_interleaved_missing(self):
+        a = cell("1 10 . A G", "gatk", "Match")
+        b = cell("1 20 . A G", "gatk", "Match")
+        c = cell("1 30 . A G", "gatk", "Match")
+        d = cell("1 40 . A G", "gatk", "Match")
+        self.assertEqual([(a[0:5], "Match", MISSING), (b[0:5], MISSING, "Match"), (c[0:5], "Match", MISSING), (d[0:5], "Match", "Match")],
+                         joined([a, c, d], [b, d]))
+
+    def test_last_cells_missing(self):
+        #The stream that runs out first must not stop the join
+        a = cell("1 10 . A G", "gatk", "Match")
+        b = cell("1 20 . A G", "gatk", "Match")
+        self.assertEqual([(a[0:5], "Match", "Match"), (b[0:5], "Match", MISSING)], joined([a, b], [a]))
+        self.assertEqual([(a[0:5], "Match", "Match"), (b[0:5], MISSING, "Match")], joined([a], [a, b]))
+
+    def test_duplicate_keys(self):
+        #The first of several cells with the same key is used, and the rest are skipped on both sides
+        first = cell("1 10 . A G", "gatk", "Match")
+        second = cell("1 10 . A G", "gatk", "No match")
+        other = cell("1 20 . A G", "gatk", "Error")
+        self.assertEqual([(first[0:5], "Match", "Match"), (other[0:5], MISSING, "Error")], joined([first, second], [first, second, second, other]))
+
+    def test_random_against_dicts(self):
+        rng = random.Random(5)
+        keys = [cell("1 " + str(pos) + " . A G", caller, None)[0:5] for pos in range(0, 300, 3) for caller in ("freebayes", "gatk")]
+        sides = [dict((key, rng.choice(["Match", "No match", "Error"])) for key in keys if rng.random() < 0.7) for i in range(2)]
+        expected = [(key, sides[0].get(key, MISSING), sides[1].get(key, MISSING)) for key in sorted(set(sides[0]) | set(sides[1]))]
+        cells = [sorted(key + (result,) for key, result in side.iteritems()) for side in sides]
+        self.assertEqual(expected, joined(cells[0], cells[1]))
+
+
+class SortedCellsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chunk_sizes(self):
+        #Merging sorted runs from disk gives the same order as sorting in memory, whatever the chunk size
+        rng = random.Random(3)
+        path = os.path.join(self.tmpdir, "results.json")
+        with open(path, "w") as fh:
+            for i in rng.sample(range(1000), 100):
+                results = {"gatk": {"nonorm": {"vgraph": rng.choice(["Match", "No match"]), "raw": "Match"}}}
+                fh.write(json.dumps({"variant": "1 " + str(i) + " . A G", "results": results}) + "\n")
+        expected = sorted(diff_results.source_cells(path))
+        for chunk_size in (1, 2, 7, 50, 199, 200, 201, 10000):
+            self.assertEqual(expected, list(diff_results.sorted_cells(path, self.tmpdir, chunk_size)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Summarize several results files in one pass, for instance the shards of a run made by run_all.sh:
+
+    python vcomp/aggregate.py results_*_het_v8.txt results_*_hom_v8.txt --ops summary,bysize -j 8
+
+Files may be json results (as written by injectvar.py) or the older text format read by
+parse_testcaller_output.py, with one 'Result for ...' line per caller / normalizer / comparator, and the format of
+each file is detected from its contents. All files are split into byte ranges that are parsed in separate processes
+running the parse_results_json operations, and the partial results are merged before the operations are finalized.
+The legacy format has no caller qualities or bam statistics, so operations that need them (like table) only work on
+json results.
+"""
+
+import argparse
+import os
+
+import parse_results_json
+import stats
+
+JSON_FORMAT = "json"
+LEGACY_FORMAT = "legacy"
+
+LEGACY_PREFIX = "Result for"
+
+#Number of lines examined when detecting the format of a file
+DETECT_LINES = 1000
+
+
+def detect_format(path):
+    """
+    Guess whether a file holds json results or legacy text results from its first few lines
+    """
+    with open(path) as fh:
+        for i, line in enumerate(fh):
+            if i >= DETECT_LINES:
+                break
+            if line.startswith("{"):
+                return JSON_FORMAT
+            if line.startswith(LEGACY_PREFIX):
+                return LEGACY_FORMAT
+    raise ValueError("Could not find json or legacy results in " + path)
+
+
+def parse_legacy_line(line):
+    """
+    Parse a line of the legacy format, 'Result for <chrom> <pos> <id> <ref> <alt>: <caller> ... <normalizer> ...
+    <comparator> <result>'
+    :return: Tuple of variant string, caller, normalizer, comparator and result, or None if the line is incomplete
+    """
+    toks = line.strip().split(' ', 12)
+    if len(toks) < 13:
+        return None
+    alt = toks[6].replace(":", "")
+    variant = " ".join(toks[2:6] + [alt])
+    return variant, toks[7], toks[9], toks[11], toks[12]
+
+
+def read_legacy(path, start=0, end=None):
+    """
+    Generate results dicts (with the same fields as json results) from the legacy lines of a byte range of a file,
+    combining consecutive lines for the same variant. A variant's lines may straddle the boundary between ranges, so
+    each range owns the group of lines that includes the first line beginning at or after its end: reading continues
+    past the end until that group is complete, and a range not at the start of the file skips the group its first
+    line belongs to (and reads nothing if no line begins within it). Every group is then read by exactly one range,
+    whatever the offsets
+    """
+    record = None
+    skipping = start > 0
+    skip_variant = None
+    last = None
+    for offset, line in parse_results_json.read_lines(path, start):
+        if not line.startswith(LEGACY_PREFIX):
+            continue
+        parsed = parse_legacy_line(line)
+        if parsed is None:
+            continue
+        variant, caller, normalizer, comparator, result = parsed
+        if end is not None and offset >= end:
+            if last is None:
+                if skipping and skip_variant is None:
+                    #No legacy line begins in the range, the group of this line belongs to an earlier one
+                    return
+                last = variant
+            if variant != last:
+                break
+        if skipping:
+            if skip_variant is None:
+                skip_variant = variant
+            if variant == skip_variant:
+                continue
+            skipping = False
+        if record is not None and record[parse_results_json.VARIANT] != variant:
+            yield record
+            record = None
+        if record is None:
+            record = {parse_results_json.VARIANT: variant, parse_results_json.QUALS: {}, parse_results_json.BAMSTATS: {}, parse_results_json.RESULTS: {}}
+        record[parse_results_json.QUALS][caller] = None
+        record[parse_results_json.RESULTS].setdefault(caller, {}).setdefault(normalizer, {})[comparator] = result
+    if record is not None:
+        yield record
+
+
+#Reader for each format, generating the results dicts in a byte range of a file
+READERS = {
+    JSON_FORMAT: parse_results_json.read_results,
+    LEGACY_FORMAT: read_legacy,
+}
+
+
+def aggregate(paths, operations, workers=1):
+    """
+    Run the operations on every result in all of the files, then finalize them. With more than one worker, each
+    file is split into a number of byte ranges proportional to its size, so that all workers have several ranges
+    to parse, and the ranges of all files are parsed in parallel
+    :param paths: List of results files, json or legacy
+    :param operations: List of operations
+    :param workers: Number of processes to use
+    """
+    formats = dict((path, detect_format(path)) for path in paths)
+    if workers > 1 and all(hasattr(op, 'merge') for op in operations):
+        total = sum(os.path.getsize(path) for path in paths)
+        chunks = []
+        for path in paths:
+            nchunks = max(1, int(round(workers * 4 * os.path.getsize(path) / float(max(1, total)))))
+            chunks.extend((READERS[formats[path]], path, start, end) for start, end in parse_results_json.chunk_ranges(path, nchunks))
+        parse_results_json.perform_parallel(chunks, operations, workers)
+    else:
+        for path in paths:
+            for results in READERS[formats[path]](path):
+                for op in operations:
+                    op.perform_op(results)
+
+    for op in operations:
+        print "\n"
+        op.finalize()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Summarize several varcomp results files together")
+    parser.add_argument("results", help="Results files, json or legacy text format", nargs="+")
+    parser.add_argument("--ops", help="Comma separated list of operations to perform (" + ", ".join(sorted(parse_results_json.OPERATIONS)) + "), default: summary", default="summary")
+    parser.add_argument("--ci", help="Add confidence intervals for match rates to summaries, computed by one of: " + ", ".join(stats.METHODS), choices=stats.METHODS, default=None)
+    parser.add_argument("-j", "--workers", help="Number of processes used to parse the results (default 1)", default=1, type=int)
+    parser.add_argument("--plot-dir", help="Write the plots of operations that make them as png files to this directory")
+    args = parser.parse_args()
+
+    if args.plot_dir is not None and not os.path.exists(args.plot_dir):
+        os.makedirs(args.plot_dir)
+
+    try:
+        ops = parse_results_json.make_operations(args.ops.split(","), ci=args.ci, plot_dir=args.plot_dir)
+    except ValueError as ex:
+        parser.error(str(ex))
+    aggregate(args.results, ops, workers=args.workers)
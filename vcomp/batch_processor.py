@@ -1,36 +1,53 @@
 import os
+import json
 import pysam
 import util
 import logging
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import traceback as tb
 import sys
+import random
 from sim import bam_simulation
+from vcomp import runner
+from result_types import NO_VARS_FOUND_RESULT, MATCH_RESULT, NO_MATCH_RESULT, MATCH_WITH_EXTRA_RESULT, ERROR_RESULT, \
+    ZYGOSITY_MATCH, ZYGOSITY_EXTRA_ALLELE, ZYGOSITY_MISSING_ALLELE, ZYGOSITY_MISSING_TWO_ALLELES, MISSING_QUAL
 
-NO_VARS_FOUND_RESULT="No variants identified"
-MATCH_RESULT="Variants matched"
-NO_MATCH_RESULT="Variants did not match"
-MATCH_WITH_EXTRA_RESULT= "Additional false variants present"
-ERROR_RESULT="Error"
+#A genotype configuration to simulate the input variants in: a genotype policy (see create_variant_sets) and
+#optional extra SNP info. Named scenarios become separate samples of a multi-sample bam
+Scenario = namedtuple('Scenario', ['name', 'gt_policy', 'snp_info'])
 
-MISSING_QUAL = -1
+#Reads simulated for one scenario: the final input variants, bed file of regions and aligned reads
+SimulatedSample = namedtuple('SimulatedSample', ['scenario', 'orig_vcf', 'bed', 'bam'])
 
-ZYGOSITY_MATCH="Zygosity match"
-ZYGOSITY_EXTRA_ALLELE="Extra allele"
-ZYGOSITY_MISSING_ALLELE="Missing allele"
-ZYGOSITY_MISSING_TWO_ALLELES="Missing two alleles!"
+#Written to the tmpdir of every batch, describes the simulated samples and caller outputs so that kept tmpdirs can
+#be used to fill in results later (see resume.py)
+MANIFEST_FILE = "manifest.json"
 
 class VariantProcessor(object):
 
-    def __init__(self, variant_callers, normalizers, comparators, output_reporter):
+    def __init__(self, variant_callers, normalizers, comparators, output_reporter, cache=None, exact_comparator=None, scheduler=None, versions=None):
+        """
+        :param cache: Optional memo.InvocationCache, if given all normalizer and comparator calls are memoized
+        :param exact_comparator: Comparator used on unnormalized vcfs to find exact matches when running in
+        fast path mode (typically compare_raw)
+        :param scheduler: Optional resources.ResourceScheduler, used to reserve resources for read alignment
+        :param versions: Optional dict of tool versions (see memo.tool_versions), recorded in the batch manifest
+        """
         self.callers = variant_callers
         self.normalizers = normalizers
         self.comparators = comparators
+        self.cache = cache
+        self.exact_comparator = exact_comparator
+        self.scheduler = scheduler
+        self.versions = versions or {}
+        if cache is not None:
+            self.normalizers = dict((name, cache.normalizer(name, n)) for name, n in normalizers.iteritems())
+            self.comparators = dict((name, cache.comparator(name, c)) for name, c in comparators.iteritems())
         # self.read_simulator = read_simulator
         self.reporter = output_reporter
 
 
-    def process_batch(self, vcf, batchname, conf, gt_policy, ex_snp=None, keep_tmpdir=False, read_depth=250, reads=None):
+    def process_batch(self, vcf, batchname, conf, gt_policy, ex_snp=None, keep_tmpdir=False, read_depth=250, reads=None, fast_path=False, audit_fraction=0.0, scenarios=None):
         """
         Process the given batch of variants by creating a fake 'genome' with the variants, simulating reads from it,
          aligning the reads to make a bam file, then using different callers, variant normalizers, and variant
@@ -39,8 +56,17 @@ class VariantProcessor(object):
         :param vcf: .vcf file containing variants to simulate
         :param conf: Configuration containing paths to all required binaries / executables / genomes, etc.
         :param homs: Boolean indicating whether variants should be simulated as hets or homs
+        :param fast_path: Regions where a caller's unnormalized output exactly matches the input variants are
+        recorded as matches for every normalizer / comparator without running them
+        :param audit_fraction: In fast path mode, fraction of exactly matching regions that are compared anyway
+        to verify that the comparators agree
+        :param scenarios: Optional list of Scenarios. If given, gt_policy and ex_snp are ignored and each scenario is
+        simulated as a separate sample of a single bam, so that multi-sample callers are run only once. Results
+        are reported separately for each scenario
         :return:
         """
+        if fast_path and self.exact_comparator is None:
+            raise ValueError('Fast path mode requires an exact comparator')
         variant_batch = list(pysam.VariantFile(vcf))
         tmpdir = "tmp-working-" + util.randstr()
         try:
@@ -50,72 +76,43 @@ class VariantProcessor(object):
         os.chdir(tmpdir)
 
         ref_path = conf.get('main', 'ref_genome')
-        bam_stats = defaultdict(dict)
         remove_tmpdir = not keep_tmpdir
         try:
 
-            variant_sets = create_variant_sets(variant_batch, ex_snp, gt_policy, pysam.FastaFile(ref_path))
-            allvars = []
-            for vset in variant_sets:
-                allvars.extend(vset['vars'])
-            variant_batch = sorted(allvars, cmp=util.variant_comp)
-            orig_vcf = util.write_vcf(variant_batch, "test_input.vcf", conf)
-
-            bed = util.vars_to_bed(variant_sets)
-            if reads is None:
-                reads = bam_simulation.gen_alt_fq(ref_path, variant_sets, read_depth)
-
-            bam = bam_simulation.gen_alt_bam(ref_path, conf, reads)
-
-            var_results = defaultdict(dict)
-            variants = {}
-            var_quals = defaultdict(dict)
-
-            #Call all variants using each variant caller, store in variants dict
-            for caller in self.callers:
-                logging.info("Running variant caller " + caller)
-                vars = self.callers[caller](bam, ref_path, bed, conf)
-                variants[caller] = vars
-
-            #Compute bam statistics separately for each region, and store them in a dictionary indexed
-            #by the same key used to store individual varian results
-            for region in util.read_regions(bed):
-                match_vars = util.find_matching_var( pysam.VariantFile(orig_vcf), region)
-                match_var = "/".join([" ".join(str(mvar).split()[0:5]) for mvar in match_vars])
-                bam_stats[match_var] = bam_simulation.gen_bam_stats(bam, region)
-                for caller in self.callers:
-                    cvar = util.find_matching_var(pysam.VariantFile(variants[caller]), region)
-                    var_quals[match_var][caller] = find_qual(cvar)
-
-
-            for normalizer_name, normalizer in self.normalizers.iteritems():
-                logging.info("Running normalizer " + normalizer_name)
-                normed_orig_vcf = normalizer(orig_vcf, conf)
-
-                for caller in variants:
-                    normed_caller_vcf = normalizer(variants[caller], conf)
-
-                    for comparator_name, comparator in self.comparators.iteritems():
-                        all_results = comparator(normed_orig_vcf, normed_caller_vcf, None, conf)
-                        single_results = split_results(all_results, bed)
-                        logging.info("Running comparator " + comparator_name)
-                        for region, result in zip(util.read_regions(bed), single_results):
-                            match_vars = util.find_matching_var( pysam.VariantFile(orig_vcf), region)
-                            if len(match_vars)==0:
-                                raise ValueError('Unable to find original variant from region!')
-
-                            result = compare_single_var(result, region, normed_orig_vcf, normed_caller_vcf, comparator, "/".join([str(i) for i in match_vars[0].samples[0]['GT']]), conf)
-
-                            match_var = "/".join([" ".join(str(mvar).split()[0:5]) for mvar in match_vars])
-
-                            if caller not in var_results[match_var]:
-                                var_results[match_var][caller] = defaultdict(dict)
-
-                            var_results[match_var][caller][normalizer_name][comparator_name] = result
+            if scenarios is None or len(scenarios)==0:
+                samples = [self.simulate(variant_batch, Scenario(None, gt_policy, ex_snp), ref_path, conf, read_depth, reads)]
+            else:
+                if reads is not None:
+                    raise ValueError('Existing reads cannot be used when simulating multiple scenarios')
+                snp_alts = {}
+                samples = [self.simulate(variant_batch, scenario, ref_path, conf, read_depth, snp_alts=snp_alts) for scenario in scenarios]
+
+            variants, timed_out = self.call_variants(samples, ref_path, conf)
+
+            for sample in samples:
+                name = sample.scenario.name
+                sample_variants = dict((caller, vcf) for (caller, sname), vcf in variants.iteritems() if sname == name)
+                regions = region_variants(sample.bed, sample.orig_vcf)
+                bam_stats, var_quals = self.sample_stats(sample, regions, sample_variants)
+
+                var_results = self.compare_calls(sample.orig_vcf, sample.bed, regions, sample_variants, conf, fast_path=fast_path, audit_fraction=audit_fraction)
+                for caller, sname in timed_out:
+                    if sname == name:
+                        for normalizer_name in self.normalizers:
+                            record_errors(var_results, regions, caller, normalizer_name, self.comparators)
+
+                #Iterate over all results and write to standard output. We do this here instead of within the loops above
+                #because it keeps results organized by variant, which makes them easier to look at
+                if name is None:
+                    self.reporter.write_output(var_results, var_quals, bam_stats)
+                else:
+                    self.reporter.write_output(var_results, var_quals, bam_stats, scenario=name)
 
-            #Iterate over all results and write to standard output. We do this here instead of within the loops above
-            #because it keeps results organized by variant, which makes them easier to look at
-            self.reporter.write_output(var_results, var_quals, bam_stats)
+            if hasattr(self.reporter, 'write_metrics'):
+                self.reporter.write_metrics(batchname, runner.drain_metrics())
+            if self.cache is not None:
+                self.cache.log_stats()
+            write_manifest(MANIFEST_FILE, batchname, samples, variants, timed_out, self.versions)
 
         except Exception as ex:
             logging.error("Error processing variant batch " + batchname + " : " + str(ex))
@@ -128,10 +125,326 @@ class VariantProcessor(object):
                 #we tried...
                 pass
 
+        runner.drain_metrics()
         os.chdir("..")
         if remove_tmpdir:
             os.system("rm -rf " + tmpdir)
 
+    def simulate(self, variant_batch, scenario, ref_path, conf, read_depth, reads=None, snp_alts=None):
+        """
+        Simulate reads for the variants in the batch under the given scenario, and align them
+        :param variant_batch: List of input variants
+        :param scenario: Scenario describing genotypes and extra SNPs. Scenarios without a name are simulated as
+        a single sample called 'sample', otherwise the name is used as the sample name
+        :param reads: Existing reads to align instead of simulating new ones
+        :param snp_alts: Optional dict of alt bases of extra SNPs shared by scenarios, see util.gen_snp
+        :return: SimulatedSample
+        """
+        suffix = "" if scenario.name is None else "-" + scenario.name
+        variant_sets = create_variant_sets(variant_batch, scenario.snp_info, scenario.gt_policy, util.get_fasta(ref_path), cluster=scenario.snp_info is None, snp_alts=snp_alts)
+        allvars = []
+        for vset in variant_sets:
+            allvars.extend(vset['vars'])
+        orig_vcf = util.write_vcf(sorted(allvars, cmp=util.variant_comp), "test_input" + suffix + ".vcf", conf)
+
+        bed = util.vars_to_bed(variant_sets)
+        if reads is None:
+            reads = bam_simulation.gen_alt_fq(ref_path, variant_sets, read_depth, dest_prefix="input" + suffix)
+
+        align = bam_simulation.gen_alt_bam
+        if self.scheduler is not None:
+            align = self.scheduler.wrap(align)
+        bam = align(ref_path, conf, reads, sample=scenario.name or bam_simulation.DEFAULT_SAMPLE)
+        return SimulatedSample(scenario, os.path.abspath(orig_vcf), os.path.abspath(bed), os.path.abspath(bam))
+
+    def call_variants(self, samples, ref_path, conf):
+        """
+        Run every variant caller on the simulated samples. With a single sample each caller is simply run on its
+        bam. With several samples, multi-sample callers (see util.multisample_caller) are run once on a merged bam
+        and their output split by sample column, while other callers are run separately on each sample's bam, in
+        a directory of its own so their output files don't collide. A caller that times out gets an error result
+        for every variant of the affected samples
+        :param samples: List of SimulatedSamples
+        :return: Tuple of dict of (caller, scenario name) -> vcf, and list of (caller, scenario name) that timed out
+        """
+        variants = {}
+        timed_out = []
+        if len(samples)>1:
+            merged_bam = bam_simulation.merge_bams([s.bam for s in samples], "scenarios.bam", conf)
+            merged_bed = util.merge_beds([s.bed for s in samples])
+
+        for caller in self.callers:
+            logging.info("Running variant caller " + caller)
+            func = self.callers[caller]
+            if len(samples)==1:
+                runs = [ ([samples[0]], samples[0].bam, samples[0].bed, ".") ]
+            elif util.is_multisample_caller(func):
+                runs = [ (samples, merged_bam, merged_bed, ".") ]
+            else:
+                runs = [ ([s], s.bam, s.bed, "sample-" + s.scenario.name) for s in samples ]
+
+            for run_samples, bam, bed, dirname in runs:
+                try:
+                    vcf = run_in_dir(dirname, func, bam, ref_path, bed, conf)
+                except runner.ToolTimeout as ex:
+                    logging.error("Variant caller " + caller + " failed: " + str(ex))
+                    timed_out.extend((caller, s.scenario.name) for s in run_samples)
+                    continue
+                if len(run_samples)==1:
+                    variants[(caller, run_samples[0].scenario.name)] = vcf
+                else:
+                    for s in run_samples:
+                        variants[(caller, s.scenario.name)] = util.extract_sample(vcf, s.scenario.name, conf)
+        return variants, timed_out
+
+    def sample_stats(self, sample, regions, sample_variants):
+        """
+        Compute bam statistics separately for each region, and the quality each caller assigned to the variants in
+        it, in dictionaries indexed by the same key used to store individual variant results
+        :param sample: SimulatedSample
+        :param regions: List of (region, input variants, variant key) tuples, as from region_variants
+        :param sample_variants: Dict of caller name -> caller vcf for the sample
+        :return: Tuple of bam stats dict and caller quals dict
+        """
+        bam_stats = defaultdict(dict)
+        var_quals = defaultdict(dict)
+        caller_vars = dict((caller, list(pysam.VariantFile(vcf))) for caller, vcf in sample_variants.iteritems())
+        for region, match_vars, match_var in regions:
+            bam_stats[match_var] = bam_simulation.gen_bam_stats(sample.bam, region)
+            for caller in self.callers:
+                if caller in caller_vars:
+                    var_quals[match_var][caller] = find_qual(util.find_matching_var(caller_vars[caller], region))
+                else:
+                    var_quals[match_var][caller] = MISSING_QUAL
+        return bam_stats, var_quals
+
+    def compare_calls(self, orig_vcf, bed, regions, variants, conf, fast_path=False, audit_fraction=0.0, cells=None):
+        """
+        Run every normalizer and comparator on the output of every caller, and determine a result for each
+        region. Timeouts of normalizers or comparators produce error results for the affected cells only
+        :param orig_vcf: Input (truth) variants
+        :param bed: BED file containing all regions in the batch
+        :param regions: List of (region, input variants, variant key) tuples, as from region_variants
+        :param variants: Dict of caller name -> caller vcf
+        :param conf: Configuration
+        :param fast_path: Skip comparisons in regions where the caller output matches the input exactly
+        :param audit_fraction: Fraction of fast path regions to compare anyway
+        :param cells: Optional set of (caller, normalizer, comparator) tuples, if given only these combinations
+        are computed
+        :return: Four-level deep dict containing [input variant string][caller][normalizer][comparator]
+        """
+        var_results = defaultdict(dict)
+        exact_regions = set()
+        if fast_path:
+            exact_regions = self.find_exact_matches(orig_vcf, variants, bed, conf)
+
+        for normalizer_name, normalizer in self.normalizers.iteritems():
+            callers = [c for c in variants if len(selected_comparators(self.comparators, cells, c, normalizer_name))>0]
+            if len(callers)==0:
+                continue
+            logging.info("Running normalizer " + normalizer_name)
+            try:
+                normed_orig_vcf = run_normalizer(normalizer, orig_vcf, conf)
+            except runner.ToolTimeout as ex:
+                logging.error("Normalizer " + normalizer_name + " failed on input variants: " + str(ex))
+                for caller in callers:
+                    record_errors(var_results, regions, caller, normalizer_name, selected_comparators(self.comparators, cells, caller, normalizer_name))
+                continue
+
+            for caller in callers:
+                comparators = selected_comparators(self.comparators, cells, caller, normalizer_name)
+                try:
+                    normed_caller_vcf = run_normalizer(normalizer, variants[caller], conf)
+                except runner.ToolTimeout as ex:
+                    logging.error("Normalizer " + normalizer_name + " failed on " + caller + " variants: " + str(ex))
+                    record_errors(var_results, regions, caller, normalizer_name, comparators)
+                    continue
+
+                shortcut, audited = set(), set()
+                compare_bed = None
+                if fast_path:
+                    #Only regions that did not match exactly (plus a sample of those that did, for auditing)
+                    #are handed to the comparators
+                    shortcut, audited = select_shortcut_regions(bed, exact_regions, caller, audit_fraction)
+                    compare_regions = [r[0] for i, r in enumerate(regions) if i not in shortcut]
+                    if len(compare_regions)>0:
+                        compare_bed = util.regions_to_bedfile(compare_regions)
+
+                for comparator_name, comparator in comparators.iteritems():
+                    logging.info("Running comparator " + comparator_name)
+                    try:
+                        if fast_path and compare_bed is None:
+                            single_results = []
+                        else:
+                            all_results = comparator(normed_orig_vcf, normed_caller_vcf, compare_bed, conf)
+                            single_results = split_results(all_results, bed)
+                    except runner.ToolTimeout as ex:
+                        logging.error("Comparator " + comparator_name + " failed on " + caller + " / " + normalizer_name + ": " + str(ex))
+                        record_errors(var_results, regions, caller, normalizer_name, [comparator_name])
+                        continue
+
+                    for i, (region, match_vars, match_var) in enumerate(regions):
+                        if i in shortcut:
+                            result = MATCH_RESULT
+                        else:
+                            try:
+                                result = compare_single_var(single_results[i], region, normed_orig_vcf, normed_caller_vcf, comparator, "/".join([str(g) for g in match_vars[0].samples[0]['GT']]), conf)
+                            except runner.ToolTimeout as ex:
+                                logging.error("Comparator " + comparator_name + " failed on single region: " + str(ex))
+                                result = ERROR_RESULT
+                            if i in audited and result != MATCH_RESULT:
+                                logging.warning("Fast path audit failed for " + caller + " / " + normalizer_name + " / " + comparator_name + " in region " + "\t".join([region.chr, str(region.start), str(region.end)]) + ": " + result)
+
+                        store_result(var_results, match_var, caller, normalizer_name, comparator_name, result)
+
+        return var_results
+
+    def find_exact_matches(self, orig_vcf, variants, bed, conf):
+        """
+        Compare each caller's unnormalized output to the input variants with the exact comparator and
+        collect the regions in which everything matches perfectly
+        :param orig_vcf: Input (truth) variants
+        :param variants: Dict of caller name -> caller vcf
+        :param bed: BED file containing all regions in the batch
+        :return: Set of (caller, region index) tuples that matched exactly
+        """
+        exact = set()
+        for caller in variants:
+            all_results = self.exact_comparator(orig_vcf, variants[caller], None, conf)
+            for i, result in enumerate(split_results(all_results, bed)):
+                if result_from_tuple(result) == MATCH_RESULT:
+                    exact.add( (caller, i) )
+            logging.info("Fast path: " + caller + " matched exactly in " + str(len([e for e in exact if e[0]==caller])) + " regions")
+        return exact
+
+def run_in_dir(dirname, func, *args):
+    """
+    Call func with the given args in the given directory (created if necessary), returning the absolute path of
+    the file it returns
+    """
+    if dirname == ".":
+        return func(*args)
+    if not os.path.exists(dirname):
+        os.mkdir(dirname)
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        return os.path.abspath(func(*args))
+    finally:
+        os.chdir(cwd)
+
+def variant_key(match_vars):
+    """
+    The string used to identify the input variant(s) in a region in the results
+    """
+    return "/".join([" ".join(str(mvar).split()[0:5]) for mvar in match_vars])
+
+def region_variants(bed, orig_vcf):
+    """
+    Find the input variants contained in each region of the bed file
+    :param bed: BED file containing all regions in the batch
+    :param orig_vcf: Input (truth) variants
+    :return: List of (region, matching variants, variant key) tuples, in the same order as the bed file
+    """
+    orig_vars = list(pysam.VariantFile(orig_vcf))
+    regions = []
+    for region in util.read_regions(bed):
+        match_vars = util.find_matching_var(orig_vars, region)
+        if len(match_vars)==0:
+            raise ValueError('Unable to find original variant from region!')
+        regions.append( (region, match_vars, variant_key(match_vars)) )
+    return regions
+
+def selected_comparators(comparators, cells, caller, normalizer):
+    """
+    The comparators to run on the output of a caller after normalization with normalizer
+    :param comparators: Dict of comparator name -> comparator
+    :param cells: Set of (caller, normalizer, comparator) tuples to compute, or None for all of them
+    """
+    if cells is None:
+        return comparators
+    return dict((name, comp) for name, comp in comparators.iteritems() if (caller, normalizer, name) in cells)
+
+def write_manifest(path, batchname, samples, variants, timed_out, versions):
+    """
+    Record the simulated samples and caller outputs of a batch, with paths relative to the directory of the manifest
+    :param samples: List of SimulatedSamples
+    :param variants: Dict of (caller, scenario name) -> vcf, as from VariantProcessor.call_variants
+    :param timed_out: List of (caller, scenario name) that timed out
+    :param versions: Dict of tool versions, see memo.tool_versions
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    rel = lambda p: os.path.relpath(os.path.abspath(p), base)
+    manifest = {
+        "batch": batchname,
+        "samples": [{"scenario": s.scenario.name, "orig_vcf": rel(s.orig_vcf), "bed": rel(s.bed), "bam": rel(s.bam)} for s in samples],
+        "calls": [{"caller": caller, "scenario": sname, "vcf": rel(vcf)} for (caller, sname), vcf in variants.iteritems()],
+        "timed_out": [{"caller": caller, "scenario": sname} for caller, sname in timed_out],
+        "versions": versions
+    }
+    with open(path, "w") as fh:
+        json.dump(manifest, fh, indent=1)
+
+def read_manifest(dirname):
+    """
+    Read the manifest of a batch tmpdir kept with --keep
+    :return: Tuple of manifest dict, list of SimulatedSamples and dict of (caller, scenario name) -> vcf, with
+    absolute paths
+    """
+    dirname = os.path.abspath(dirname)
+    with open(os.path.join(dirname, MANIFEST_FILE)) as fh:
+        manifest = json.load(fh)
+    path = lambda p: os.path.join(dirname, p)
+    samples = [SimulatedSample(Scenario(s["scenario"], None, None), path(s["orig_vcf"]), path(s["bed"]), path(s["bam"])) for s in manifest["samples"]]
+    variants = dict(((c["caller"], c["scenario"]), path(c["vcf"])) for c in manifest["calls"])
+    return manifest, samples, variants
+
+def store_result(var_results, match_var, caller, normalizer, comparator, result):
+    if caller not in var_results[match_var]:
+        var_results[match_var][caller] = defaultdict(dict)
+    var_results[match_var][caller][normalizer][comparator] = result
+
+def record_errors(var_results, regions, caller, normalizer, comparators):
+    """
+    Store an error result for every region for the given caller, normalizer and comparator(s)
+    """
+    for comparator in comparators:
+        for region, match_vars, match_var in regions:
+            store_result(var_results, match_var, caller, normalizer, comparator, ERROR_RESULT)
+
+def select_shortcut_regions(bed, exact_regions, caller, audit_fraction):
+    """
+    Decide which regions can skip comparison for a caller, setting aside a random sample of the exactly
+    matching regions for auditing
+    :param bed: BED file containing all regions in the batch
+    :param exact_regions: Set of (caller, region index) tuples that matched exactly
+    :param caller: Caller name
+    :param audit_fraction: Fraction of exactly matching regions to compare anyway
+    :return: Tuple of (set of region indices to skip, set of region indices being audited)
+    """
+    shortcut = set()
+    audited = set()
+    for i, _ in enumerate(util.read_regions(bed)):
+        if (caller, i) in exact_regions:
+            if random.random() < audit_fraction:
+                audited.add(i)
+            else:
+                shortcut.add(i)
+    return shortcut, audited
+
+def run_normalizer(normalizer, vcf, conf):
+    """
+    Normalize the given vcf. Identity normalizers (see util.identity_normalizer) are skipped entirely and
+    the input vcf is passed straight through, avoiding a pointless copy / re-index for every caller
+    :param normalizer: Normalizer function
+    :param vcf: Path to vcf to normalize
+    :param conf: Configuration
+    :return: Path to normalized vcf, which may be the input vcf itself
+    """
+    if util.is_identity_normalizer(normalizer):
+        return util.ensure_indexed(vcf, conf)
+    return normalizer(vcf, conf)
+
 def find_qual(vars):
     qual = MISSING_QUAL
     if vars is None or len(vars)==0:
@@ -228,16 +541,19 @@ def split_results(allresults, bed):
 
     return reg_results
 
-def create_variant_sets(vars, ex_snp_info, default_policy, ref_genome):
+def create_variant_sets(vars, ex_snp_info, default_policy, ref_genome, cluster=True, snp_alts=None):
     """
     Create a list of variant 'sets', where each set is a list of possibly-phased variants to add to two
     alternate reference genomes. If ex_snp_info isn't None, extra SNPs are added to each input variant, otherwise,
-    every variant ends up in its own unique set.
+    every variant ends up in its own unique set - except for variants too close to simulate independently, which
+    (if cluster is True) are grouped into a single set with the PHASED policy, see util.cluster_variants
     Default-pol
     :param vars: List of variants (not a VCF)
     :param ex_snp_info: Information describing additional SNPs to add to input variants
     :param default_policy: Genotype policy for original variants - either None (read GT from sample field), ALL_HETS, or ALL_HOMS
     :param ref_genome:
+    :param cluster: Simulate clusters of nearby variants jointly
+    :param snp_alts: Optional dict of alt bases of extra SNPs shared by scenarios, see util.gen_snp
     :return:
     """
     sets = []
@@ -250,6 +566,17 @@ def create_variant_sets(vars, ex_snp_info, default_policy, ref_genome):
     if default_policy ==  bam_simulation.ALL_HETS:
         default_gt = "0|1"
 
+    if ex_snp_info is None and cluster:
+        singles = []
+        for group in util.cluster_variants(vars):
+            if len(group)>1:
+                sets.append({'policy': bam_simulation.PHASED,
+                             'cluster': True,
+                             'vars': [util.pysamVar_to_Variant(var, default_gt) for var in group]})
+            else:
+                singles.append(group[0])
+        vars = singles
+
     for var in vars:
         vset = {}
         if ex_snp_info is None:
@@ -276,7 +603,7 @@ def create_variant_sets(vars, ex_snp_info, default_policy, ref_genome):
                     var_gt = "1|0"
                 else:
                     var_gt = default_gt
-            newsnp = util.gen_snp(var.chrom, var.start + ex_snp_info.dist, snp_gt, ref_genome)
+            newsnp = util.gen_snp(var.chrom, var.start + ex_snp_info.dist, snp_gt, ref_genome, snp_alts=snp_alts)
             vset['vars'] = [newsnp]
             vset['vars'].append(util.pysamVar_to_Variant(var, var_gt))
         sets.append(vset)
@@ -0,0 +1,421 @@
+"""
+Columnar results store. The json results written by injectvar.JsonReporter repeat every caller, normalizer and
+comparator name and every result string for each cell, and have to be parsed line by line to be summarized. A
+columnar store holds the same information as a directory of numpy arrays that can be memory mapped:
+
+    cells      one row per (variant, caller, normalizer, comparator) result:
+               record, caller, normalizer, comparator, result (codes) and qual (the caller's quality)
+    records    one row per input variant (and scenario):
+               variant, scenario, vartype (codes), ref_len, alt_len, size and one column per bam statistic
+
+Names are dictionary encoded, so summaries can be computed with a few vectorized group-bys (see ColumnarStore.counts) instead of by walking dicts. Stores are
+written directly by injectvar.py --columnar DIR, or converted from json results with
+
+    python vcomp/columnar.py results.json store_dir
+
+The distinct values of the small dimensions (caller, normalizer, comparator, result and vartype) are listed in
+dims.json. Variants and scenarios can have millions of values, which are appended to dims.variant.txt and
+dims.scenario.txt (one json string per line) as they are first seen, so they are only written once. While a store is being written, each batch is saved as it completes as a numbered part of every column, and the
+parts are joined when the writer is closed. A store whose writer never finished (e.g. after a crash) can be read as
+it is, or its parts joined with `python vcomp/columnar.py --finish store_dir`.
+"""
+
+import argparse
+import array
+import json
+import os
+
+import numpy as np
+
+DIMS_FILE = "dims.json"
+#Dimensions whose values are appended to their own file instead of being rewritten to DIMS_FILE
+APPENDED_DIMS = ("variant", "scenario")
+METRICS_FILE = "metrics.txt"
+#Number of complete parts of an unfinished store, absent once the parts have been joined
+PARTS_FILE = "parts.txt"
+
+#Number of records converted between saved parts
+CONVERT_BATCH = 100000
+
+#Coded columns of the cells and records tables, and the dimension each is coded against
+CELL_CODES = {"record": None, "caller": "caller", "normalizer": "normalizer", "comparator": "comparator", "result": "result"}
+RECORD_CODES = {"variant": "variant", "scenario": "scenario", "vartype": "vartype"}
+BAMSTATS = ("total_reads", "properpair", "mq20", "mq40", "softclipped_reads", "softclipped_bases")
+
+#Columns of each table
+COLUMNS = {
+    "cells": list(CELL_CODES) + ["qual"],
+    "records": list(RECORD_CODES) + ["ref_len", "alt_len", "size"] + list(BAMSTATS),
+}
+
+SNP = "SNP"
+INSERTION = "Insertion"
+DELETION = "Deletion"
+MNP = "MNP"
+
+
+def variant_alleles(varstr):
+    """
+    Ref and alt alleles of the (last) variant in a results variant string
+    """
+    toks = varstr.split("/")[-1].split()
+    return toks[3], toks[4]
+
+
+def variant_type(ref, alt):
+    """
+    Broad type of a variant, using the same rules as parse_results_json.get_vartype (without size bins)
+    """
+    if len(ref)==1 and len(alt)==1:
+        return SNP
+    if len(ref)<2 and len(alt)>1:
+        return INSERTION
+    if len(alt)<2 and len(ref)>1:
+        return DELETION
+    return MNP
+
+
+class Dimension(object):
+    """
+    Assigns consecutive integer codes to distinct strings
+    """
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self.codes = dict((v, i) for i, v in enumerate(self.values))
+
+    def code(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+
+def column_dtype(name):
+    return np.float64 if name == "qual" else np.int32
+
+
+def column_path(path, table, name, part=None):
+    if part is None:
+        return os.path.join(path, table + "." + name + ".npy")
+    return os.path.join(path, table + "." + name + "." + str(part) + ".part.npy")
+
+
+def dim_path(path, name):
+    return os.path.join(path, "dims." + name + ".txt")
+
+
+def read_appended_dim(path, name):
+    """
+    Values of an appended dimension. A line left incomplete by a crash is ignored, no saved part refers to it
+    """
+    values = []
+    with open(dim_path(path, name)) as fh:
+        for line in fh:
+            if line.endswith("\n"):
+                values.append(json.loads(line))
+    return values
+
+
+def write_atomic(path, data):
+    with open(path + ".tmp", "w") as fh:
+        fh.write(data)
+    os.rename(path + ".tmp", path)
+
+
+def read_parts(path):
+    """
+    Number of complete parts of an unfinished store, or None if the store is finished
+    """
+    parts_file = os.path.join(path, PARTS_FILE)
+    if not os.path.exists(parts_file):
+        return None
+    with open(parts_file) as fh:
+        return int(fh.read().strip())
+
+
+class ColumnarWriter(object):
+    """
+    Accumulates results in compact arrays. flush() saves what has accumulated as the next part of every column,
+    and close() joins the parts into the final columns
+    """
+
+    def __init__(self, path):
+        if read_parts(path) is not None:
+            raise ValueError(path + " holds an unfinished columnar store, join its parts with columnar.py --finish or remove it")
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.dims = dict((name, Dimension()) for name in ("variant", "scenario", "vartype", "caller", "normalizer", "comparator", "result"))
+        #Number of values of each dimension already written
+        self.written = dict((name, 0) for name in self.dims)
+        write_atomic(os.path.join(self.path, DIMS_FILE), json.dumps(dict((name, []) for name in self.dims if name not in APPENDED_DIMS)))
+        for name in APPENDED_DIMS:
+            open(dim_path(self.path, name), "w").close()
+        open(os.path.join(self.path, METRICS_FILE), "w").close()
+        #Metrics lines not yet written
+        self.metrics = []
+        self.parts = 0
+        #Number of records saved in earlier parts
+        self.saved_records = 0
+        self._clear()
+
+    def _clear(self):
+        self.cells = dict((name, array.array('d' if column_dtype(name) == np.float64 else 'i')) for name in COLUMNS["cells"])
+        self.records = dict((name, array.array('i')) for name in COLUMNS["records"])
+
+    def add_record(self, record):
+        """
+        Add a single results dict, as written by injectvar.JsonReporter
+        """
+        index = self.saved_records + len(self.records["variant"])
+        var = record["variant"]
+        ref, alt = variant_alleles(var)
+        self.records["variant"].append(self.dims["variant"].code(var))
+        self.records["scenario"].append(self.dims["scenario"].code(record.get("scenario")))
+        self.records["vartype"].append(self.dims["vartype"].code(variant_type(ref, alt)))
+        self.records["ref_len"].append(len(ref))
+        self.records["alt_len"].append(len(alt))
+        self.records["size"].append(len(alt) - len(ref))
+        bamstats = record.get("bamstats", {})
+        for stat in BAMSTATS:
+            self.records[stat].append(int(bamstats.get(stat, 0)))
+
+        quals = record.get("caller_quals", {})
+        for caller, caller_results in record["results"].iteritems():
+            qual = quals.get(caller)
+            for normalizer, norm_results in caller_results.iteritems():
+                for comparator, result in norm_results.iteritems():
+                    self.cells["record"].append(index)
+                    self.cells["caller"].append(self.dims["caller"].code(caller))
+                    self.cells["normalizer"].append(self.dims["normalizer"].code(normalizer))
+                    self.cells["comparator"].append(self.dims["comparator"].code(comparator))
+                    self.cells["result"].append(self.dims["result"].code(result))
+                    self.cells["qual"].append(float("nan") if qual is None else float(qual))
+
+    def flush(self):
+        """
+        Save the records added since the last flush as a new part of every column. The dimensions are written before
+        the part is counted as complete, so every saved part can always be decoded
+        """
+        if len(self.records["variant"])==0:
+            return
+        for table, columns in (("cells", self.cells), ("records", self.records)):
+            for name, values in columns.iteritems():
+                np.save(column_path(self.path, table, name, self.parts), to_numpy(values, column_dtype(name)))
+        self._write_dims()
+        self._write_metrics()
+        self.parts += 1
+        write_atomic(os.path.join(self.path, PARTS_FILE), str(self.parts) + "\n")
+        self.saved_records += len(self.records["variant"])
+        self._clear()
+
+    def _write_dims(self):
+        """
+        Append new values of the appended dimensions to their files, and rewrite the small dimensions if any of them
+        has new values
+        """
+        for name in APPENDED_DIMS:
+            values = self.dims[name].values
+            if len(values) > self.written[name]:
+                with open(dim_path(self.path, name), "a") as fh:
+                    fh.write("".join(json.dumps(v) + "\n" for v in values[self.written[name]:]))
+                self.written[name] = len(values)
+        small = [name for name in self.dims if name not in APPENDED_DIMS]
+        if any(len(self.dims[name].values) > self.written[name] for name in small):
+            write_atomic(os.path.join(self.path, DIMS_FILE), json.dumps(dict((name, self.dims[name].values) for name in small)))
+            for name in small:
+                self.written[name] = len(self.dims[name].values)
+
+    def _write_metrics(self):
+        if len(self.metrics)>0:
+            with open(os.path.join(self.path, METRICS_FILE), "a") as fh:
+                fh.write("".join(self.metrics))
+            self.metrics = []
+
+    def close(self):
+        self.flush()
+        self._write_metrics()
+        if self.parts == 0:
+            write_atomic(os.path.join(self.path, PARTS_FILE), "0\n")
+        finish(self.path)
+
+
+def to_numpy(values, dtype):
+    return np.frombuffer(values, dtype=dtype) if len(values)>0 else np.zeros(0, dtype=dtype)
+
+
+def finish(path):
+    """
+    Join the parts of an unfinished store into its final columns, one column at a time (written through a memory
+    map, so columns needn't fit in memory), then remove the parts
+    """
+    parts = read_parts(path)
+    if parts is None:
+        return
+    for table, names in COLUMNS.iteritems():
+        for name in names:
+            pieces = [np.load(column_path(path, table, name, part), mmap_mode='r') for part in range(parts)]
+            out = np.lib.format.open_memmap(column_path(path, table, name) + ".tmp", mode='w+', dtype=column_dtype(name), shape=(sum(len(p) for p in pieces),))
+            pos = 0
+            for piece in pieces:
+                out[pos:pos + len(piece)] = piece
+                pos += len(piece)
+            out.flush()
+            del out
+            os.rename(column_path(path, table, name) + ".tmp", column_path(path, table, name))
+    os.remove(os.path.join(path, PARTS_FILE))
+    #Including any part a crash left incomplete
+    for filename in os.listdir(path):
+        if filename.endswith(".part.npy"):
+            os.remove(os.path.join(path, filename))
+
+
+class ColumnarReporter(ColumnarWriter):
+    """
+    An output reporter (see injectvar.JsonReporter) that writes a columnar store, saving the results of each batch
+    as soon as they are reported. The parts are joined when the reporter is closed
+    """
+
+    def write_output(self, results, quals, bamstats, scenario=None):
+        for var, vresults in results.iteritems():
+            record = {
+                "variant": var,
+                "caller_quals": quals[var],
+                "bamstats": bamstats[var],
+                "results": vresults
+            }
+            if scenario is not None:
+                record["scenario"] = scenario
+            self.add_record(record)
+        self.flush()
+
+    def write_metrics(self, batchname, metrics):
+        self.metrics.append("#metrics " + json.dumps({"batch": batchname, "tools": [m._asdict() for m in metrics]}) + "\n")
+        self._write_metrics()
+
+
+class ColumnarStore(object):
+    """
+    Read access to a columnar store. Columns are memory mapped when first used. The parts of an unfinished store
+    (one still being written, or left by a crashed run) are read as they are, concatenated in memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #Read before the dimensions, which always cover the parts counted
+        self.parts = read_parts(path)
+        with open(os.path.join(path, DIMS_FILE)) as fh:
+            self.dims = json.load(fh)
+        for name in APPENDED_DIMS:
+            self.dims[name] = read_appended_dim(path, name)
+        self.columns = {}
+
+    def column(self, table, name):
+        key = (table, name)
+        if key not in self.columns:
+            if self.parts is None:
+                self.columns[key] = np.load(column_path(self.path, table, name), mmap_mode='r')
+            elif self.parts == 0:
+                self.columns[key] = np.zeros(0, dtype=column_dtype(name))
+            else:
+                self.columns[key] = np.concatenate([np.load(column_path(self.path, table, name, part), mmap_mode='r') for part in range(self.parts)])
+        return self.columns[key]
+
+    def cell_values(self, name):
+        """
+        Values of a column for every cell: cell columns are returned as is, record columns are looked up through
+        the record each cell belongs to
+        """
+        if name in CELL_CODES or name == "qual":
+            return self.column("cells", name)
+        return np.asarray(self.column("records", name))[self.column("cells", "record")]
+
+    def code(self, dim, value):
+        """
+        Code of a value of a dimension, or -1 if it does not occur in the store
+        """
+        try:
+            return self.dims[dim].index(value)
+        except ValueError:
+            return -1
+
+    def mask(self, **selected):
+        """
+        Boolean array selecting the cells with the given values of coded columns, e.g. mask(normalizer='nonorm')
+        """
+        mask = np.ones(len(self.column("cells", "record")), dtype=bool)
+        for name, value in selected.iteritems():
+            mask &= self.cell_values(name) == self.code(dimension(name), value)
+        return mask
+
+    def counts(self, columns, mask=None):
+        """
+        Count the cells for each combination of values of the given columns
+        :param columns: List of column names or arrays of per-cell values. Coded columns are decoded, others (e.g.
+        size, or arrays) are used as is and must be non-negative integers
+        :param mask: Optional boolean array selecting the cells to count
+        :return: Dict of tuple of column values -> count, for combinations with nonzero counts
+        """
+        values = []
+        for name in columns:
+            vals = np.asarray(self.cell_values(name) if isinstance(name, basestring) else name)
+            if mask is not None:
+                vals = vals[mask]
+            values.append(vals.astype(np.int64))
+        if len(values)==0 or len(values[0])==0:
+            return {}
+        shape = tuple(int(v.max()) + 1 for v in values)
+        counts = np.bincount(np.ravel_multi_index(values, shape), minlength=int(np.prod(shape)))
+        result = {}
+        for flat in np.flatnonzero(counts):
+            key = []
+            for name, idx in zip(columns, np.unravel_index(flat, shape)):
+                dim = dimension(name) if isinstance(name, basestring) else None
+                key.append(self.dims[dim][idx] if dim is not None else int(idx))
+            result[tuple(key)] = int(counts[flat])
+        return result
+
+
+def dimension(column):
+    """
+    Name of the dimension a column is coded against, or None for plain numeric columns
+    """
+    if column in CELL_CODES:
+        return CELL_CODES[column]
+    return RECORD_CODES.get(column)
+
+
+def convert(results_path, store_path, batch_size=CONVERT_BATCH):
+    """
+    Convert a json results file into a columnar store, saving a part every batch_size records
+    """
+    writer = ColumnarWriter(store_path)
+    with open(results_path) as fh:
+        for line in fh:
+            if line.startswith("#metrics"):
+                writer.metrics.append(line)
+            elif len(line.strip())>0 and line[0] != '#':
+                writer.add_record(json.loads(line))
+                if len(writer.records["variant"]) >= batch_size:
+                    writer.flush()
+    writer.close()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Convert json varcomp results to a columnar store")
+    parser.add_argument("results", help="Json results file", nargs="?")
+    parser.add_argument("store", help="Destination directory")
+    parser.add_argument("--finish", help="Join the parts of an unfinished store (e.g. left by a crashed run) instead of converting", action='store_true')
+    args = parser.parse_args()
+
+    if args.finish:
+        if args.results is not None:
+            parser.error("--finish takes only the store directory")
+        if read_parts(args.store) is None:
+            parser.error(args.store + " is not an unfinished columnar store")
+        finish(args.store)
+    else:
+        if args.results is None:
+            parser.error("the results file is required")
+        convert(args.results, args.store)
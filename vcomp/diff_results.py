@@ -0,0 +1,184 @@
+"""
+Compare the results of two runs cell by cell. Each source (json results, a columnar store directory or a SQLite
+database, see columnar.py and sqlstore.py) is turned into a stream of (variant, scenario, caller, normalizer,
+comparator, result) cells sorted by key. Cells are sorted in memory a chunk at a time and the sorted chunks merged
+from temporary files, so memory use is bounded by the chunk size no matter how large the inputs are. The two
+streams are then merge joined:
+
+    python vcomp/diff_results.py old_output.txt new_output.txt > diff.txt
+
+Every cell whose result changed is written as a tab delimited line (cells present in only one of the sources are
+included with --missing), followed by '##' lines counting the transitions between results (including unchanged
+ones, and '.' for missing cells) for every caller and variant type.
+"""
+
+import argparse
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+
+import parse_results_json
+
+MISSING = "."
+
+#Number of cells sorted in memory at a time
+DEFAULT_CHUNK_SIZE = 1000000
+
+#Number of cells of a columnar store decoded at a time
+COLUMNAR_BLOCK = 100000
+
+
+def text(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def is_sqlite(path):
+    with open(path, "rb") as fh:
+        return fh.read(16) == "SQLite format 3\x00"
+
+
+def source_cells(path):
+    """
+    Generate (variant, scenario, caller, normalizer, comparator, result) tuples of strings from a results source
+    """
+    if os.path.isdir(path):
+        import columnar
+        store = columnar.ColumnarStore(path)
+        records = store.column("cells", "record")
+        variants = store.column("records", "variant")
+        scenarios = store.column("records", "scenario")
+        columns = [store.column("cells", name) for name in ("caller", "normalizer", "comparator", "result")]
+        names = [[text(v) for v in store.dims[name]] for name in ("variant", "scenario", "caller", "normalizer", "comparator", "result")]
+        #Decode a block of cells at a time, the columns themselves stay memory mapped
+        for start in xrange(0, len(records), COLUMNAR_BLOCK):
+            block = np.asarray(records[start:start + COLUMNAR_BLOCK])
+            codes = zip(variants[block].tolist(), scenarios[block].tolist(), *[col[start:start + COLUMNAR_BLOCK].tolist() for col in columns])
+            for cell in codes:
+                yield tuple(dim[code] for dim, code in zip(names, cell))
+    elif is_sqlite(path):
+        import sqlstore
+        conn = sqlstore.connect(path)
+        for row in sqlstore.select(conn):
+            yield tuple(text(v) for v in row[0:6])
+        conn.close()
+    else:
+        for results in parse_results_json.read_results(path):
+            variant = text(results[parse_results_json.VARIANT])
+            scenario = text(results.get("scenario"))
+            for caller, caller_results in results[parse_results_json.RESULTS].iteritems():
+                for normalizer, norm_results in caller_results.iteritems():
+                    for comparator, result in norm_results.iteritems():
+                        yield (variant, scenario, text(caller), text(normalizer), text(comparator), text(result))
+
+
+def write_run(cells, tmpdir):
+    fd, path = tempfile.mkstemp(dir=tmpdir, suffix=".run")
+    with os.fdopen(fd, "w") as fh:
+        for cell in cells:
+            fh.write("\t".join(cell) + "\n")
+    return path
+
+
+def read_run(path):
+    with open(path) as fh:
+        for line in fh:
+            yield tuple(line.rstrip("\n").split("\t"))
+
+
+def sorted_cells(path, tmpdir, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generate the cells of a source in key order, sorting chunks of at most chunk_size cells in memory and merging
+    the sorted chunks from files in tmpdir
+    """
+    runs = []
+    chunk = []
+    for cell in source_cells(path):
+        chunk.append(cell)
+        if len(chunk) >= chunk_size:
+            chunk.sort()
+            runs.append(write_run(chunk, tmpdir))
+            chunk = []
+    chunk.sort()
+    if len(runs)==0:
+        return iter(chunk)
+    if len(chunk)>0:
+        runs.append(write_run(chunk, tmpdir))
+    return heapq.merge(*[read_run(run) for run in runs])
+
+
+def join(cells1, cells2):
+    """
+    Merge join two key sorted cell streams. If a source has several cells with the same key the first one is used
+    :return: Generator of (key, result1, result2) tuples, with MISSING for cells absent from one of the streams
+    """
+    end = object()
+    cell1 = next(cells1, end)
+    cell2 = next(cells2, end)
+    while cell1 is not end or cell2 is not end:
+        key1 = cell1[0:5] if cell1 is not end else None
+        key2 = cell2[0:5] if cell2 is not end else None
+        if cell2 is end or (cell1 is not end and key1 < key2):
+            yield key1, cell1[5], MISSING
+            key = key1
+        elif cell1 is end or key2 < key1:
+            yield key2, MISSING, cell2[5]
+            key = key2
+        else:
+            yield key1, cell1[5], cell2[5]
+            key = key1
+        while cell1 is not end and cell1[0:5] == key:
+            cell1 = next(cells1, end)
+        while cell2 is not end and cell2[0:5] == key:
+            cell2 = next(cells2, end)
+
+
+def diff(path1, path2, output, include_missing=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write every changed cell and the result transition counts for every caller and variant type to output
+    :return: Dict of (caller, variant type) -> (result1, result2) -> count
+    """
+    tmpdir = tempfile.mkdtemp(prefix="diff-results-")
+    transitions = defaultdict(lambda: defaultdict(int))
+    try:
+        output.write("#" + "\t".join(["variant", "scenario", "caller", "normalizer", "comparator", "result1", "result2"]) + "\n")
+        variant, vartype = None, None
+        for key, result1, result2 in join(sorted_cells(path1, tmpdir, chunk_size), sorted_cells(path2, tmpdir, chunk_size)):
+            if key[0] != variant:
+                variant = key[0]
+                vartype = parse_results_json.get_vartype(variant)
+            transitions[(key[2], vartype)][(result1, result2)] += 1
+            if result1 != result2 and (include_missing or (result1 != MISSING and result2 != MISSING)):
+                output.write("\t".join(key + (result1, result2)) + "\n")
+
+        output.write("##" + "\t".join(["caller", "vartype", "result1", "result2", "count"]) + "\n")
+        for caller, vartype in sorted(transitions):
+            for (result1, result2), count in sorted(transitions[(caller, vartype)].iteritems()):
+                output.write("##" + "\t".join([caller, vartype, result1, result2, str(count)]) + "\n")
+    finally:
+        shutil.rmtree(tmpdir)
+    return transitions
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Compare the results of two runs cell by cell")
+    parser.add_argument("results1", help="First results (json file, columnar store directory or SQLite database)")
+    parser.add_argument("results2", help="Second results (json file, columnar store directory or SQLite database)")
+    parser.add_argument("-o", "--output", help="Output destination", default=sys.stdout)
+    parser.add_argument("--missing", help="Also list cells present in only one of the results", action='store_true')
+    parser.add_argument("--chunk-size", help="Number of cells to sort in memory at a time (default " + str(DEFAULT_CHUNK_SIZE) + ")", default=DEFAULT_CHUNK_SIZE, type=int)
+    args = parser.parse_args()
+
+    output = args.output
+    if type(output) is str:
+        output = open(output, "w")
+    diff(args.results1, args.results2, output, include_missing=args.missing, chunk_size=args.chunk_size)
+    output.close()
@@ -0,0 +1,109 @@
+"""
+Window geometry for simulated variants. The amount of reference sequence needed around a variant (or a set of
+variants simulated together) depends on how far simulated reads can reach from the point they're centered on, and
+on how much sequence the variants themselves cover. A WindowGeometry derives all the window sizes used throughout
+varcomp from those two quantities:
+
+    reach - how far from the simulation center a read can extend, from the template size distribution and the
+            spread of template midpoints used by the read simulator
+    flank - reference bases on each side of a variant set that are affected by its simulation: its reads, its
+            alternate genome and its BED region all lie within [start - flank, end + flank]
+    safe distance - two variant sets can be simulated in the same batch if their spans are at least this far apart,
+            which is just the sum of their flanks
+
+so SNPs can be packed densely while large events get as much flanking sequence as they need.
+"""
+
+from collections import namedtuple
+
+Span = namedtuple('Span', ['chrom', 'start', 'end'])
+
+
+class WindowGeometry(object):
+
+    def __init__(self, mean_template_size=250, stdev_template_size=50, pos_stdev=50, read_len=100, margin=50, min_flank=0, sds=4):
+        """
+        :param mean_template_size: Mean size in bp of simulated templates
+        :param stdev_template_size: Stdev of template size
+        :param pos_stdev: Stdev of template midpoints around the simulation center
+        :param read_len: Read length
+        :param margin: Extra bases added to every flank
+        :param min_flank: Smallest flank ever used
+        :param sds: Number of standard deviations of template size and position to allow for
+        """
+        self.mean_template_size = mean_template_size
+        self.stdev_template_size = stdev_template_size
+        self.pos_stdev = pos_stdev
+        self.read_len = read_len
+        self.margin = margin
+        self.min_flank = min_flank
+        self.sds = sds
+
+    def max_template_size(self):
+        return self.mean_template_size + self.sds * self.stdev_template_size
+
+    def reach(self):
+        """
+        Maximum distance from the simulation center covered by a simulated read
+        """
+        return self.sds * self.pos_stdev + self.max_template_size() / 2
+
+    def flank(self, span_len=1):
+        """
+        Number of bases on either side of a variant set spanning span_len reference bases that may be touched by its
+        simulation. The span is added in full since deletions shift reads away from the simulation center by up to
+        their length
+        """
+        return max(self.min_flank, self.reach() + span_len + self.margin)
+
+    def window_size(self, span_len=1):
+        """
+        Number of reference bases to build an alternate genome from
+        """
+        return 2 * self.flank(span_len)
+
+    def bed_region(self, span):
+        """
+        Region in which reads from a variant set align and in which callers should look for variants
+        :param span: Span of the variant set
+        :return: Span object
+        """
+        return Span(span.chrom, max(0, span.start - self.reach()), span.end + self.reach())
+
+    def safe_distance(self, span1, span2):
+        """
+        Minimum number of bases required between two variant set spans for them to be simulated together
+        """
+        return self.flank(span_len(span1)) + self.flank(span_len(span2))
+
+    def compatible(self, span1, span2):
+        """
+        True if two variant set spans are far enough apart (or on different contigs) to be simulated together
+        """
+        if span1.chrom != span2.chrom:
+            return True
+        gap = max(span1.start, span2.start) - min(span1.end, span2.end)
+        return gap >= self.safe_distance(span1, span2)
+
+
+DEFAULT_GEOMETRY = WindowGeometry()
+
+
+def span_len(span):
+    return max(1, span.end - span.start)
+
+
+def var_span(var, upstream=0):
+    """
+    Span of reference bases covered by a single variant (util.Variant or pysam variant record)
+    :param upstream: Extend the span this many bases to the left, for example to cover extra SNPs that will be added
+    """
+    return Span(var.chrom, max(0, var.start - upstream), var.start + max(1, len(var.ref)))
+
+
+def set_span(vars):
+    """
+    Span of reference bases covered by a list of variants on the same contig
+    """
+    spans = [var_span(var) for var in vars]
+    return Span(spans[0].chrom, min(s.start for s in spans), max(s.end for s in spans))
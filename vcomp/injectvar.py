@@ -8,18 +8,38 @@ from collections import namedtuple
 import random
 import argparse
 import imp
+import importlib
 import util
+import memo
+import sharding
+import columnar
+import sqlstore
+import resources
+import result_types
 from sim import bam_simulation
 import batch_processor as bp
-from plugins import core_callers,\
-    normalizers as core_norms, \
-    comparators as core_comps
 
 
-all_result_types = (bp.MATCH_RESULT, bp.NO_MATCH_RESULT, bp.NO_VARS_FOUND_RESULT, bp.MATCH_WITH_EXTRA_RESULT, bp.ZYGOSITY_MISSING_ALLELE, bp.ZYGOSITY_EXTRA_ALLELE, bp.ERROR_RESULT)
+all_result_types = result_types.ALL_RESULT_TYPES
+
+#Built-in plugin module of each kind of component and the function listing its components. Modules are imported
+#when components of their kind are first needed
+CORE_PLUGINS = {
+    'callers': ('core_callers', 'get_callers'),
+    'normalizers': ('normalizers', 'get_normalizers'),
+    'comparators': ('comparators', 'get_comparators'),
+}
 
 ExSNPInfo = namedtuple('ExSNPInfo', ['policy', 'dist'])
 
+#Scenarios that can be simulated together with --scenarios, each becomes a separate sample in a single bam
+SCENARIOS = {
+    "het": bp.Scenario("het", bam_simulation.ALL_HETS, None),
+    "hom": bp.Scenario("hom", bam_simulation.ALL_HOMS, None),
+    "cis": bp.Scenario("cis", bam_simulation.ALL_HETS, ExSNPInfo(policy=bam_simulation.CIS, dist=-4)),
+    "trans": bp.Scenario("trans", bam_simulation.ALL_HETS, ExSNPInfo(policy=bam_simulation.TRANS, dist=-4)),
+}
+
 
 class JsonReporter(object):
     """
@@ -29,23 +49,36 @@ class JsonReporter(object):
     def __init__(self, outputfile=sys.stdout):
         self.output = outputfile
 
-    def write_output(self, results, quals, bamstats):
+    def write_output(self, results, quals, bamstats, scenario=None):
         """
         Write output for a batch of input variants (with individual entries for each caller/normalizer/comparator
           combination) to the given output handle.
         :param results: Four-level deep dict containing [input variant string][caller][normalizer][comparator]
         :param bamstats: Dictionary containing statistics for bam file
         :param output: File-like object to which formatted output will be written
+        :param scenario: Name of the simulated scenario the results are for, if any
         """
         for var, vresults in results.iteritems():
-            json.dump({
+            record = {
                 "variant":var,
                 "caller_quals": quals[var],
                 "bamstats": bamstats[var],
                 "results": vresults
-            }, self.output)
+            }
+            if scenario is not None:
+                record["scenario"] = scenario
+            json.dump(record, self.output)
             self.output.write("\n")
 
+    def write_metrics(self, batchname, metrics):
+        """
+        Write the resource usage of every external tool run for a batch as a single comment line, so parsers of
+        the per-variant results skip it
+        :param batchname: Name of the batch
+        :param metrics: List of runner.ToolMetrics
+        """
+        self.output.write("#metrics " + json.dumps({"batch": batchname, "tools": [m._asdict() for m in metrics]}) + "\n")
+
 def gen_reads(vcf, dest_vcf, dest_fq_prefix, ex_snp, gt_policy, read_depth, conf):
     """
     Generate fastqs for the given set of input variants. This code is fired when the user supplies the --generate-fqs
@@ -60,11 +93,13 @@ def gen_reads(vcf, dest_vcf, dest_fq_prefix, ex_snp, gt_policy, read_depth, conf
     """
 
     #First, make sure there aren't variants that are too close to process independently...
-    batches = util.batch_variants(vcf, max_batch_size=1e9)
-    if len(list(batches))>1:
-        raise ValueError('The VCF file ' + vcf + ' contains variants that are too close to include in a single set of fastqs, please ensure no two variants are within 2kb of each other')
+    batches = util.batch_variants(vcf, max_batch_size=1e9, upstream=extra_snp_distance(ex_snp), cluster=ex_snp is None)
+    for batch_vcf in batches:
+        os.remove(batch_vcf)
+    if len(batches)>1:
+        raise ValueError('The VCF file ' + vcf + ' contains variants that are too close to include in a single set of fastqs, please ensure variants are far enough apart that their simulated reads do not overlap')
     vars = list(pysam.VariantFile(vcf))
-    variant_sets = bp.create_variant_sets(vars, ex_snp, gt_policy, pysam.FastaFile( conf.get('main', 'ref_genome')))
+    variant_sets = bp.create_variant_sets(vars, ex_snp, gt_policy, util.get_fasta(conf.get('main', 'ref_genome')))
     allvars = []
     for vset in variant_sets:
         allvars.extend(vset['vars'])
@@ -76,7 +111,45 @@ def gen_reads(vcf, dest_vcf, dest_fq_prefix, ex_snp, gt_policy, read_depth, conf
 
 
 
-def load_components(conf, section, callable_name):
+def parse_scenarios(names):
+    """
+    Look up scenarios by name, given as a list of (possibly comma separated) strings
+    :return: List of Scenarios
+    """
+    scenarios = []
+    for name in [n.strip() for item in names for n in item.split(",") if n.strip()]:
+        if name not in SCENARIOS:
+            raise KeyError('Unknown scenario ' + name + ', choose from ' + ", ".join(sorted(SCENARIOS)))
+        scenarios.append(SCENARIOS[name])
+    return scenarios
+
+def extra_snp_distance(snp_info):
+    """
+    Number of bases upstream of each input variant that extra SNPs (if any) will be added at
+    """
+    if snp_info is None:
+        return 0
+    return abs(snp_info.dist)
+
+def core_plugin(section):
+    """
+    Import the built-in plugin module for a kind of component (e.g. 'callers')
+    """
+    return importlib.import_module("plugins." + CORE_PLUGINS[section][0])
+
+def is_core_plugin(mod_path):
+    """
+    True if a plugin module path from the configuration refers to one of the built-in plugin modules, which are
+    always loaded and must not be loaded again. Paths that don't exist are compared by name, since configurations
+    written for other installations (e.g. the docker image) list the built-in modules under their own paths
+    """
+    plugin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+    core_files = [module + ".py" for module, _ in CORE_PLUGINS.values()]
+    if os.path.exists(mod_path):
+        return os.path.realpath(mod_path) in [os.path.realpath(os.path.join(plugin_dir, f)) for f in core_files]
+    return os.path.basename(os.path.dirname(mod_path)) == "plugins" and os.path.basename(mod_path) in core_files
+
+def load_components(conf, section, callable_name, wanted=None):
     """
     Create a dict of string -> callables by examining the configuration object, loading any modules
     defined in the given section, and then calling the 'callable_name' function in the module. That function should
@@ -84,11 +157,17 @@ def load_components(conf, section, callable_name):
     :param conf:  Configuration object
     :param section:  Section to examine in configuration (e.g. 'callers')
     :param callable_name: Name of callable to execute to get new components (e.g. 'get_callers')
+    :param wanted: Optional collection of component names, if given modules are only loaded until all of them
+    have been found
     :return: Dict containing loaded components, mapping string -> callable
     """
     components = {}
+    if not conf.has_section(section):
+        return components
 
     for item in conf.items(section):
+        if wanted is not None and all(name in components for name in wanted):
+            break
         try:
 
             if not os.path.isabs(item[1]):
@@ -96,8 +175,14 @@ def load_components(conf, section, callable_name):
                 mod_path = os.path.split( pdir )[0] + "/" + item[1]
             else:
                 mod_path = item[1]
+            if is_core_plugin(mod_path):
+                logging.info("Skipping built-in plugin module " + mod_path)
+                continue
             logging.info("Loading plugins from module " + mod_path)
-            mod = imp.load_source(item[0], mod_path)
+            try:
+                mod = imp.load_source(item[0], mod_path)
+            except IOError as e:
+                raise ImportError(str(e))
             if not callable_name in dir(mod):
                 raise ImportError('Module ' + item[1] + ' does not define a function called ' + callable_name)
             result = mod.__dict__[callable_name]()
@@ -109,30 +194,104 @@ def load_components(conf, section, callable_name):
 
     return components
 
-def process_vcf(vcf, gt_default, conf, output, callers, fqs=None, snp_info=None, single_batch=False, keep_tmpdir=False, read_depth=250):
+def select_components(conf, section, selected=None):
+    """
+    Collect the components of one kind (callers, normalizers or comparators): the core components, plus those from
+    plugin modules listed in the given configuration section. If only some components are selected, plugin
+    modules are loaded only as far as needed to find them
+    :param section: Kind of component, one of the keys of CORE_PLUGINS
+    :param selected: List of names of components to use, or None to use all of them
+    :return: Dict containing selected components, mapping string -> callable
+    """
+    callable_name = CORE_PLUGINS[section][1]
+    components = dict(getattr(core_plugin(section), callable_name)())
+    if selected is None or len(selected)==0:
+        components.update(load_components(conf, section, callable_name))
+        return components
+
+    missing = [name for name in selected if name not in components]
+    if len(missing)>0:
+        components.update(load_components(conf, section, callable_name, wanted=missing))
+    return choose_components(components, selected, section)
+
+def choose_components(components, selected, section):
+    """
+    Pick the selected components out of a dict of already loaded ones
+    :param components: Dict mapping string -> callable
+    :param selected: List of names of components to use, or None to use all of them
+    :param section: Kind of component (e.g. 'callers'), for error messages
+    :return: Dict containing selected components
+    """
+    if selected is None or len(selected)==0:
+        return dict(components)
+    chosen = {}
+    for name in selected:
+        if name not in components:
+            raise KeyError('No component ' + name + ' found in ' + section)
+        chosen[name] = components[name]
+    return chosen
+
+def load_all_components(conf):
+    """
+    Load every core and configured caller, normalizer and comparator
+    :return: Tuple of dicts of callers, normalizers, comparators
+    """
+    return (select_components(conf, 'callers'),
+            select_components(conf, 'normalizers'),
+            select_components(conf, 'comparators'))
+
+def split_names(values):
+    """
+    Flatten a list of (possibly comma separated) command line values into a list of names, or None if no
+    values were given
+    """
+    if values is None:
+        return None
+    return [name.strip() for value in values for name in value.split(",") if name.strip()]
+
+def process_vcf(vcf, gt_default, conf, output, callers, fqs=None, snp_info=None, single_batch=False, keep_tmpdir=False, read_depth=250, memoize=True, fast_path=False, audit_fraction=0.0, shards=1, scenarios=None, normalizers=None, comparators=None, components=None, cache=None, reporter=None):
     """
     Perform analyses for each variant in the VCF file.
     :param input_vcf: Path to vcf file containing variants to process
+    :param callers: Names of variant callers to run (default: all)
+    :param normalizers: Names of normalizers to run (default: all)
+    :param comparators: Names of comparators to run (default: all)
     :param single_batch: Assume all variants in VCF are part of one batch and process them all simultaneously
     :param keep_tmpdir: Preserve tmpdirs created (otherwise delete them, unless they are flagged)
     :param conf: Configuration object
+    :param memoize: Reuse normalizer / comparator results for inputs with identical content
+    :param fast_path: Skip normalizers / comparators for regions where the raw comparator finds an exact match
+    :param audit_fraction: Fraction of fast path regions to compare anyway, to verify agreement
+    :param shards: Split the regions of each batch into this many shards and run every caller on them in parallel
+    :param scenarios: Optional list of Scenarios to simulate together as separate samples (instead of gt_default
+    and snp_info)
+    :param components: Optional tuple of already loaded callers, normalizers and comparators (as returned by
+    load_all_components) to select from, instead of loading plugins
+    :param cache: Optional memo.InvocationCache to use when memoizing, for instance one shared across calls
+    :param reporter: Optional output reporter to use instead of a JsonReporter writing to output
     """
 
-    variant_callers = core_callers.get_callers()
-    #variant_callers.update(load_components(conf, 'callers', 'get_callers'))
+    if components is None:
+        variant_callers = select_components(conf, 'callers', callers)
+        normalizers = select_components(conf, 'normalizers', normalizers)
+        comparators = select_components(conf, 'comparators', comparators)
+    else:
+        variant_callers = choose_components(components[0], callers, 'callers')
+        normalizers = choose_components(components[1], normalizers, 'normalizers')
+        comparators = choose_components(components[2], comparators, 'comparators')
+    logging.info("Using callers: " + ", ".join(sorted(variant_callers)) + "; normalizers: " + ", ".join(sorted(normalizers)) + "; comparators: " + ", ".join(sorted(comparators)))
+
+    versions = memo.tool_versions(variant_callers, normalizers, comparators)
 
-    normalizers = core_norms.get_normalizers()
-    #normalizers.update(load_components(conf, 'normalizers', 'get_normalizers'))
-    comparators = core_comps.get_comparators()
-    #comparators.update(load_components(conf, 'comparators', 'get_comparators'))
+    #Scheduling wraps the plain plugin functions, so that each shard of a sharded caller holds its own reservation
+    scheduler = resources.scheduler_from_conf(conf)
+    if scheduler is not None:
+        variant_callers = scheduler.wrap_all(variant_callers)
+        normalizers = scheduler.wrap_all(normalizers)
+        comparators = scheduler.wrap_all(comparators)
 
-    if callers is not None and len(callers)>0:
-        callers_to_use = {}
-        for caller in callers:
-            if caller not in variant_callers:
-                raise KeyError('No variant caller ' + caller + ' found in callers')
-            callers_to_use[caller] = variant_callers[caller]
-        variant_callers = callers_to_use
+    if shards > 1:
+        variant_callers = dict((name, sharding.ShardedCaller(caller, shards)) for name, caller in variant_callers.iteritems())
 
     if fqs is not None:
         nfq = []
@@ -140,34 +299,32 @@ def process_vcf(vcf, gt_default, conf, output, callers, fqs=None, snp_info=None,
             nfq.append( os.path.abspath(fq))
         fqs = nfq
 
-    processor = bp.VariantProcessor(variant_callers, normalizers, comparators, JsonReporter(output))
+    if not memoize:
+        cache = None
+    elif cache is None:
+        cache = memo.InvocationCache()
+    if reporter is None:
+        reporter = JsonReporter(output)
+    processor = bp.VariantProcessor(variant_callers, normalizers, comparators, reporter, cache=cache, exact_comparator=core_plugin('comparators').compare_raw, scheduler=scheduler, versions=versions)
     logging.info("Processing variants in file " + vcf)
     if single_batch:
         logging.info("Processing all variants as one batch")
-        processor.process_batch(vcf, vcf.replace(".vcf", "-tmpfiles"), conf, gt_default, ex_snp=snp_info, keep_tmpdir=keep_tmpdir, read_depth=read_depth, reads=fqs)
+        processor.process_batch(vcf, vcf.replace(".vcf", "-tmpfiles"), conf, gt_default, ex_snp=snp_info, keep_tmpdir=keep_tmpdir, read_depth=read_depth, reads=fqs, fast_path=fast_path, audit_fraction=audit_fraction, scenarios=scenarios)
     else:
-        batches = util.batch_variants(vcf, max_batch_size=1000, min_safe_dist=2000)
+        snp_infos = [s.snp_info for s in scenarios] if scenarios else [snp_info]
+        upstream = max(extra_snp_distance(info) for info in snp_infos)
+        batches = util.batch_variants(vcf, max_batch_size=1000, upstream=upstream, cluster=all(info is None for info in snp_infos))
         for batchnum, batch_vcf in enumerate(batches):
             logging.info("Processing batch #" + str(batchnum+1) + " of " + str(len(batches)))
-            processor.process_batch(batch_vcf, vcf.replace(".vcf", "-tmpfiles"), conf, gt_default, ex_snp=snp_info, keep_tmpdir=keep_tmpdir, read_depth=read_depth, reads=fqs)
+            processor.process_batch(batch_vcf, vcf.replace(".vcf", "-tmpfiles"), conf, gt_default, ex_snp=snp_info, keep_tmpdir=keep_tmpdir, read_depth=read_depth, reads=fqs, fast_path=fast_path, audit_fraction=audit_fraction, scenarios=scenarios)
             os.remove(batch_vcf)
 
 
-def main(args):
+def simulation_options(args):
     """
-    Respond to command line args, check for basic config errors, and perform analyses
-    :param args:
-    :return:
+    Work out how variants should be simulated from the command line args
+    :return: Tuple of genotype policy, extra SNP info (or None) and list of scenarios (or None)
     """
-    conf = cp.SafeConfigParser()
-    conf.read(args.conf)
-
-    if type(args.output) is str:
-        args.output = open(args.output, "w")
-
-    if args.seed is not None:
-        random.seed(args.seed)
-
     if args.het and args.hom:
         raise ValueError('Specify just one of --het or --hom')
 
@@ -187,30 +344,69 @@ def main(args):
             snp_policy = bam_simulation.ALL_HOMS
         snp_inf = ExSNPInfo(policy=snp_policy, dist=-4)
 
-    if args.generate_fqs:
-        if len(args.vcf)>1:
-            raise ValueError('Only one VCF supported for now')
-        vcf = args.vcf[0]
-        fastq_prefix = vcf.strip(".gz").strip(".vcf")
-        logging.info("Generating reads for vcf file " + vcf)
-        gen_reads(vcf, vcf.strip(".gz").strip(".vcf") + "_final.vcf", fastq_prefix, snp_inf, gt_default, args.readdepth, conf)
-        exit(0)
+    scenarios = None
+    if args.scenarios:
+        if args.het or args.hom or args.addsnp:
+            raise ValueError('--scenarios can not be combined with --het, --hom or --addsnp')
+        if args.fqs or args.generate_fqs:
+            raise ValueError('--scenarios can not be used with existing or generated fastqs')
+        scenarios = parse_scenarios(args.scenarios)
+
+    return gt_default, snp_inf, scenarios
+
+def main(args):
+    """
+    Respond to command line args, check for basic config errors, and perform analyses
+    :param args:
+    :return:
+    """
+    conf = cp.SafeConfigParser()
+    conf.read(args.conf)
+
+    if type(args.output) is str:
+        args.output = open(args.output, "w")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    gt_default, snp_inf, scenarios = simulation_options(args)
 
+    if args.columnar and args.sqlite:
+        raise ValueError('Specify just one of --columnar or --sqlite')
 
-    for vcf in args.vcf:
-        logging.info("Processing vcf file " + vcf)
-        process_vcf(vcf, gt_default, conf, args.output, args.callers, fqs=args.fqs, snp_info=snp_inf, single_batch=args.batch, keep_tmpdir=args.keep, read_depth=args.readdepth)
+    reporter = None
+    if args.columnar:
+        reporter = columnar.ColumnarReporter(os.path.abspath(args.columnar))
+    elif args.sqlite:
+        reporter = sqlstore.SqliteReporter(os.path.abspath(args.sqlite))
+
+    try:
+        if args.generate_fqs:
+            if len(args.vcf)>1:
+                raise ValueError('Only one VCF supported for now')
+            vcf = args.vcf[0]
+            fastq_prefix = vcf.strip(".gz").strip(".vcf")
+            logging.info("Generating reads for vcf file " + vcf)
+            gen_reads(vcf, vcf.strip(".gz").strip(".vcf") + "_final.vcf", fastq_prefix, snp_inf, gt_default, args.readdepth, conf)
+            exit(0)
+
+
+        for vcf in args.vcf:
+            logging.info("Processing vcf file " + vcf)
+            process_vcf(vcf, gt_default, conf, args.output, split_names(args.callers), normalizers=split_names(args.normalizers), comparators=split_names(args.comparators), fqs=args.fqs, snp_info=snp_inf, single_batch=args.batch, keep_tmpdir=args.keep, read_depth=args.readdepth, memoize=not args.no_memo, fast_path=args.fast_path, audit_fraction=args.audit_fraction, shards=args.shards, scenarios=scenarios, reporter=reporter)
+    finally:
+        if reporter is not None:
+            reporter.close()
 
     try:
         args.output.close()
     except:
         pass
 
-if __name__=="__main__":
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s - %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
-
+def make_parser():
+    """
+    Build the command line parser (also used to interpret jobs submitted to the service, see service.py)
+    """
     parser = argparse.ArgumentParser("Inject, simulate, call, compare")
     parser.add_argument("-c", "--conf", help="Path to configuration file", default="./comp.conf")
     parser.add_argument("-v", "--vcf", help="Input vcf file(s)", nargs="+")
@@ -225,8 +421,24 @@ if __name__=="__main__":
     parser.add_argument("--het", help="Force all simulated variants to be hets", action='store_true')
     parser.add_argument("--hom", help="Force all simulated variants to be homozygotes", action='store_true')
     parser.add_argument("--callers", help="Comma separated list of variant callers to use (default: use all)", action='append')
+    parser.add_argument("--normalizers", help="Comma separated list of normalizers to use (default: use all)", action='append')
+    parser.add_argument("--comparators", help="Comma separated list of comparators to use (default: use all)", action='append')
     parser.add_argument("--fqs", help="Dont generate fastqs, use these instead (two entries expected)", action='append')
+    parser.add_argument("--no-memo", help="Dont reuse normalizer / comparator results for identical inputs", action='store_true')
+    parser.add_argument("--fast-path", help="Record regions where raw caller output matches the input exactly as matches without running normalizers / comparators on them", action='store_true')
+    parser.add_argument("--audit-fraction", help="With --fast-path, fraction of exactly matching regions to compare anyway (default 0.05)", default=0.05, type=float)
+    parser.add_argument("--shards", help="Run each caller on this many shards of the batch regions in parallel (default 1)", default=1, type=int)
+    parser.add_argument("--scenarios", help="Comma separated list of scenarios (" + ", ".join(sorted(SCENARIOS)) + ") to simulate as separate samples of one bam, so each caller runs once for all of them", action='append')
+    parser.add_argument("--columnar", help="Write results to a columnar store in this directory (see columnar.py) instead of json to the output")
+    parser.add_argument("--sqlite", help="Insert results into this SQLite database (see sqlstore.py) instead of writing json to the output")
     parser.add_argument("--generate-fqs", help="Generate fastqs only, do not perform any variant calling or comparison", action='store_true')
-    args = parser.parse_args()
+    return parser
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    args = make_parser().parse_args()
 
     main(args)
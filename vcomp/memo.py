@@ -0,0 +1,143 @@
+"""
+Memoization of normalizer and comparator invocations, keyed by the content of the vcfs (and bed files) they are
+given. Lots of the work done in a batch is redundant - many callers report nothing at all, or exactly the same
+variants, and each of those produces byte-identical inputs for the normalizers and comparators. An
+InvocationCache answers these repeated calls from memory.
+"""
+
+import gzip
+import hashlib
+import inspect
+import logging
+import os
+from collections import OrderedDict
+
+import util
+
+
+class InvocationCache(object):
+    """
+    Caches normalizer output files and comparator result tuples. Keys are built from the name of the tool and
+    digests of the variant records in the input files, so header differences (command lines, dates, etc) don't
+    prevent a hit. A single cache may be shared across batches of the same run.
+    """
+
+    def __init__(self, max_results=20000):
+        """
+        :param max_results: Maximum number of comparator results to hold, oldest entries are dropped first
+        """
+        self.digests = {}
+        self.normalized = {}
+        self.compared = OrderedDict()
+        self.max_results = max_results
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, path):
+        """
+        Compute a digest of the non-header lines of the given file (vcf or bed, possibly gzipped). Digests
+        are remembered by absolute path, size and modification time so each file is read only once
+        :param path: Path to file, or None
+        :return: Hex digest string, or None if path is None
+        """
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        fkey = (path, st.st_size, st.st_mtime)
+        if fkey not in self.digests:
+            sha = hashlib.sha1()
+            if path.endswith(".gz"):
+                fh = gzip.open(path)
+            else:
+                fh = open(path)
+            for line in fh:
+                if len(line)>0 and line[0] != '#':
+                    sha.update(line)
+            fh.close()
+            self.digests[fkey] = sha.hexdigest()
+        return self.digests[fkey]
+
+    def normalizer(self, name, normalizer):
+        """
+        Wrap the given normalizer so that repeated calls on vcfs with identical content return the file produced
+        by the first call. Identity normalizers are returned unchanged since they don't do any work anyway
+        :param name: Name of the normalizer
+        :param normalizer: Normalizer function
+        :return: Function with the same signature as normalizer
+        """
+        if util.is_identity_normalizer(normalizer):
+            return normalizer
+        tool = tool_identity(name, normalizer)
+
+        def memoized(orig_vcf, conf):
+            key = (tool, self.digest(orig_vcf))
+            cached = self.normalized.get(key)
+            #Cached files are removed along with the tmpdir of the batch that created them
+            if cached is not None and os.path.exists(cached):
+                self.hits += 1
+                return cached
+            self.misses += 1
+            result = normalizer(orig_vcf, conf)
+            self.normalized[key] = os.path.abspath(result)
+            return result
+
+        return memoized
+
+    def comparator(self, name, comparator):
+        """
+        Wrap the given comparator so that repeated calls with identical truth, caller and bed inputs return the
+        result tuple computed by the first call
+        :param name: Name of the comparator
+        :param comparator: Comparator function
+        :return: Function with the same signature as comparator
+        """
+        tool = tool_identity(name, comparator)
+
+        def memoized(orig_vcf, caller_vcf, bed, conf):
+            key = (tool, self.digest(orig_vcf), self.digest(caller_vcf), self.digest(bed))
+            if key in self.compared:
+                self.hits += 1
+                return self.compared[key]
+            self.misses += 1
+            result = comparator(orig_vcf, caller_vcf, bed, conf)
+            self.compared[key] = result
+            if len(self.compared) > self.max_results:
+                self.compared.popitem(last=False)
+            return result
+
+        return memoized
+
+    def log_stats(self):
+        logging.info("Invocation cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses")
+
+
+def tool_identity(name, func):
+    """
+    Return a string identifying a tool by both its registered name and the function that implements it
+    """
+    return name + ":" + getattr(func, '__module__', '?') + "." + getattr(func, '__name__', '?')
+
+
+def tool_version(func):
+    """
+    Return a digest of the source code of the function implementing a tool, so that results computed by an older
+    version of it can be recognized (see resume.py). Only the function itself is covered, not what it calls
+    """
+    try:
+        source = inspect.getsource(func)
+    except (IOError, TypeError):
+        source = getattr(func, '__module__', '?') + "." + getattr(func, '__name__', '?')
+    return hashlib.sha1(source).hexdigest()[0:12]
+
+
+def tool_versions(callers, normalizers, comparators):
+    """
+    Versions of all the given (unwrapped) callers, normalizers and comparators, as recorded in batch manifests
+    :return: Dict with keys 'callers', 'normalizers' and 'comparators', each a dict of name -> version
+    """
+    return {
+        "callers": dict((name, tool_version(func)) for name, func in callers.iteritems()),
+        "normalizers": dict((name, tool_version(func)) for name, func in normalizers.iteritems()),
+        "comparators": dict((name, tool_version(func)) for name, func in comparators.iteritems())
+    }
@@ -1,10 +1,19 @@
 
+import argparse
+import array
+import copy
+import csv
 import json
-import injectvar, batch_processor
+import multiprocessing
+import os
+import pickle
 import sys
+import time
 from collections import defaultdict
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+import numpy as np
+import columnar
+import result_types
+import stats
 import itertools
 
 VARIANT = "variant"
@@ -24,10 +33,10 @@ NO_NORM = "nonorm"
 RAW_COMP = "raw"
 
 LABEL_SUBS = {
-    batch_processor.NO_VARS_FOUND_RESULT: "Ref. call",
-    batch_processor.ZYGOSITY_MISSING_ALLELE: "Zygosity error",
-    batch_processor.NO_MATCH_RESULT: "Other mismatch",
-    batch_processor.MATCH_RESULT: "Match",
+    result_types.NO_VARS_FOUND_RESULT: "Ref. call",
+    result_types.ZYGOSITY_MISSING_ALLELE: "Zygosity error",
+    result_types.NO_MATCH_RESULT: "Other mismatch",
+    result_types.MATCH_RESULT: "Match",
 }
 
 class Tabelize(object):
@@ -83,7 +92,7 @@ class NormBreakFinder(object):
     def perform_op(self, results):
         for caller in results[RESULTS]:
             try:
-                 if results[RESULTS][caller][self.nonorm_method][self.comp_method] == batch_processor.MATCH_RESULT and results[RESULTS][caller][self.norm_method1][self.omp_method] != batch_processor.MATCH_RESULT:
+                 if results[RESULTS][caller][self.nonorm_method][self.comp_method] == result_types.MATCH_RESULT and results[RESULTS][caller][self.norm_method1][self.omp_method] != result_types.MATCH_RESULT:
                      self.breaks[results[VARIANT] + "-" + caller] = self.norm_method1 + ": " + results[RESULTS][caller][self.norm_method1][self.comp_method] + "  " + self.nonorm_method + ": " + results[RESULTS][caller][self.nonorm_method][self.comp_method]
             except:
                 pass
@@ -96,6 +105,9 @@ class NormBreakFinder(object):
              for var, result in self.breaks:
                  print var + "\t" + result
 
+    def merge(self, other):
+        self.breaks.update(other.breaks)
+
 
 class VAPFailsVgraphHits(object):
 
@@ -122,7 +134,7 @@ class VAPFailsVgraphHits(object):
             graph_result = var_results[caller][self.nonorm][self.vgraph]
             naive_result = var_results[caller][self.nonorm][self.rawcomp]
 
-            if graph_result != batch_processor.MATCH_RESULT:
+            if graph_result != result_types.MATCH_RESULT:
                 return
 
             if vt_result != graph_result:
@@ -135,6 +147,13 @@ class VAPFailsVgraphHits(object):
         except KeyError:
             pass
 
+    def merge(self, other):
+        for hits, other_hits in ((self.vap_hits, other.vap_hits), (self.vt_hits, other.vt_hits), (self.naive_hits, other.naive_hits)):
+            for vartype, vhits in other_hits.iteritems():
+                hits[vartype].update(vhits)
+        for vartype, tot in other.tot.iteritems():
+            self.tot[vartype] += tot
+
     def finalize(self):
         print "VAP / raw match fails, matched by " + self.vgraph
 
@@ -179,40 +198,80 @@ class VAPFailsVgraphHits(object):
 
 class CallerSummary(object):
 
-    def __init__(self):
+    def __init__(self, ci=None, confidence=0.95, plot_dir=None):
+        """
+        :param ci: Method used for confidence intervals of the match rate (one of stats.METHODS), or None for none
+        :param confidence: Confidence level of intervals
+        :param plot_dir: If given, also plot the summary to a png file in this directory
+        """
         self.summary = {}
         self.comparator = VGRAPH
         self.normalizer = NO_NORM
+        self.ci = ci
+        self.confidence = confidence
+        self.plot_dir = plot_dir
 
 
     def perform_op(self, results):
         var_results = results[RESULTS]
         for caller in var_results:
+            try:
+                cresult = var_results[caller][self.normalizer][self.comparator]
+            except KeyError:
+                #This normalizer / comparator wasn't run for this caller
+                continue
             if caller not in self.summary:
                 self.summary[caller] = defaultdict(int)
-            cresult = var_results[caller][self.normalizer][self.comparator]
             self.summary[caller][cresult] += 1
 
+    def merge(self, other):
+        merge_summary(self.summary, other.summary)
+
+    def perform_columnar(self, store):
+        counts = store.counts(["caller", "result"], store.mask(normalizer=self.normalizer, comparator=self.comparator))
+        for (caller, cresult), count in counts.iteritems():
+            if caller not in self.summary:
+                self.summary[caller] = defaultdict(int)
+            self.summary[caller][cresult] += count
+
+    def perform_sql(self, conn):
+        rows = conn.execute("SELECT caller, result, COUNT(*) FROM results WHERE normalizer = ? AND comparator = ? GROUP BY caller, result", (self.normalizer, self.comparator))
+        for caller, cresult, count in rows:
+            if caller not in self.summary:
+                self.summary[caller] = defaultdict(int)
+            self.summary[caller][cresult] += count
+
     def finalize(self):
+        intervals = match_intervals([self.summary], self.ci, self.confidence)[0] if self.ci else None
         print "Caller summary:"
-        print "caller\t" + "\t".join(injectvar.all_result_types)
+        print "caller\t" + "\t".join(result_types.ALL_RESULT_TYPES) + interval_header(intervals, self.confidence)
         for caller in self.summary:
             tot = 0
             for result in self.summary[caller]:
                 tot += self.summary[caller][result]
             print caller,
-            for res in injectvar.all_result_types:
+            for res in result_types.ALL_RESULT_TYPES:
                 print "\t{:.5}".format(100.0*float(self.summary[caller][res])/float(tot)),
-            print ""
+            print format_interval(intervals, caller)
 
         # plot_callers( ([self.summary], ), ["Overall"])
-        plot_results(self.summary)
+        if self.plot_dir is not None:
+            plot_results(self.summary, os.path.join(self.plot_dir, "summary.png"))
 
 class CallerSummaryBySize(object):
 
-    def __init__(self, breaks=None):
+    def __init__(self, breaks=None, ci=None, confidence=0.95, plot_dir=None):
+        """
+        :param breaks: Upper bounds of the size bins
+        :param ci: Method used for confidence intervals of the match rate (one of stats.METHODS), or None for none
+        :param confidence: Confidence level of intervals
+        :param plot_dir: If given, also plot the summary to a png file in this directory
+        """
         self.comparator = VGRAPH
         self.normalizer = NO_NORM
+        self.ci = ci
+        self.confidence = confidence
+        self.plot_dir = plot_dir
         if breaks is None:
             self.breaks = [10, 25, 50, 1000]
         else:
@@ -246,39 +305,78 @@ class CallerSummaryBySize(object):
             summary = self.del_summary[idx]
 
         for caller in var_results:
+            try:
+                cresult = var_results[caller][self.normalizer][self.comparator]
+            except KeyError:
+                continue
             if caller not in summary:
                 summary[caller] = defaultdict(int)
-            cresult = var_results[caller][self.normalizer][self.comparator]
             summary[caller][cresult] += 1
 
-    def _emit_summary(self, summary):
-        print "caller\t" + "\t".join(injectvar.all_result_types)
+    def merge(self, other):
+        for summary, other_summary in zip(self.ins_summary + self.del_summary, other.ins_summary + other.del_summary):
+            merge_summary(summary, other_summary)
+
+    def perform_columnar(self, store):
+        ref_len = np.asarray(store.cell_values("ref_len"))
+        alt_len = np.asarray(store.cell_values("alt_len"))
+        size = np.where(ref_len == alt_len, ref_len, np.abs(alt_len - ref_len))
+        idx = np.searchsorted(self.breaks, size, side='right')
+        insertion = (alt_len > ref_len).astype(np.int64)
+        mask = store.mask(normalizer=self.normalizer, comparator=self.comparator) & (idx < len(self.breaks))
+        counts = store.counts([insertion, idx, "caller", "result"], mask)
+        for (ins, i, caller, cresult), count in counts.iteritems():
+            summary = self.ins_summary[i] if ins else self.del_summary[i]
+            if caller not in summary:
+                summary[caller] = defaultdict(int)
+            summary[caller][cresult] += count
+
+    def perform_sql(self, conn):
+        rows = conn.execute("SELECT ref_len, alt_len, caller, result, COUNT(*) FROM results JOIN variants ON variants.id = results.variant_id WHERE normalizer = ? AND comparator = ? GROUP BY ref_len, alt_len, caller, result", (self.normalizer, self.comparator))
+        for ref_len, alt_len, caller, cresult, count in rows:
+            idx = self._index(ref_len if ref_len == alt_len else abs(ref_len - alt_len))
+            if idx is None:
+                continue
+            summary = self.ins_summary[idx] if alt_len > ref_len else self.del_summary[idx]
+            if caller not in summary:
+                summary[caller] = defaultdict(int)
+            summary[caller][cresult] += count
+
+    def _emit_summary(self, summary, intervals=None):
+        print "caller\t" + "\t".join(result_types.ALL_RESULT_TYPES) + interval_header(intervals, self.confidence)
         for caller in summary:
             tot = 0
             for result in summary[caller]:
                 tot += summary[caller][result]
             print caller + "(" + str(tot) + ")",
-            for res in injectvar.all_result_types:
+            for res in result_types.ALL_RESULT_TYPES:
                 print "\t{:.5}".format(100.0*float(summary[caller][res])/float(tot)),
-            print ""
+            print format_interval(intervals, caller)
 
     def finalize(self):
+        #Intervals for every caller in every bin are computed together
+        nbins = len(self.breaks)
+        if self.ci:
+            intervals = match_intervals(self.ins_summary + self.del_summary, self.ci, self.confidence)
+        else:
+            intervals = [None] * (2 * nbins)
         print "Caller summary:"
         bstrs = [str(i) + "-" + str(j) for i,j in zip([0] + self.breaks[0:-1], self.breaks)]
         for i, bstr in enumerate(bstrs):
             print "\nInsertions, Size range: " + bstr
-            self._emit_summary(self.ins_summary[i])
+            self._emit_summary(self.ins_summary[i], intervals[i])
 
         for i, bstr in enumerate(bstrs):
             print "\nDeletions, Size range: " + bstr
-            self._emit_summary(self.del_summary[i])
+            self._emit_summary(self.del_summary[i], intervals[nbins + i])
 
         #plot_callers( (self.ins_summary, self.del_summary), bstrs)
         # if len(self.ins_summary)>0:
         #      plot_callers_line(self.ins_summary, [str(x) for x in self.breaks + [str(self.breaks[-1]) + "+" ]])
         # else:
 
-        plot_callers_line(self.del_summary, [str(x) for x in self.breaks + [str(self.breaks[-1]) + "+" ]])
+        if self.plot_dir is not None:
+            plot_callers_line(self.del_summary, [str(x) for x in self.breaks + [str(self.breaks[-1]) + "+" ]], os.path.join(self.plot_dir, "bysize.png"))
 
 
 
@@ -296,13 +394,19 @@ class GraphCompMismatches(object):
         var_results = results[RESULTS]
         for caller in var_results:
             for norm_method in var_results[caller]:
-                res1 = var_results[caller][norm_method][self.comp1]
-                res2 = var_results[caller][norm_method][self.comp2]
-                res3 = var_results[caller][norm_method][self.comp3]
+                try:
+                    res1 = var_results[caller][norm_method][self.comp1]
+                    res2 = var_results[caller][norm_method][self.comp2]
+                    res3 = var_results[caller][norm_method][self.comp3]
+                except KeyError:
+                    continue
 
                 if res1 != res2 or res2 != res3:
                     self.mismatches[results[VARIANT]] = caller + "/ " + norm_method + ": " + self.comp1 + ":" +res1 + "\t" + self.comp2 + ": " +res2 + "\t" + self.comp3 + ": " + res3
 
+    def merge(self, other):
+        self.mismatches.update(other.mismatches)
+
     def finalize(self):
         print "Graph comparator mismatches:"
         if len(self.mismatches)==0:
@@ -311,9 +415,185 @@ class GraphCompMismatches(object):
             for k,v in self.mismatches.iteritems():
                 print k + "\t" + v
 
+class QualityCurves(object):
+    """
+    Match rate and result breakdown of each caller / normalizer / comparator combination as a function of a minimum
+    QUAL threshold (from caller_quals): calls below the threshold are counted as filtered, so the curves show what
+    each QUAL cutoff would keep. Quals and results are collected into flat arrays, and each curve is computed by
+    sorting once by qual and taking cumulative sums of the result counts. Curves are written as CSV, one row per
+    threshold
+    """
+
+    def __init__(self, output=None, max_points=200, plot_dir=None):
+        """
+        :param output: File-like object to which CSV output will be written (default: sys.stdout)
+        :param max_points: Maximum number of thresholds reported per curve, evenly spaced through the distinct quals
+        :param plot_dir: If given, also plot match rate against threshold to qualcurves.png in this directory
+        """
+        self.output = output
+        self.max_points = max_points
+        self.plot_dir = plot_dir
+        self.result_types = list(result_types.ALL_RESULT_TYPES)
+        self.result_codes = dict((r, i) for i, r in enumerate(self.result_types))
+        #(caller, normalizer, comparator) -> (array of quals, array of result codes)
+        self.values = {}
+
+    def _result_code(self, result):
+        if result not in self.result_codes:
+            self.result_codes[result] = len(self.result_types)
+            self.result_types.append(result)
+        return self.result_codes[result]
+
+    def _arrays(self, key):
+        if key not in self.values:
+            self.values[key] = (array.array('d'), array.array('i'))
+        return self.values[key]
 
+    def perform_op(self, results):
+        for caller, caller_results in results[RESULTS].iteritems():
+            qual = results[QUALS].get(caller)
+            qual = result_types.MISSING_QUAL if qual is None else float(qual)
+            for normalizer, norm_results in caller_results.iteritems():
+                for comparator, cresult in norm_results.iteritems():
+                    quals, codes = self._arrays( (caller, normalizer, comparator) )
+                    quals.append(qual)
+                    codes.append(self._result_code(cresult))
+
+    def perform_columnar(self, store):
+        keys = [np.asarray(store.cell_values(name)) for name in ("caller", "normalizer", "comparator")]
+        quals = np.asarray(store.cell_values("qual"))
+        recode = np.array([self._result_code(r) for r in store.dims["result"]], dtype=np.int32)
+        codes = recode[np.asarray(store.cell_values("result"))] if len(recode)>0 else np.zeros(0, dtype=np.int32)
+        shape = tuple(len(store.dims[name]) for name in ("caller", "normalizer", "comparator"))
+        flat = np.ravel_multi_index(keys, shape) if len(quals)>0 else np.zeros(0, dtype=np.int64)
+        for combo in np.unique(flat):
+            mask = flat == combo
+            key = tuple(store.dims[name][i] for name, i in zip(("caller", "normalizer", "comparator"), np.unravel_index(combo, shape)))
+            key_quals, key_codes = self._arrays(key)
+            key_quals.extend(quals[mask].tolist())
+            key_codes.extend(codes[mask].tolist())
+
+    def perform_sql(self, conn):
+        for caller, normalizer, comparator, qual, cresult in conn.execute("SELECT caller, normalizer, comparator, qual, result FROM results"):
+            quals, codes = self._arrays( (caller, normalizer, comparator) )
+            quals.append(result_types.MISSING_QUAL if qual is None else qual)
+            codes.append(self._result_code(cresult))
+
+    def merge(self, other):
+        recode = [self._result_code(r) for r in other.result_types]
+        for key, (quals, codes) in other.values.iteritems():
+            key_quals, key_codes = self._arrays(key)
+            key_quals.extend(quals)
+            key_codes.extend(recode[c] for c in codes)
+
+    def curve(self, key):
+        """
+        Compute the curve for one caller / normalizer / comparator combination
+        :return: Tuple of thresholds array, number of calls kept at each threshold, total number of calls, and a
+        2d array of result counts at each threshold (one column per entry in self.result_types)
+        """
+        quals, codes = self.values[key]
+        quals = np.frombuffer(quals, dtype=np.float64) if len(quals)>0 else np.zeros(0)
+        codes = np.frombuffer(codes, dtype=np.int32) if len(codes)>0 else np.zeros(0, dtype=np.int32)
+        quals = np.where(np.isnan(quals), result_types.MISSING_QUAL, quals)
+
+        #Descending qual order, so that the calls kept at each threshold are a prefix
+        order = np.argsort(-quals, kind='mergesort')
+        quals = quals[order]
+        codes = codes[order]
+        counts = np.zeros( (len(codes), len(self.result_types)), dtype=np.int64)
+        counts[np.arange(len(codes)), codes] = 1
+        counts = counts.cumsum(axis=0)
+
+        #Last call with each distinct qual
+        ends = np.flatnonzero(np.append(quals[1:] != quals[:-1], True))
+        if len(ends) > self.max_points:
+            ends = ends[np.unique(np.linspace(0, len(ends)-1, self.max_points).round().astype(int))]
+        return quals[ends], ends + 1, len(quals), counts[ends]
 
-def plot_results(data):
+    def finalize(self):
+        writer = csv.writer(self.output or sys.stdout)
+        writer.writerow(["caller", "normalizer", "comparator", "min_qual", "kept", "total", "match_rate"] + self.result_types)
+        match = self.result_codes.get(result_types.MATCH_RESULT)
+        curves = {}
+        for key in sorted(self.values):
+            thresholds, kept, total, counts = self.curve(key)
+            rates = counts[:, match] / float(total) if match is not None and total>0 else np.zeros(len(kept))
+            curves[key] = (thresholds, rates)
+            for i in range(len(kept)):
+                writer.writerow(list(key) + [thresholds[i], kept[i], total, "{:.5}".format(rates[i])] + counts[i].tolist())
+
+        if self.plot_dir is not None:
+            plot_quality_curves(curves, os.path.join(self.plot_dir, "qualcurves.png"))
+
+#Operations that can be selected on the command line
+OPERATIONS = {
+    "table": Tabelize,
+    "normbreaks": NormBreakFinder,
+    "vapfails": VAPFailsVgraphHits,
+    "summary": CallerSummary,
+    "bysize": CallerSummaryBySize,
+    "graphmismatches": GraphCompMismatches,
+    "qualcurves": QualityCurves,
+}
+
+def match_intervals(summaries, method, confidence):
+    """
+    Confidence intervals for the match rate of every caller in each of a list of summaries (caller -> result -> count),
+    all computed in a single vectorized call
+    :return: List of dicts of caller -> (lower, upper), one per summary
+    """
+    keys = [(i, caller) for i, summary in enumerate(summaries) for caller in summary]
+    successes = [summaries[i][caller].get(result_types.MATCH_RESULT, 0) for i, caller in keys]
+    trials = [sum(summaries[i][caller].values()) for i, caller in keys]
+    intervals = [{} for _ in summaries]
+    if len(keys)>0:
+        lower, upper = stats.interval(successes, trials, method, confidence)
+        for (i, caller), lo, hi in zip(keys, lower, upper):
+            intervals[i][caller] = (lo, hi)
+    return intervals
+
+def interval_header(intervals, confidence):
+    if intervals is None:
+        return ""
+    return "\tMatch " + str(int(round(100*confidence))) + "% CI"
+
+def format_interval(intervals, caller):
+    if intervals is None:
+        return ""
+    lower, upper = intervals[caller]
+    return "\t{:.4}-{:.4}".format(100.0*lower, 100.0*upper)
+
+def merge_summary(summary, other):
+    """
+    Add the result counts of other, a dict of caller -> result -> count, to summary
+    """
+    for caller, counts in other.iteritems():
+        if caller not in summary:
+            summary[caller] = defaultdict(int)
+        for result, count in counts.iteritems():
+            summary[caller][result] += count
+
+
+def pyplot():
+    """
+    Import matplotlib on first use, with a non-interactive backend so plots can be rendered without a display. Only
+    operations that plot pay for loading it
+    :return: Tuple of the matplotlib.pyplot and matplotlib.cm modules
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+    return plt, cm
+
+def save_plot(fig, path):
+    plt, _ = pyplot()
+    fig.savefig(path, facecolor=fig.get_facecolor(), bbox_inches='tight')
+    plt.close(fig)
+
+def plot_results(data, path):
+    plt, cm = pyplot()
     fig = plt.figure()
     fig.patch.set_facecolor('white')
     xmod = 0.5
@@ -322,7 +602,7 @@ def plot_results(data):
     ax = plt.subplot(111)
     ax.yaxis.grid(True)
     vals = {}
-    results = [batch_processor.MATCH_RESULT, batch_processor.NO_MATCH_RESULT,batch_processor.ZYGOSITY_MISSING_ALLELE, batch_processor.NO_VARS_FOUND_RESULT]
+    results = [result_types.MATCH_RESULT, result_types.NO_MATCH_RESULT,result_types.ZYGOSITY_MISSING_ALLELE, result_types.NO_VARS_FOUND_RESULT]
 
     prev = None
     colors = ('green', 'yellow', 'orange', 'red',)
@@ -352,14 +632,33 @@ def plot_results(data):
     ax.set_xticklabels(labels, rotation=45, horizontalalignment='center')
      # ax.set_xticks([x+0.3 for x in xlocs])
     ax.legend(loc='lower right')
-    plt.show()
+    save_plot(fig, path)
 
-def plot_callers_line(data, titles):
+def plot_quality_curves(curves, path):
+    """
+    Plot match rate against minimum QUAL threshold
+    :param curves: Dict of (caller, normalizer, comparator) -> (thresholds, match rates)
+    :param path: Destination image file
+    """
+    plt, cm = pyplot()
+    fig = plt.figure()
+    fig.patch.set_facecolor('white')
+    cmap = cm.get_cmap('CMRmap')
+    ax = plt.subplot(111)
+    for c, (key, (thresholds, rates)) in enumerate(sorted(curves.iteritems())):
+        plt.plot(thresholds, rates, linewidth=2.0, color=cmap(c/float(len(curves))), label="/".join(key))
+    ax.legend(loc='lower left')
+    ax.set_ylabel("Match rate (matches / total assessments)")
+    ax.set_xlabel("Minimum QUAL")
+    save_plot(fig, path)
+
+def plot_callers_line(data, titles, path):
+    plt, cm = pyplot()
     fig = plt.figure()
     fig.patch.set_facecolor('white')
     cmap = cm.get_cmap('CMRmap')
     markers = ['.', 'o', 'v', '+', 's', '*', '>', 'x', 'D', '<', '^']
-    target_result = batch_processor.MATCH_RESULT
+    target_result = result_types.MATCH_RESULT
 
 
     #Need to accumulate a single list of accuracies for a given caller across sizes
@@ -382,18 +681,19 @@ def plot_callers_line(data, titles):
     ax.set_xticklabels(titles)
     ax.set_ylabel("Accuracy (matches / total assessments)")
     ax.set_xlabel("Size")
-    plt.show()
+    save_plot(fig, path)
 
 
 
-def plot_callers(data, titles):
+def plot_callers(data, titles, path):
+    plt, cm = pyplot()
     fig = plt.figure()
     fig.patch.set_facecolor('white')
     rows = len(data)
     cols = len(data[0])
     xmod = 0.5
     ymax = 0
-    results = [batch_processor.MATCH_RESULT, batch_processor.NO_MATCH_RESULT,batch_processor.ZYGOSITY_MISSING_ALLELE, batch_processor.NO_VARS_FOUND_RESULT]
+    results = [result_types.MATCH_RESULT, result_types.NO_MATCH_RESULT,result_types.ZYGOSITY_MISSING_ALLELE, result_types.NO_VARS_FOUND_RESULT]
     for c, ins in enumerate( itertools.chain(*data)):
         labels = []
         ax = plt.subplot(rows, cols, c+1)
@@ -429,7 +729,7 @@ def plot_callers(data, titles):
         ax.set_title(titles[c % cols])
 
     plt.subplots_adjust(hspace=0.3)
-    plt.show()
+    save_plot(fig, path)
 
 
 
@@ -464,22 +764,210 @@ def get_vartype(varstr):
         return "Deletion (" + sizebin(len(ref)-len(alt)) + ")"
     return "MNP " + sizebin( len(ref))
 
-def main(path, operations=[]):
-    line_num = 0
+def read_results(path, start=0, end=None):
+    """
+    Generate the results dicts in a results file one at a time, without reading the whole file into memory. If a
+    byte range is given, only the lines beginning within it are read, so a file can be split into ranges at arbitrary
+    offsets and every line is read exactly once
+    :param path: Path to results file
+    :param start: Byte offset to start reading at
+    :param end: Byte offset to stop reading at (default: end of file)
+    """
+    for offset, line in read_lines(path, start, end):
+        if line[0] == '#' or len(line.strip())==0:
+            continue
+        try:
+            yield parseline(line)
+        except Exception as ex:
+            sys.stderr.write("Error parsing line at byte " + str(offset) + ": " + str(ex) + "\n")
+
+def read_lines(path, start=0, end=None):
+    """
+    Generate (byte offset, line) tuples for the lines of a file that begin within a byte range
+    """
+    with open(path) as fh:
+        if start > 0:
+            #Skip the rest of the line that started before our range, it belongs to the previous one
+            fh.seek(start - 1)
+            fh.readline()
+        pos = fh.tell()
+        while end is None or pos < end:
+            line = fh.readline()
+            if len(line)==0:
+                break
+            offset = pos
+            pos += len(line)
+            yield offset, line
+
+def chunk_ranges(path, chunks):
+    """
+    Split a file into the given number of byte ranges of roughly equal size
+    :return: List of (start, end) tuples
+    """
+    size = os.path.getsize(path)
+    step = max(1, size / chunks + 1)
+    return [(start, min(size, start + step)) for start in range(0, size, step)]
+
+def _process_chunk(task):
+    """
+    Worker process entry point: run fresh copies of the operations on the results a reader (read_results, or another
+    function with the same signature) finds in one byte range of a file, and return them
+    """
+    reader, path, start, end, operations = task
+    for results in reader(path, start, end):
+        for op in operations:
+            op.perform_op(results)
+    return operations
+
+def perform_parallel(chunks, operations, workers):
+    """
+    Run the operations on byte ranges of files in separate processes, and merge the partial results into the
+    operations, which must all have a merge() method and not have been run yet
+    :param chunks: List of (reader, path, start, end) tuples, where reader is a function generating the results dicts
+    in a byte range of a file (like read_results)
+    """
+    #Each task gets its own copy of the (still empty) operations, since tasks are sent while partial results are
+    #being merged
+    tasks = [(reader, path, start, end, copy.deepcopy(operations)) for reader, path, start, end in chunks]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for partial_ops in pool.imap_unordered(_process_chunk, tasks):
+            for op, partial in zip(operations, partial_ops):
+                op.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+
+def make_operations(names, ci=None, plot_dir=None):
+    """
+    Create operations by their names in OPERATIONS, setting the confidence interval method and plot directory of
+    those that have them
+    """
+    ops = []
+    for name in names:
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation " + name)
+        op = OPERATIONS[name]()
+        if hasattr(op, 'ci'):
+            op.ci = ci
+        if hasattr(op, 'plot_dir'):
+            op.plot_dir = plot_dir
+        ops.append(op)
+    return ops
+
+def read_appended(path, offset, operations):
+    """
+    Run the operations on the complete result lines after a byte offset. A last line without a newline may still be
+    being written, so it is left for the next call
+    :return: Tuple of number of results read and offset of the first unread byte
+    """
+    count = 0
     with open(path) as fh:
-        for line in fh.readlines():
-            line_num += 1
-            if len(line)==0 or line[0] == '#':
+        fh.seek(offset)
+        while True:
+            line = fh.readline()
+            if not line.endswith("\n"):
+                break
+            pos = offset
+            offset += len(line)
+            if line[0] == '#' or len(line.strip())==0:
                 continue
             try:
                 results = parseline(line)
             except Exception as ex:
-                sys.stderr.write("Error parsing line #" + str(line_num) + ": " + str(ex))
+                sys.stderr.write("Error parsing line at byte " + str(pos) + ": " + str(ex) + "\n")
                 continue
-
             for op in operations:
                 op.perform_op(results)
+            count += 1
+    return count, offset
 
+def save_checkpoint(checkpoint, path, offset, operations):
+    """
+    Atomically write the state of the operations and the offset they have read the results file up to
+    """
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump({"path": os.path.abspath(path), "offset": offset, "operations": operations}, fh, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, checkpoint)
+
+def load_checkpoint(checkpoint, path, operations):
+    """
+    Read the state saved by save_checkpoint, checking that it was made for the same results file and operations
+    :return: Tuple of offset and operations
+    """
+    with open(checkpoint, "rb") as fh:
+        state = pickle.load(fh)
+    if state["path"] != os.path.abspath(path):
+        raise ValueError("Checkpoint " + checkpoint + " was made for results file " + state["path"])
+    if [op.__class__ for op in state["operations"]] != [op.__class__ for op in operations]:
+        raise ValueError("Checkpoint " + checkpoint + " was made for different operations")
+    return state["offset"], state["operations"]
+
+def follow(path, operations, checkpoint=None, interval=60.0, polls=None):
+    """
+    Keep the operations up to date with a results file that is still being written. Every interval seconds, only
+    the lines appended since the last poll are read, and if there were any the operations are finalized (on a copy,
+    so they can keep accumulating) to print the updated summaries. With a checkpoint file, the state of the operations
+    and the offset read up to are saved after every update, and picked up again when following is restarted
+    :param path: Path to results file
+    :param operations: List of operations
+    :param checkpoint: Optional path to checkpoint file
+    :param interval: Seconds between polls
+    :param polls: Stop after this many polls (default: follow forever)
+    :return: The operations
+    """
+    initial = copy.deepcopy(operations)
+    offset = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        offset, operations = load_checkpoint(checkpoint, path, operations)
+
+    count = 0
+    while polls is None or count < polls:
+        if count > 0:
+            time.sleep(interval)
+        count += 1
+        if os.path.getsize(path) < offset:
+            sys.stderr.write("Results file " + path + " is shorter than before, starting over\n")
+            offset = 0
+            operations = copy.deepcopy(initial)
+        new_results, offset = read_appended(path, offset, operations)
+        if new_results == 0:
+            continue
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, path, offset, operations)
+        print "\n#Results read: up to byte " + str(offset) + " at " + time.strftime('%Y-%m-%d %H:%M:%S')
+        for op in copy.deepcopy(operations):
+            print "\n"
+            op.finalize()
+        sys.stdout.flush()
+    return operations
+
+def main(path, operations=[], workers=1):
+    """
+    Run the operations on every result in the file, then finalize them. With more than one worker, the file is
+    split into byte ranges that are parsed in separate processes, each running all of the operations, and the partial
+    results are combined with each operation's merge() method. Operations without one (like Tabelize, which prints
+    as it goes) are always run in a single process
+    :param path: Path to results file
+    :param operations: List of operations
+    :param workers: Number of processes to use
+    """
+    if os.path.isdir(path):
+        #A columnar store (see columnar.py), which operations summarize with vectorized group-bys
+        unsupported = [op.__class__.__name__ for op in operations if not hasattr(op, 'perform_columnar')]
+        if len(unsupported)>0:
+            raise ValueError("Operations " + ", ".join(unsupported) + " can't be performed on a columnar store")
+        store = columnar.ColumnarStore(path)
+        for op in operations:
+            op.perform_columnar(store)
+    elif workers > 1 and all(hasattr(op, 'merge') for op in operations):
+        #Several chunks per worker keeps them all busy even if chunks take different amounts of time
+        perform_parallel([(read_results, path, start, end) for start, end in chunk_ranges(path, workers * 4)], operations, workers)
+    else:
+        for results in read_results(path):
+            for op in operations:
+                op.perform_op(results)
 
     for op in operations:
         print "\n"
@@ -487,17 +975,27 @@ def main(path, operations=[]):
 
 
 if __name__=="__main__":
-    if len(sys.argv)<2:
-        print "Please enter the name of the results file to parse"
-        exit(1)
-
-    ops = [
-
-        # Tabelize(),
-        #NormBreakFinder(),
-        VAPFailsVgraphHits(),
-        #GraphCompMismatches(),
-        #CallerSummary(),
-        #CallerSummaryBySize(range(1, 120, 5)),
-    ]
-    main(sys.argv[1], ops)
\ No newline at end of file
+    parser = argparse.ArgumentParser("Summarize varcomp results")
+    parser.add_argument("results", help="Results file (or columnar store directory, see columnar.py) to parse")
+    parser.add_argument("--ops", help="Comma separated list of operations to perform (" + ", ".join(sorted(OPERATIONS)) + "), default: vapfails", default="vapfails")
+    parser.add_argument("--ci", help="Add confidence intervals for match rates to summaries, computed by one of: " + ", ".join(stats.METHODS), choices=stats.METHODS, default=None)
+    parser.add_argument("-j", "--workers", help="Number of processes used to parse the results (default 1)", default=1, type=int)
+    parser.add_argument("-f", "--follow", help="Keep reading results as they are appended to the file, printing updated summaries", action='store_true')
+    parser.add_argument("--interval", help="Seconds between checks for new results with --follow (default 60)", default=60.0, type=float)
+    parser.add_argument("--checkpoint", help="With --follow, save the summaries and the position in the results file to this file after every update, and resume from it when restarted")
+    parser.add_argument("--plot-dir", help="Write the plots of operations that make them (summary, bysize, qualcurves) as png files to this directory. Nothing is plotted by default")
+    args = parser.parse_args()
+
+    if args.plot_dir is not None and not os.path.exists(args.plot_dir):
+        os.makedirs(args.plot_dir)
+
+    try:
+        ops = make_operations(args.ops.split(","), ci=args.ci, plot_dir=args.plot_dir)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if args.follow:
+        if os.path.isdir(args.results):
+            parser.error("--follow needs a results file, not a columnar store")
+        follow(args.results, ops, checkpoint=args.checkpoint, interval=args.interval)
+    else:
+        main(args.results, ops, workers=args.workers)
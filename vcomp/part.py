@@ -1,22 +1,11 @@
-from   collections import deque
+from   collections import deque, defaultdict
 from   itertools   import groupby
-from   operator    import attrgetter
+from   operator    import attrgetter, itemgetter
 from   heapq       import heappop, heappush
+import argparse
 import sys
 import pysam
 
-DEFAULT_CONTIG_ORDER=['1', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '2', '20', '21', '22', '3', '4', '5', '6', '7', '8','9', 'MT', 'X','Y']
-
-def var_comp(v1, v2):
-    v1c = DEFAULT_CONTIG_ORDER.index(v1[0])
-    v2c = DEFAULT_CONTIG_ORDER.index(v2[0])
-    if v1c == v2c:
-        return v1[1] - v2[1]
-    else:
-        return v1c - v2c
-
-
-
 
 def window(seq, n=2):
     '''windowed iterator
@@ -38,7 +27,7 @@ def decorate_vars(vars, d=1000):
        (contig, max(0, start-d), stop+d, var)
     '''
     for var in vars:
-        yield var.contig, max(0, var.start - d), var.stop + 1000, var
+        yield var.contig, max(0, var.start - d), var.stop + d, var
 
 
 
@@ -78,7 +67,7 @@ def partition_intervals(items):
     parts = [ (-1, []) ]
 
     for item in items:
-        contig, start, stop, var = item
+        start, stop = item[1], item[2]
 
         if parts[0][0] <= start:
             _, p = heappop(parts)
@@ -91,78 +80,178 @@ def partition_intervals(items):
     return [ p for (stop, p) in parts ]
 
 
-def merge_partitions(parts, solitary):
+class CostModel(object):
     '''
-    Merge partitioned and solitary variants.  Partitioned variants are
-    merged using a min-size greedy algorithm.  Solitary variants are added
-    sequentially to the minimum sized partitions.
+    Estimated cost (in roughly seconds) of processing a decorated variant.
+    Cost grows with the size of the window around the variant, including
+    the length of any inserted sequence, and optionally with the fraction of
+    the window that is soft-masked (repeat) sequence in the reference.
+    Measured timings from previous runs take precedence over the estimate.
     '''
 
-    # Start with an empty set of partitions.  For each contig, add each new
-    # partition to the current set of partitions such that len(combined) =
-    # max( len(old), len(new) ) in descending size order of new partitions
-    # and selecting the smallest old partition.  These two greedy choices
-    # are not optimal, since partitions are added contig by contig and not
-    # globally.
+    def __init__(self, per_variant=1.0, per_kb=0.5, repeat_weight=0.0, timings=None, ref=None):
+        self.per_variant = per_variant
+        self.per_kb = per_kb
+        self.repeat_weight = repeat_weight
+        self.timings = timings or {}
+        self.ref = ref
 
-    heap = []
-    for part in parts:
-        next_heap = []
+    def __call__(self, item):
+        contig, start, stop, var = item[:4]
 
-        part.sort(key=len, reverse=True)
+        measured = self.timings.get( (contig, var.pos) )
+        if measured is not None:
+            return measured
 
-        for vars in part:
-            if heap:
-                _, p = heappop(heap)
-                p.extend(vars)
-            else:
-                p = vars
-            heappush(next_heap, (len(p), p) )
+        inserted = max(0, max(len(a) for a in var.alleles) - len(var.ref))
+        cost = self.per_variant + self.per_kb * (stop - start + inserted) / 1000.0
 
-        for item in heap:
-            heappush(next_heap, item)
+        if self.ref is not None and self.repeat_weight > 0:
+            seq = self.ref.fetch(contig, start, stop)
+            if seq:
+                masked = sum(1 for c in seq if c.islower())
+                cost *= 1.0 + self.repeat_weight * masked / float(len(seq))
 
-        heap = next_heap
+        return cost
 
-    # Stuff in solitary elements to the smallest partitions even out sizes
-    for s in solitary:
-        _, p = heappop(heap)
-        p.append(s)
-        heappush(heap, (len(p), p) )
 
-    # Undecorate heap to obtain final partitions
-    return [p for l,p in heap]
+def read_timings(filename):
+    '''
+    Read measured per-variant processing times from a tab separated file of
+    contig, position (1-based, as in the VCF) and seconds.  Lines starting
+    with '#' are ignored.
+    '''
+    timings = {}
+    with open(filename) as fh:
+        for line in fh:
+            if not line.strip() or line.startswith('#'):
+                continue
+            toks = line.split()
+            timings[ (toks[0], int(toks[1])) ] = float(toks[2])
+    return timings
 
 
-def main(args):
-    filename = args[1]
-    vars = pysam.VariantFile(filename)
+class Partition(object):
+    '''
+    A single output partition.  The output file is created when the first
+    variants are written to it.
+    '''
 
-    solitary = []
-    parts = []
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.out = None
+        self.cost = 0.0
+        self.count = 0
 
-    for contig, contig_vars in groupby(vars, attrgetter('contig')):
-        contig_vars = decorate_vars(contig_vars)
-        contig_solitary, contig_popular = collect_solitary(contig_vars)
-        contig_parts = partition_intervals(contig_popular)
+    def write(self, items):
+        if self.out is None:
+            self.out = pysam.VariantFile(self.filename, 'w', header=self.header)
+        for item in items:
+            self.out.write(item[3])
+        self.count += len(items)
 
-        solitary += contig_solitary
-        parts.append(contig_parts)
+    def close(self):
+        if self.out is not None:
+            self.out.close()
 
-    parts = merge_partitions(parts, solitary)
 
+class PartitionWriter(object):
+    '''
+    Assign variants to partitions balanced by estimated cost, and stream them
+    out one contig at a time.  Only the variants of the current contig are
+    held in memory.
+    '''
+
+    def __init__(self, basename, header, workers=1):
+        self.basename = basename
+        self.header = header
+        self.parts = []
+        self.heap = []
+        for _ in xrange(workers):
+            self.add_partition()
+
+    def add_partition(self):
+        part = Partition(self.basename.format(len(self.parts) + 1), self.header)
+        self.parts.append(part)
+        heappush(self.heap, (0.0, len(self.parts) - 1))
+
+    def add_contig(self, chains, solitary):
+        '''
+        Assign the non-overlapping chains and the solitary variants of one
+        contig to partitions.  Chains must go to distinct partitions, so the
+        most costly chains are paired with the least loaded partitions (adding
+        partitions if there are more chains than partitions).  Solitary
+        variants are then placed one at a time, most costly first, on the
+        least loaded partition.  Items are decorated variants with their cost
+        as the last element.
+        '''
+        while len(self.parts) < len(chains):
+            self.add_partition()
+
+        cost = itemgetter(-1)
+        pending = defaultdict(list)
+
+        chains = sorted(chains, key=lambda c: sum(map(cost, c)), reverse=True)
+        smallest = [ heappop(self.heap) for _ in chains ]
+        for chain, (load, i) in zip(chains, smallest):
+            pending[i].extend(chain)
+            heappush(self.heap, (load + sum(map(cost, chain)), i))
+
+        for item in sorted(solitary, key=cost, reverse=True):
+            load, i = heappop(self.heap)
+            pending[i].append(item)
+            heappush(self.heap, (load + cost(item), i))
+
+        for i, items in pending.iteritems():
+            items.sort(key=itemgetter(1))
+            self.parts[i].write(items)
+            self.parts[i].cost += sum(map(cost, items))
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+
+
+def output_basename(filename):
     if filename == '-':
-        basename = 'vars_part{:03d}.vcf'
+        return 'vars_part{:03d}.vcf'
     elif filename.endswith('.vcf') or filename.endswith('.bcf'):
-        basename = filename[:-4] + '_part{:03d}' + filename[-4:]
+        return filename[:-4] + '_part{:03d}' + filename[-4:]
     elif filename.endswith('.vcf.gz'):
-        basename = filename[:-7] + '_part{:03d}' + filename[-7:]
+        return filename[:-7] + '_part{:03d}' + filename[-7:]
+    return filename + '_part{:03d}.vcf'
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Partition variants into sets of non-overlapping variants, balanced by estimated processing cost')
+    parser.add_argument('vcf', help='Input VCF (sorted), or - for standard input')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Target number of partitions (more are created if overlapping variants require it)')
+    parser.add_argument('-d', '--distance', type=int, default=1000, help='Window size around each variant used to determine overlaps')
+    parser.add_argument('--timings', help='Tab separated file of contig, position and seconds measured for variants in previous runs')
+    parser.add_argument('--per-variant', type=float, default=1.0, help='Estimated fixed cost of each variant')
+    parser.add_argument('--per-kb', type=float, default=0.5, help='Estimated cost per kb of window')
+    parser.add_argument('--ref', help='Soft-masked reference fasta, used to increase the cost of repeat-rich windows')
+    parser.add_argument('--repeat-weight', type=float, default=1.0, help='Relative cost increase of a fully repeat-masked window (requires --ref)')
+    args = parser.parse_args(args[1:])
+
+    timings = read_timings(args.timings) if args.timings else None
+    ref = pysam.FastaFile(args.ref) if args.ref else None
+    cost = CostModel(args.per_variant, args.per_kb, args.repeat_weight if ref else 0.0, timings, ref)
+
+    vars = pysam.VariantFile(args.vcf)
+    writer = PartitionWriter(output_basename(args.vcf), vars.header, max(1, args.workers))
+
+    for contig, contig_vars in groupby(vars, attrgetter('contig')):
+        items = [ item + (cost(item),) for item in decorate_vars(contig_vars, args.distance) ]
+        contig_solitary, contig_popular = collect_solitary(items)
+        writer.add_contig(partition_intervals(contig_popular), contig_solitary)
+
+    writer.close()
 
-    for i,part in enumerate(parts, 1):
-        out_vars = pysam.VariantFile(basename.format(i), 'w', header=vars.header)
-        for var in sorted(list(part), cmp=var_comp):
-            out_vars.write(var[3])
-        out_vars.close()
+    for part in writer.parts:
+        if part.count:
+            sys.stderr.write('{}\t{}\t{:.1f}\n'.format(part.filename, part.count, part.cost))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+"""
+Multi-stage external tool pipelines whose stages are connected by OS pipes, so intermediate output (mpileups,
+uncompressed vcfs) never touches the disk or gets buffered in memory.
+"""
+
+import subprocess
+import time
+
+from vcomp import runner
+
+
+class Pipeline(object):
+    """
+    A chain of commands, each reading the previous command's standard output. Stages may be given as shell
+    command strings or as argument lists. The output of the final stage is usually a vcf, which can be streamed
+    straight into a bgzipped, tabix-indexed file with run_to_bgzf
+    """
+
+    def __init__(self, *stages):
+        if len(stages)==0:
+            raise ValueError('A pipeline needs at least one stage')
+        self.stages = list(stages)
+
+    def run(self, output_fh, conf=None, tool=None):
+        """
+        Execute all stages concurrently, writing the output of the last stage to the given file handle. Raises
+        CalledProcessError (for the first failing stage) if any stage exits with a nonzero status. Each stage
+        is reaped by the runner, so it gets its own metrics entry; the configured timeout for the tool applies
+        to the pipeline as a whole
+        :param output_fh: Open file to receive final output
+        :param conf: Configuration object
+        :param tool: Name of the tool the pipeline implements (default: derived from the first stage)
+        """
+        if tool is None:
+            tool = runner.tool_name(self.stages[0])
+        timeout = runner.timeout_for(tool, conf)
+        started = time.time()
+        deadline = started + timeout if timeout is not None else None
+
+        procs = []
+        upstream = None
+        for i, stage in enumerate(self.stages):
+            last = i == len(self.stages)-1
+            proc = runner.start(stage, shell=isinstance(stage, basestring), stdin=upstream,
+                                stdout=output_fh if last else subprocess.PIPE)
+            #Drop our copy of the pipe so the upstream stage gets SIGPIPE if this one exits early
+            if upstream is not None:
+                upstream.close()
+            upstream = proc.stdout
+            procs.append(proc)
+
+        failed = None
+        try:
+            for stage, proc in zip(self.stages, procs):
+                status = runner.wait(proc, stage, tool + ":" + runner.tool_name(stage), deadline=deadline, started=started)
+                if status != 0 and failed is None:
+                    failed = subprocess.CalledProcessError(status, stage)
+        except runner.ToolTimeout:
+            for stage, proc in zip(self.stages, procs):
+                if proc.returncode is None:
+                    runner.kill(proc)
+                    runner.wait(proc, stage, tool + ":" + runner.tool_name(stage), started=started)
+            raise
+        if failed is not None:
+            raise failed
+
+    def run_to_bgzf(self, dest, conf, tool=None):
+        """
+        Execute the pipeline, compressing the final output with bgzip on the fly and indexing the result with tabix
+        :param dest: Destination file name, should end with .vcf.gz
+        :param conf: Configuration (needed for paths to tabix, bgzip)
+        :param tool: Name of the tool the pipeline implements
+        :return: Name of compressed, indexed output file
+        """
+        if tool is None:
+            tool = runner.tool_name(self.stages[0])
+        compressed = Pipeline(*(self.stages + [[conf.get('main', 'bgzip_path'), "-c"]]))
+        with open(dest, "wb") as fh:
+            compressed.run(fh, conf=conf, tool=tool)
+        runner.check_call([conf.get('main', 'tabix_path'), "-f", "-p", "vcf", dest], conf, tool="tabix")
+        return dest
@@ -1,8 +1,10 @@
 
 import pysam
-import subprocess
 import os
 import vcomp.util
+from vcomp import records
+from vcomp import resources
+from vcomp import runner
 
 
 ALLELE_MATCH="Alleles matched"
@@ -46,6 +48,7 @@ def compare_raw(orig_vcf, caller_vcf, bed, conf):
 
 
 
+@resources.requires(mem_mb=1024)
 def compare_vgraph(orig_vcf, caller_vcf, bed, conf):
     #Slightly tricky - must make sure executed python script is executed in a workable virtualenv. For now we
     #execute it in whatever virtual env this script is being processed in.
@@ -62,7 +65,7 @@ def compare_vgraph(orig_vcf, caller_vcf, bed, conf):
     if bed is not None:
         bedcmd = " --include-regions " + bed
     vg_cmd = conf.get('main', 'vgraph_path') + " --out1 " + orig_out + " --out2 " + caller_out + " --reference " + conf.get('main', 'ref_genome') + bedcmd + " " + orig_vcf + " " + caller_vcf
-    ignored = subprocess.check_output(vg_cmd, env=os.environ.copy(), shell=True)
+    ignored = runner.check_output(vg_cmd, conf, tool="vgraph", env=os.environ.copy(), shell=True)
 
     unmatched_orig = []
     matches = []
@@ -73,7 +76,7 @@ def compare_vgraph(orig_vcf, caller_vcf, bed, conf):
         bk = ovar.samples[0]['BK']
 
         if bd == 'X':
-            unmatched_orig.append(ovar)
+            unmatched_orig.append(records.from_pysam(ovar, orig_out))
         if bd == 'N':
             unmatched_orig.append(
                 vcomp.util.ErrorVariant(chrom=ovar.chrom, start=ovar.start, msg="vgraph error code N"))
@@ -81,9 +84,10 @@ def compare_vgraph(orig_vcf, caller_vcf, bed, conf):
     for cvar in pysam.VariantFile(caller_out):
         bd = cvar.samples[0]['BD']
         if bd == '=':
-            matches.append((cvar, cvar))
+            var = records.from_pysam(cvar, caller_out)
+            matches.append((var, var))
         if bd == 'X':
-            unmatched_caller.append(cvar)
+            unmatched_caller.append(records.from_pysam(cvar, caller_out))
         if bd == 'N':
             unmatched_caller.append(vcomp.util.ErrorVariant(chrom=cvar.chrom, start=cvar.start, msg="vgraph error code N"))
 
@@ -91,6 +95,7 @@ def compare_vgraph(orig_vcf, caller_vcf, bed, conf):
 
 
 
+@resources.requires(mem_mb=4608)
 def compare_vcfeval(orig_vcf, caller_vcf, bed, conf):
 
     #vcfeval will throw an exception if caller vcf is empty, so catch that case here
@@ -99,10 +104,10 @@ def compare_vcfeval(orig_vcf, caller_vcf, bed, conf):
         return (read_all_vars(orig_vcf, bed), [], caller_vars)
 
     output_dir = "vcfeval-output" + vcomp.util.randstr()
-    cmd = "java -Djava.io.tmpdir=. -Xmx4g -jar " + conf.get('main', 'rtg_jar') + " vcfeval -t " + conf.get('main', 'rtg_ref_sdf') + " --all-records -o " + output_dir + " -b " + orig_vcf + " -c " + caller_vcf
+    cmd = "java -Djava.io.tmpdir=. " + resources.java_heap(compare_vcfeval, conf) + " -jar " + conf.get('main', 'rtg_jar') + " vcfeval -t " + conf.get('main', 'rtg_ref_sdf') + " --all-records -o " + output_dir + " -b " + orig_vcf + " -c " + caller_vcf
     if bed is not None:
         cmd = cmd + " --bed-regions " + bed
-    subprocess.check_output(cmd, shell=True, executable="/bin/bash")
+    runner.check_output(cmd, conf, tool="vcfeval", shell=True, executable="/bin/bash")
     # orig_vars = read_all_vars(orig_vcf, bed)
     tp_vars = read_all_vars(output_dir + "/tp.vcf.gz")
     fp_vars = read_all_vars(output_dir + "/fp.vcf.gz")
@@ -110,6 +115,7 @@ def compare_vcfeval(orig_vcf, caller_vcf, bed, conf):
     return (fn_vars, zip(tp_vars, tp_vars), fp_vars)
 
 
+@resources.requires(mem_mb=2048)
 def compare_happy(orig_vcf, caller_vcf, bed, conf):
     orig_vars = read_all_vars(orig_vcf, bed)
     caller_vars = read_all_vars(caller_vcf, bed)
@@ -125,14 +131,15 @@ def compare_happy(orig_vcf, caller_vcf, bed, conf):
     if bed is not None:
         bedarg = " -T " + bed
     cmd = conf.get('main', 'happy_path') + " " + orig_vcf + " " + caller_vcf + " " + bedarg + " -o " + output_prefix + " --scratch-prefix=. --include-nonpass -r " + conf.get('main', 'ref_genome') + " -l " + ",".join(all_chrs) + " --no-fixchr-truth --no-fixchr-query -V"
-    ignored = subprocess.check_output(cmd, shell=True)
+    ignored = runner.check_output(cmd, conf, tool="happy", shell=True)
 
     orig_unmatched = []
     matches = []
     caller_unmatched = []
 
-    for var in pysam.VariantFile(output_prefix + ".vcf.gz"):
-        vstr = str(var)
+    for pvar in pysam.VariantFile(output_prefix + ".vcf.gz"):
+        vstr = str(pvar)
+        var = records.from_pysam(pvar, output_prefix + ".vcf.gz")
         if "type=FP" in vstr:
             caller_unmatched.append(var)
             if "kind=gtmismatch" in vstr or "kind=alpartial" in vstr:
@@ -152,12 +159,12 @@ def read_all_vars(vcf, bed=None):
     reading the vcf, return an empty list
     :param vcf:VCF to read variants from
     :param bed:If not none, only read variants in these regions
-    :return:
+    :return: List of records.CompactVariant
     """
     vars = []
     try:
         if bed is None:
-            vars = list(pysam.VariantFile(vcf))
+            vars = [records.from_pysam(var, vcf) for var in pysam.VariantFile(vcf)]
         else:
             vfh = pysam.VariantFile(vcf)
             for line in open(bed, "r"):
@@ -168,7 +175,7 @@ def read_all_vars(vcf, bed=None):
                 chr = toks[0]
                 reg_start = int(toks[1])
                 reg_end = int(toks[2])
-                vars.extend(list(vfh.fetch(chr, reg_start, reg_end)))
+                vars.extend(records.from_pysam(var, vcf) for var in vfh.fetch(chr, reg_start, reg_end))
     except Exception as ex:
         #VCF files with zero variants cause the pysam.VariantFile to throw an exception. We ignore
         #these exceptions and return an empty list
@@ -179,15 +186,13 @@ def read_all_vars(vcf, bed=None):
 def test_var_equiv(var1, var2):
     """
     Compare two vars for equality of chrom, pos, ref, and alt and return True if everything is equal.
-    :param var1:
-    :param var2:
+    :param var1: records.CompactVariant
+    :param var2: records.CompactVariant
     :return: True if both variant records are identical (contain same alts with same GT fields)
     """
-    alts1 = str([str(a) + "," for a in var1.alts])
-    alts2 = str([str(a) +","  for a in var2.alts])
-    gt1 = vcomp.util.get_first_gt(var1)
-    gt2 = vcomp.util.get_first_gt(var2)
-    return var1.chrom == var2.chrom and var1.start == var2.start and var1.ref == var2.ref and  alts1==alts2 and gt1 == gt2
+    gt1 = vcomp.util.genotype_class(var1.gt)
+    gt2 = vcomp.util.genotype_class(var2.gt)
+    return var1.chrom == var2.chrom and var1.start == var2.start and var1.ref == var2.ref and var1.alts == var2.alts and gt1 == gt2
 
 
 
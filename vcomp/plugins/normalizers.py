@@ -1,6 +1,7 @@
 
-import subprocess
 from vcomp import util
+from vcomp import runner
+from vcomp import resources
 
 def get_normalizers():
     return {
@@ -10,24 +11,22 @@ def get_normalizers():
         # 'bcftools': normalize_bcftools
     }
 
+@util.identity_normalizer
 def normalize_nothing(orig_vcf, conf):
     """
-    Just copy the original vcf to a new, identical vcf file.
+    Don't normalize at all. The original vcf is returned as-is (after making sure it's compressed and indexed),
+    no copy is made.
     """
-    newvcf_name = orig_vcf.replace(".vcf", ".nonorm.vcf")
-    cmd = "cp " + orig_vcf + " " + newvcf_name
-    subprocess.check_call(cmd, shell=True)
-
-    newvcf_name = util.bgz_tabix(newvcf_name, conf)
-    return newvcf_name
+    return util.ensure_indexed(orig_vcf, conf)
 
+@resources.requires(mem_mb=1536)
 def normalize_vap_leftalign(orig_vcf, conf):
     err = open("/dev/null")
     orig_vcf = util.sort_vcf(orig_vcf, conf)
     tmp_vcf = orig_vcf.replace(".vcf", ".vap.tmp.vcf").replace(".gz", "")
     final_vcf = orig_vcf.replace(".vcf", ".vap.leftaligned.vcf")
     norm_orig_cmd = conf.get('main', 'vcfallelicprimitives_path') + " " + orig_vcf
-    tmp_output=subprocess.check_output(norm_orig_cmd, shell=True)
+    tmp_output=runner.check_output(norm_orig_cmd, conf, tool="vcfallelicprimitives", shell=True)
     with open(tmp_vcf, "w") as fh:
         fh.write(tmp_output)
 
@@ -37,8 +36,8 @@ def normalize_vap_leftalign(orig_vcf, conf):
     except:
         pass
 
-    cmd = "java -Djava.io.tmpdir=. -Xmx1g -jar " + conf.get('main', 'gatk_path') + " -T LeftAlignAndTrimVariants " + no_et + " -R " + conf.get('main', 'ref_genome') + " -V " + tmp_vcf + " -o " + final_vcf
-    subprocess.check_output(cmd, shell=True)
+    cmd = "java -Djava.io.tmpdir=. " + resources.java_heap(normalize_vap_leftalign, conf) + " -jar " + conf.get('main', 'gatk_path') + " -T LeftAlignAndTrimVariants " + no_et + " -R " + conf.get('main', 'ref_genome') + " -V " + tmp_vcf + " -o " + final_vcf
+    runner.check_output(cmd, conf, tool="leftalign", shell=True)
     err.close()
 
     return util.bgz_tabix(final_vcf, conf)
@@ -52,7 +51,7 @@ def normalize_vt(orig_vcf, conf):
     err = open("/dev/null")
     norm_orig_vcf = orig_vcf.replace(".vcf", ".norm.vt.vcf")
     norm_orig_cmd = conf.get('main', 'vt_path') + " normalize " + " -r " + conf.get('main', 'ref_genome') + " " + orig_vcf + " -o " + norm_orig_vcf
-    subprocess.check_output(norm_orig_cmd.split(), stderr=err)
+    runner.check_output(norm_orig_cmd.split(), conf, tool="vt", stderr=err)
     norm_orig_vcf = util.bgz_tabix(norm_orig_vcf, conf)
     err.close()
     return norm_orig_vcf
@@ -66,7 +65,7 @@ def normalize_bcftools(orig_vcf, conf):
     """
     norm_orig_vcf = orig_vcf.replace(".vcf.gz", ".norm.bcftools" + util.randstr() + ".vcf")
     norm_orig_cmd = conf.get('main', 'bcftools_path') + " norm " + " -c w -f " + conf.get('main', 'ref_genome') + " " + orig_vcf + " -o " + norm_orig_vcf
-    subprocess.check_call(norm_orig_cmd.split())
+    runner.check_call(norm_orig_cmd.split(), conf, tool="bcftools-norm")
     norm_orig_vcf = util.bgz_tabix(norm_orig_vcf, conf)
     return norm_orig_vcf
 
@@ -0,0 +1,55 @@
+"""
+Compact variant records for comparator results. Comparators used to return the pysam.VariantRecords they read,
+which keep their whole vcf line (INFO, FORMAT and sample fields) and file handle alive, and compute every attribute
+on access. Results are held for every caller x normalizer x comparator of a batch (and by the invocation cache
+across batches), and split into regions by chrom and start, so comparators convert their records to CompactVariants
+holding only the fields that are looked at, with chromosome names, alleles and genotypes shared between records.
+"""
+
+#Distinct genotype tuples seen, so records share them
+_genotypes = {}
+
+
+class CompactVariant(object):
+    """
+    The chromosome, 0-based start, alleles and first sample's genotype of a vcf record, plus the file it was read
+    from. Attribute names are those of pysam.VariantRecord, so code examining comparator results works with either
+    """
+
+    __slots__ = ('chrom', 'start', 'ref', 'alts', 'gt', 'source')
+
+    def __init__(self, chrom, start, ref, alts, gt=None, source=None):
+        """
+        :param chrom: Chromosome name
+        :param start: 0-based start position
+        :param ref: Reference allele
+        :param alts: Tuple of alternate alleles
+        :param gt: Tuple of allele indices of the first sample's GT, or None if there is none
+        :param source: Path of the vcf the record was read from
+        """
+        self.chrom = intern(chrom)
+        self.start = start
+        self.ref = intern(ref)
+        self.alts = tuple(intern(a) for a in alts) if alts is not None else ()
+        self.gt = _genotypes.setdefault(gt, gt) if gt is not None else None
+        self.source = source
+
+    @property
+    def pos(self):
+        return self.start + 1
+
+    def __reduce__(self):
+        return (CompactVariant, (self.chrom, self.start, self.ref, self.alts, self.gt, self.source))
+
+    def __repr__(self):
+        return "\t".join([self.chrom, str(self.pos), self.ref, ",".join(self.alts), "/".join(str(g) for g in self.gt or ())])
+
+
+def from_pysam(var, source=None):
+    """
+    Create a CompactVariant from a pysam.VariantRecord
+    """
+    gt = None
+    if len(var.samples)>0 and 'GT' in var.samples[0]:
+        gt = tuple(var.samples[0]['GT'])
+    return CompactVariant(str(var.chrom), var.start, str(var.ref), var.alts, gt, source)
@@ -0,0 +1,204 @@
+"""
+CPU and memory declarations for callers, normalizers, comparators and alignment, plus a node-level scheduler that
+keeps concurrently running tools within a core and memory budget. The scheduler's bookkeeping lives in a small
+lock-protected state file, so it also limits tools started by separate varcomp processes (for instance several
+batches run side by side by GNU parallel).
+
+Budgets and per-function overrides are read from the optional [resources] configuration section:
+
+    [resources]
+    cpus=16
+    mem_mb=64000
+    state_file=/tmp/varcomp-resources.json
+    gen_alt_bam.cpus=8
+    call_variant_gatk_hc.mem_mb=4096
+"""
+
+import errno
+import fcntl
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+Resources = namedtuple('Resources', ['cpus', 'mem_mb'])
+
+DEFAULT_RESOURCES = Resources(cpus=1, mem_mb=512)
+
+#Memory a JVM needs beyond its maximum heap size
+JVM_OVERHEAD_MB = 512
+
+SECTION = 'resources'
+
+
+def requires(cpus=1, mem_mb=512):
+    """
+    Decorator used by plugins to declare the number of cores and amount of memory (in MB) a single call uses
+    """
+    def decorate(func):
+        func.resources = Resources(cpus, mem_mb)
+        return func
+    return decorate
+
+
+def requirements(func, conf=None):
+    """
+    Return the resources needed by the given function: its declared requirements, overridden by any
+    '<function name>.cpus' or '<function name>.mem_mb' entries in the [resources] section of the configuration
+    :param func: Caller, normalizer, comparator or other function
+    :param conf: Configuration object, may be None
+    :return: Resources tuple
+    """
+    declared = getattr(func, 'resources', DEFAULT_RESOURCES)
+    cpus, mem_mb = declared.cpus, declared.mem_mb
+    if conf is not None and conf.has_section(SECTION):
+        name = getattr(func, '__name__', None)
+        if conf.has_option(SECTION, str(name) + '.cpus'):
+            cpus = conf.getint(SECTION, name + '.cpus')
+        if conf.has_option(SECTION, str(name) + '.mem_mb'):
+            mem_mb = conf.getint(SECTION, name + '.mem_mb')
+    return Resources(cpus, mem_mb)
+
+
+def threads(func, conf=None):
+    """
+    Number of threads the given function should tell the tools it runs to use
+    """
+    return max(1, requirements(func, conf).cpus)
+
+
+def java_heap(func, conf=None):
+    """
+    JVM maximum heap size argument (e.g. -Xmx1024m) matching the memory declared for the given function
+    """
+    return "-Xmx" + str(max(256, requirements(func, conf).mem_mb - JVM_OVERHEAD_MB)) + "m"
+
+
+def physical_mem_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+
+
+class ResourceScheduler(object):
+    """
+    Grants reservations of cores and memory such that the sum of all outstanding reservations on the node stays
+    within the budget. A request that exceeds the budget on its own is granted once nothing else is running,
+    so it can't wait forever. Reservations belonging to processes that have died are discarded.
+    """
+
+    def __init__(self, conf=None, cpus=None, mem_mb=None, state_file=None, poll_interval=1.0):
+        """
+        :param conf: Configuration object, used for per-function overrides and (if not given explicitly) budgets
+        :param cpus: Total number of cores available (default: [resources] cpus, or all cores)
+        :param mem_mb: Total memory available in MB (default: [resources] mem_mb, or all physical memory)
+        :param state_file: Path to file shared by all schedulers on the node
+        :param poll_interval: Seconds to wait between attempts to acquire resources
+        """
+        self.conf = conf
+        has_section = conf is not None and conf.has_section(SECTION)
+        if cpus is None:
+            cpus = conf.getint(SECTION, 'cpus') if has_section and conf.has_option(SECTION, 'cpus') else multiprocessing.cpu_count()
+        if mem_mb is None:
+            mem_mb = conf.getint(SECTION, 'mem_mb') if has_section and conf.has_option(SECTION, 'mem_mb') else physical_mem_mb()
+        if state_file is None:
+            if has_section and conf.has_option(SECTION, 'state_file'):
+                state_file = conf.get(SECTION, 'state_file')
+            else:
+                state_file = os.path.join(tempfile.gettempdir(), "varcomp-resources.json")
+        self.budget = Resources(cpus, mem_mb)
+        self.state_file = os.path.abspath(state_file)
+        self.poll_interval = poll_interval
+        self.counter = 0
+
+    @contextmanager
+    def _locked_state(self):
+        with open(self.state_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self.state_file):
+                    with open(self.state_file) as fh:
+                        try:
+                            state = json.load(fh)
+                        except ValueError:
+                            state = {}
+                state = dict((k, v) for k, v in state.iteritems() if _pid_alive(v[0]))
+                yield state
+                with open(self.state_file, "w") as fh:
+                    json.dump(state, fh)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, request):
+        """
+        Block until the requested resources are available, then reserve them
+        :param request: Resources tuple
+        :return: Token to pass to release()
+        """
+        self.counter += 1
+        token = str(os.getpid()) + "-" + str(id(self)) + "-" + str(self.counter)
+        waited = False
+        while True:
+            with self._locked_state() as state:
+                used_cpus = sum(v[1] for v in state.itervalues())
+                used_mem = sum(v[2] for v in state.itervalues())
+                if len(state)==0 or (used_cpus + request.cpus <= self.budget.cpus and used_mem + request.mem_mb <= self.budget.mem_mb):
+                    state[token] = [os.getpid(), request.cpus, request.mem_mb]
+                    return token
+            if not waited:
+                logging.info("Waiting for " + str(request.cpus) + " cores / " + str(request.mem_mb) + " MB")
+                waited = True
+            time.sleep(self.poll_interval)
+
+    def release(self, token):
+        with self._locked_state() as state:
+            state.pop(token, None)
+
+    @contextmanager
+    def reserve(self, request):
+        token = self.acquire(request)
+        try:
+            yield request
+        finally:
+            self.release(token)
+
+    def wrap(self, func):
+        """
+        Return a function with the same signature (and attributes) as func that holds a reservation for func's
+        requirements while it runs
+        """
+        request = requirements(func, self.conf)
+
+        @functools.wraps(func)
+        def scheduled(*args, **kwargs):
+            with self.reserve(request):
+                return func(*args, **kwargs)
+
+        return scheduled
+
+    def wrap_all(self, components):
+        """
+        Wrap every function in a dict of name -> function
+        """
+        return dict((name, self.wrap(func)) for name, func in components.iteritems())
+
+
+def scheduler_from_conf(conf):
+    """
+    Create a ResourceScheduler if the configuration contains a [resources] section, otherwise return None
+    """
+    if conf.has_section(SECTION):
+        return ResourceScheduler(conf)
+    return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM #Process exists but belongs to someone else
+    return True
@@ -0,0 +1,20 @@
+"""
+Result strings written for each (variant, caller, normalizer, comparator) cell. Kept free of other imports so that
+tools which only read results (parse_results_json.py and friends) don't have to load the pipeline
+"""
+
+NO_VARS_FOUND_RESULT="No variants identified"
+MATCH_RESULT="Variants matched"
+NO_MATCH_RESULT="Variants did not match"
+MATCH_WITH_EXTRA_RESULT= "Additional false variants present"
+ERROR_RESULT="Error"
+
+#Quality recorded for callers that made no call
+MISSING_QUAL = -1
+
+ZYGOSITY_MATCH="Zygosity match"
+ZYGOSITY_EXTRA_ALLELE="Extra allele"
+ZYGOSITY_MISSING_ALLELE="Missing allele"
+ZYGOSITY_MISSING_TWO_ALLELES="Missing two alleles!"
+
+ALL_RESULT_TYPES = (MATCH_RESULT, NO_MATCH_RESULT, NO_VARS_FOUND_RESULT, MATCH_WITH_EXTRA_RESULT, ZYGOSITY_MISSING_ALLELE, ZYGOSITY_EXTRA_ALLELE, ERROR_RESULT)
@@ -0,0 +1,224 @@
+"""
+Fill in missing or stale results of an earlier run, without simulating or aligning reads again. Given the results
+file of a run and the batch tmpdirs it kept (injectvar.py --keep), this works out which
+(variant, caller, normalizer, comparator) cells are missing from the results or were computed by a tool whose code
+has changed since, runs only the callers, normalizers and comparators needed for them on the kept bams and caller
+outputs, and writes a merged results file:
+
+    python vcomp/resume.py -c comp.conf -r results.json -d tmp-working-* -o merged.json
+
+Adding a new caller to a finished run then only costs the runtime of that caller (plus its normalization and
+comparison). Tools can also be rerun explicitly with --rerun, for instance after fixing something the version
+digests can't see, like an external binary.
+"""
+
+import ConfigParser as cp
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+
+import batch_processor as bp
+import injectvar
+import memo
+import resources
+from vcomp import runner
+
+
+class ResultsMerger(object):
+    """
+    Holds the records of an existing results file, in their original order, and merges new results into them
+    """
+
+    def __init__(self):
+        self.records = OrderedDict()
+        self.comments = []
+
+    def read(self, path):
+        with open(path) as fh:
+            for line in fh:
+                if line.startswith("#"):
+                    self.comments.append(line)
+                elif line.strip():
+                    record = json.loads(line)
+                    self.records[(record["variant"], record.get("scenario"))] = record
+
+    def missing(self, key, caller, normalizer, comparator):
+        try:
+            self.records[key]["results"][caller][normalizer][comparator]
+            return False
+        except KeyError:
+            return True
+
+    def write_output(self, results, quals, bamstats, scenario=None):
+        """
+        Merge results for a batch of input variants, same arguments as injectvar.JsonReporter.write_output
+        """
+        for var, vresults in results.iteritems():
+            key = (var, scenario)
+            if key not in self.records:
+                record = {"variant": var, "caller_quals": {}, "bamstats": bamstats[var], "results": {}}
+                if scenario is not None:
+                    record["scenario"] = scenario
+                self.records[key] = record
+            record = self.records[key]
+            record["caller_quals"].update(quals[var])
+            for caller, cresults in vresults.iteritems():
+                for normalizer, nresults in cresults.iteritems():
+                    record["results"].setdefault(caller, {}).setdefault(normalizer, {}).update(nresults)
+
+    def write_metrics(self, batchname, metrics):
+        self.comments.append("#metrics " + json.dumps({"batch": batchname, "tools": [m._asdict() for m in metrics]}) + "\n")
+
+    def write(self, output):
+        for line in self.comments:
+            output.write(line)
+        for record in self.records.itervalues():
+            json.dump(record, output)
+            output.write("\n")
+
+
+def stale_tools(manifest, kind, versions, rerun):
+    """
+    Names of tools of the given kind whose current version differs from the one recorded in the manifest, or that
+    are to be rerun anyway
+    :param kind: One of 'callers', 'normalizers', 'comparators'
+    :param versions: Dict of current tool versions, see memo.tool_versions
+    :param rerun: Set of tool names to rerun regardless of version
+    """
+    recorded = manifest.get("versions", {}).get(kind, {})
+    return set(name for name, version in versions[kind].iteritems() if name in rerun or (name in recorded and recorded[name] != version))
+
+
+def resume_batch(dirname, processor, merger, versions, rerun, conf):
+    """
+    Compute the missing and stale results of a single kept batch and merge them into the existing results. The
+    manifest of the batch is updated to describe the new caller outputs
+    :param dirname: Batch tmpdir containing a manifest
+    :param processor: VariantProcessor with the selected callers, normalizers and comparators
+    :param merger: ResultsMerger holding the existing results
+    :param versions: Dict of current tool versions, see memo.tool_versions
+    :param rerun: Set of tool names to rerun regardless of version
+    """
+    manifest, samples, variants = bp.read_manifest(dirname)
+    stale = dict((kind, stale_tools(manifest, kind, versions, rerun)) for kind in ("callers", "normalizers", "comparators"))
+    timed_out = set((t["caller"], t["scenario"]) for t in manifest.get("timed_out", []))
+    ref_path = conf.get('main', 'ref_genome')
+    all_callers = processor.callers
+
+    #Callers that never produced output for some sample (new, timed out before, ...) or have changed are rerun
+    rerun_callers = set(stale["callers"])
+    for caller in all_callers:
+        for sample in samples:
+            if (caller, sample.scenario.name) not in variants:
+                rerun_callers.add(caller)
+
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        new_timeouts = []
+        if len(rerun_callers)>0:
+            logging.info("Batch " + dirname + ": running callers " + ", ".join(sorted(rerun_callers)))
+            processor.callers = dict((name, func) for name, func in all_callers.iteritems() if name in rerun_callers)
+            new_variants, new_timeouts = processor.call_variants(samples, ref_path, conf)
+            processor.callers = all_callers
+            for key in [key for key in variants if key[0] in rerun_callers]:
+                del variants[key]
+            variants.update(new_variants)
+            timed_out = set(t for t in timed_out if t[0] not in rerun_callers)
+            timed_out.update(new_timeouts)
+
+        for sample in samples:
+            name = sample.scenario.name
+            regions = bp.region_variants(sample.bed, sample.orig_vcf)
+            sample_variants = dict((caller, vcf) for (caller, sname), vcf in variants.iteritems() if sname == name and caller in all_callers)
+
+            cells = set()
+            for caller in all_callers:
+                for normalizer in processor.normalizers:
+                    for comparator in processor.comparators:
+                        if caller in rerun_callers or normalizer in stale["normalizers"] or comparator in stale["comparators"] or \
+                                any(merger.missing((match_var, name), caller, normalizer, comparator) for _, _, match_var in regions):
+                            cells.add( (caller, normalizer, comparator) )
+            if len(cells)==0:
+                continue
+            logging.info("Batch " + dirname + ": computing " + str(len(cells)) + " caller / normalizer / comparator combinations" + ("" if name is None else " for scenario " + name))
+
+            bam_stats, var_quals = processor.sample_stats(sample, regions, sample_variants)
+            compare_variants = dict((caller, vcf) for caller, vcf in sample_variants.iteritems() if any(c[0] == caller for c in cells))
+            var_results = processor.compare_calls(sample.orig_vcf, sample.bed, regions, compare_variants, conf, cells=cells)
+            for caller, sname in timed_out:
+                if sname == name:
+                    for normalizer in processor.normalizers:
+                        bp.record_errors(var_results, regions, caller, normalizer, bp.selected_comparators(processor.comparators, cells, caller, normalizer))
+            merger.write_output(var_results, var_quals, bam_stats, scenario=name)
+
+        merger.write_metrics(manifest["batch"], runner.drain_metrics())
+
+        #Later resumes should compare against what this one did
+        recorded = manifest.get("versions", {})
+        for kind in ("callers", "normalizers", "comparators"):
+            recorded.setdefault(kind, {}).update(versions[kind])
+        bp.write_manifest(bp.MANIFEST_FILE, manifest["batch"], samples, variants, list(timed_out), recorded)
+    finally:
+        processor.callers = all_callers
+        runner.drain_metrics()
+        os.chdir(cwd)
+
+
+def main(args):
+    conf = cp.SafeConfigParser()
+    conf.read(args.conf)
+
+    callers = injectvar.select_components(conf, 'callers', injectvar.split_names(args.callers))
+    normalizers = injectvar.select_components(conf, 'normalizers', injectvar.split_names(args.normalizers))
+    comparators = injectvar.select_components(conf, 'comparators', injectvar.split_names(args.comparators))
+    versions = memo.tool_versions(callers, normalizers, comparators)
+
+    scheduler = resources.scheduler_from_conf(conf)
+    if scheduler is not None:
+        callers = scheduler.wrap_all(callers)
+        normalizers = scheduler.wrap_all(normalizers)
+        comparators = scheduler.wrap_all(comparators)
+
+    merger = ResultsMerger()
+    merger.read(args.results)
+    processor = bp.VariantProcessor(callers, normalizers, comparators, merger, cache=memo.InvocationCache(), scheduler=scheduler, versions=versions)
+
+    rerun = set(injectvar.split_names(args.rerun) or [])
+    for dirname in args.dirs:
+        if not os.path.exists(os.path.join(dirname, bp.MANIFEST_FILE)):
+            logging.warning("Skipping " + dirname + ", it has no " + bp.MANIFEST_FILE)
+            continue
+        try:
+            resume_batch(dirname, processor, merger, versions, rerun, conf)
+        except Exception as ex:
+            logging.error("Error resuming batch " + dirname + " : " + str(ex))
+
+    output = args.output
+    if type(output) is str:
+        output = open(output, "w")
+    merger.write(output)
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser("Compute missing or stale results of an earlier run from its kept batch directories")
+    parser.add_argument("-c", "--conf", help="Path to configuration file", default="./comp.conf")
+    parser.add_argument("-r", "--results", help="Results file of the earlier run", required=True)
+    parser.add_argument("-d", "--dirs", help="Batch directories kept by the earlier run (with --keep)", nargs="+", required=True)
+    parser.add_argument("-o", "--output", help="Destination for merged results", default=sys.stdout)
+    parser.add_argument("--callers", help="Comma separated list of variant callers to use (default: use all)", action='append')
+    parser.add_argument("--normalizers", help="Comma separated list of normalizers to use (default: use all)", action='append')
+    parser.add_argument("--comparators", help="Comma separated list of comparators to use (default: use all)", action='append')
+    parser.add_argument("--rerun", help="Comma separated list of callers, normalizers or comparators to rerun even if unchanged", action='append')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,185 @@
+"""
+Common runner for the external tools used by callers, normalizers, comparators and alignment. Every child is reaped
+with wait4() so its wall time, user / system cpu time and peak memory use can be recorded, and every tool can be
+given a timeout after which it (and anything it started) is killed.
+
+Timeouts are read from the optional [timeouts] configuration section, keyed by tool name, with an optional
+default:
+
+    [timeouts]
+    default=7200
+    gatk-hc=3600
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+ToolMetrics = namedtuple('ToolMetrics', ['tool', 'command', 'wall', 'user', 'sys', 'maxrss_kb', 'status'])
+
+TIMEOUT_SECTION = 'timeouts'
+
+#Metrics for every tool run by this process since the last call to drain_metrics()
+collected = []
+
+
+class ToolTimeout(Exception):
+
+    def __init__(self, tool, timeout):
+        Exception.__init__(self, tool, timeout)
+        self.tool = tool
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Tool " + str(self.tool) + " did not finish within " + str(self.timeout) + " seconds"
+
+
+def drain_metrics():
+    """
+    Return metrics collected so far and start a fresh collection
+    :return: List of ToolMetrics
+    """
+    global collected
+    metrics = collected
+    collected = []
+    return metrics
+
+
+def tool_name(cmd):
+    """
+    Derive a short tool name from a command (the basename of the executable, or of the jar for java commands)
+    """
+    toks = cmd.split() if isinstance(cmd, basestring) else list(cmd)
+    if len(toks)==0:
+        return "?"
+    name = os.path.basename(toks[0])
+    if name == "java" and "-jar" in toks and toks.index("-jar") < len(toks)-1:
+        name = os.path.basename(toks[toks.index("-jar")+1])
+    return name
+
+
+def timeout_for(tool, conf):
+    """
+    Look up the timeout in seconds for the given tool, returning None if there isn't one
+    """
+    if conf is None or not conf.has_section(TIMEOUT_SECTION):
+        return None
+    for key in (tool, 'default'):
+        if conf.has_option(TIMEOUT_SECTION, key):
+            return conf.getfloat(TIMEOUT_SECTION, key)
+    return None
+
+
+def start(cmd, shell=False, **kwargs):
+    """
+    Start a command in its own process group (so that the whole group can be killed on timeout)
+    :return: subprocess.Popen object
+    """
+    return subprocess.Popen(cmd, shell=shell, preexec_fn=os.setsid, **kwargs)
+
+
+def wait(proc, cmd, tool, deadline=None, started=None):
+    """
+    Wait for a process started with start() to finish, record its metrics, and return its exit status. Without a
+    deadline this blocks until the process exits. If the deadline (as given by time.time()) passes first, the
+    process group is killed and ToolTimeout is raised
+    """
+    if started is None:
+        started = time.time()
+    if deadline is None:
+        pid, status, usage = os.wait4(proc.pid, 0)
+        _record(proc, cmd, tool, started, status, usage)
+        return proc.returncode
+    delay = 0.01
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            kill(proc)
+            pid, status, usage = os.wait4(proc.pid, 0)
+            _record(proc, cmd, tool, started, status, usage, "timeout")
+            raise ToolTimeout(tool, round(deadline - started, 1))
+        #Never sleep past the deadline
+        time.sleep(min(delay, remaining))
+        delay = min(delay*2, 1.0)
+    _record(proc, cmd, tool, started, status, usage)
+    return proc.returncode
+
+
+def kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _record(proc, cmd, tool, started, status, usage, outcome=None):
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if outcome is None:
+        outcome = "ok" if proc.returncode==0 else "failed"
+    command = cmd if isinstance(cmd, basestring) else " ".join(cmd)
+    collected.append(ToolMetrics(tool, command, round(time.time()-started, 3), usage.ru_utime, usage.ru_stime, usage.ru_maxrss, outcome))
+
+
+def call(cmd, conf=None, tool=None, shell=False, timeout=None, **kwargs):
+    """
+    Run the command and return its exit status, recording metrics along the way. The timeout defaults to the
+    configured timeout for the tool
+    :param cmd: Command string (with shell=True) or argument list
+    :param conf: Configuration object
+    :param tool: Tool name used for metrics and timeout lookup (default: derived from the command)
+    :return: Exit status
+    """
+    if tool is None:
+        tool = tool_name(cmd)
+    if timeout is None:
+        timeout = timeout_for(tool, conf)
+    started = time.time()
+    proc = start(cmd, shell=shell, **kwargs)
+    deadline = started + timeout if timeout is not None else None
+    return wait(proc, cmd, tool, deadline=deadline, started=started)
+
+
+def check_call(cmd, conf=None, tool=None, shell=False, timeout=None, **kwargs):
+    """
+    Like subprocess.check_call, but with metrics and timeouts (see call())
+    """
+    status = call(cmd, conf=conf, tool=tool, shell=shell, timeout=timeout, **kwargs)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd)
+    return 0
+
+
+def check_output(cmd, conf=None, tool=None, shell=False, timeout=None, **kwargs):
+    """
+    Like subprocess.check_output, but with metrics and timeouts (see call())
+    """
+    if tool is None:
+        tool = tool_name(cmd)
+    if timeout is None:
+        timeout = timeout_for(tool, conf)
+    started = time.time()
+    proc = start(cmd, shell=shell, stdout=subprocess.PIPE, **kwargs)
+
+    #Read output on another thread so that we can keep polling for the process exiting (or timing out)
+    chunks = []
+    reader = threading.Thread(target=lambda: chunks.append(proc.stdout.read()))
+    reader.daemon = True
+    reader.start()
+    deadline = started + timeout if timeout is not None else None
+    try:
+        status = wait(proc, cmd, tool, deadline=deadline, started=started)
+    finally:
+        reader.join(1.0 if deadline is not None and time.time() > deadline else None)
+    output = "".join(chunks)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd, output=output)
+    return output
@@ -0,0 +1,212 @@
+"""
+Sequential sampling of input variants. When the goal is an estimate of caller accuracy for each class of variant
+(SNPs, insertions and deletions in each size bin, see parse_results_json.get_vartype), there's no need to process
+every variant in a large input. This runs injectvar in rounds: each round draws a random sample of the not yet used
+variants of every class that hasn't converged, processes them, and updates the match rate of every caller in every
+class. A class stops being sampled once the confidence intervals of all callers' match rates are narrower than the
+target width. Usage is the same as injectvar.py, with a few extra options:
+
+    python vcomp/sampling.py -v my_variants.vcf --het --target-width 0.1 --round-size 100 > my_output.txt
+
+The output contains the results of all variants used, plus a '#sampling' comment line after each round recording the
+number of variants used and available, the widest interval and whether sampling has stopped, for every class.
+"""
+
+import ConfigParser as cp
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+from collections import defaultdict
+
+import batch_processor as bp
+import injectvar
+import memo
+import parse_results_json
+import stats
+
+
+class SamplingReporter(injectvar.JsonReporter):
+    """
+    Writes results as json like JsonReporter, and counts the results of one normalizer / comparator combination for
+    every class of variant and caller
+    """
+
+    def __init__(self, outputfile, normalizer, comparator):
+        super(SamplingReporter, self).__init__(outputfile)
+        self.normalizer = normalizer
+        self.comparator = comparator
+        #class -> caller -> [matches, total]
+        self.counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+
+    def write_output(self, results, quals, bamstats, scenario=None):
+        super(SamplingReporter, self).write_output(results, quals, bamstats, scenario=scenario)
+        for var, vresults in results.iteritems():
+            vclass = parse_results_json.get_vartype(var)
+            for caller, caller_results in vresults.iteritems():
+                try:
+                    result = caller_results[self.normalizer][self.comparator]
+                except KeyError:
+                    continue
+                counts = self.counts[vclass][caller]
+                counts[1] += 1
+                if result == bp.MATCH_RESULT:
+                    counts[0] += 1
+
+    def widest_interval(self, vclass, confidence):
+        """
+        Width of the widest confidence interval of a caller's match rate in the given class, or None if there are no
+        results for it yet
+        """
+        callers = self.counts[vclass]
+        if len(callers)==0:
+            return None
+        successes = [c[0] for c in callers.itervalues()]
+        trials = [c[1] for c in callers.itervalues()]
+        lower, upper = stats.binomial_interval(successes, trials, confidence)
+        return float(max(upper - lower))
+
+
+class VcfSampler(object):
+    """
+    Holds the records of the input vcf, grouped by class and shuffled, and writes samples of them to new vcfs
+    """
+
+    def __init__(self, path):
+        self.header = []
+        self.records = []
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path) as fh:
+            for line in fh:
+                if line.startswith("#"):
+                    self.header.append(line)
+                elif len(line.strip())>0:
+                    self.records.append(line)
+
+        self.remaining = defaultdict(list)
+        for i, line in enumerate(self.records):
+            self.remaining[record_class(line)].append(i)
+        for indices in self.remaining.itervalues():
+            random.shuffle(indices)
+        self.available = dict((vclass, len(indices)) for vclass, indices in self.remaining.iteritems())
+
+    def draw(self, vclass, count):
+        """
+        Remove and return up to count random, not yet used record indices of the given class
+        """
+        drawn = self.remaining[vclass][0:count]
+        self.remaining[vclass] = self.remaining[vclass][count:]
+        return drawn
+
+    def write(self, indices, path):
+        """
+        Write the records with the given indices to a vcf, in their original order
+        """
+        with open(path, "w") as fh:
+            fh.writelines(self.header)
+            for i in sorted(indices):
+                fh.write(self.records[i])
+        return path
+
+
+def record_class(line):
+    """
+    Class of the variant in a vcf line, as assigned by parse_results_json.get_vartype to its results
+    """
+    return parse_results_json.get_vartype(" ".join(line.split()[0:5]))
+
+
+def sample_vcf(vcf, gt_default, conf, output, args, snp_info=None, scenarios=None, components=None, cache=None):
+    """
+    Process variants from the vcf in rounds until the match rate of every caller in every class of variant is known
+    well enough, or the variants run out
+    :param args: Parsed command line arguments (as for injectvar.main, plus the sampling options)
+    :return: Dict of class -> number of variants used
+    """
+    sampler = VcfSampler(vcf)
+    reporter = SamplingReporter(output, args.ci_normalizer, args.ci_comparator)
+    active = set(sampler.available)
+    used = defaultdict(int)
+    widths = {}
+    round_num = 0
+    while len(active)>0:
+        round_num += 1
+        indices = []
+        for vclass in sorted(active):
+            drawn = sampler.draw(vclass, args.round_size)
+            used[vclass] += len(drawn)
+            indices.extend(drawn)
+        if len(indices)==0:
+            break
+
+        logging.info("Sampling round " + str(round_num) + ": processing " + str(len(indices)) + " variants from " + str(len(active)) + " classes")
+        round_vcf = sampler.write(indices, os.path.abspath("sampling-round-" + str(round_num) + ".vcf"))
+        injectvar.process_vcf(round_vcf, gt_default, conf, output, injectvar.split_names(args.callers), normalizers=injectvar.split_names(args.normalizers), comparators=injectvar.split_names(args.comparators), snp_info=snp_info, keep_tmpdir=args.keep, read_depth=args.readdepth, memoize=not args.no_memo, fast_path=args.fast_path, audit_fraction=args.audit_fraction, shards=args.shards, scenarios=scenarios, components=components, cache=cache, reporter=reporter)
+        os.remove(round_vcf)
+
+        for vclass in sorted(active):
+            widths[vclass] = reporter.widest_interval(vclass, args.confidence)
+            exhausted = len(sampler.remaining[vclass])==0
+            converged = used[vclass] >= args.min_variants and widths[vclass] is not None and widths[vclass] <= args.target_width
+            if exhausted or converged:
+                logging.info("Stopped sampling " + vclass + " after " + str(used[vclass]) + " of " + str(sampler.available[vclass]) + " variants" + (" (converged)" if converged else ""))
+                active.discard(vclass)
+
+        summary = dict((vclass, {"used": used[vclass], "available": sampler.available[vclass], "width": widths.get(vclass), "active": vclass in active}) for vclass in sampler.available)
+        output.write("#sampling " + json.dumps({"round": round_num, "classes": summary}) + "\n")
+        output.flush()
+    return dict(used)
+
+
+def main(args):
+    conf = cp.SafeConfigParser()
+    conf.read(args.conf)
+
+    if type(args.output) is str:
+        args.output = open(args.output, "w")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.fqs or args.generate_fqs or args.batch or args.columnar or args.sqlite:
+        raise ValueError('Sampling can not be used with --fqs, --generate-fqs, --batch, --columnar or --sqlite')
+
+    gt_default, snp_inf, scenarios = injectvar.simulation_options(args)
+    components = injectvar.load_all_components(conf)
+    #Match rates are only known for the normalizer and comparator they are taken from, if those don't run no class
+    #would ever converge
+    normalizers = injectvar.choose_components(components[1], injectvar.split_names(args.normalizers), 'normalizers')
+    comparators = injectvar.choose_components(components[2], injectvar.split_names(args.comparators), 'comparators')
+    if args.ci_normalizer not in normalizers:
+        raise ValueError('Normalizer ' + args.ci_normalizer + ' given by --ci-normalizer is not among the normalizers run: ' + ", ".join(sorted(normalizers)))
+    if args.ci_comparator not in comparators:
+        raise ValueError('Comparator ' + args.ci_comparator + ' given by --ci-comparator is not among the comparators run: ' + ", ".join(sorted(comparators)))
+    cache = memo.InvocationCache() if not args.no_memo else None
+    for vcf in args.vcf:
+        logging.info("Sampling variants from vcf file " + vcf)
+        used = sample_vcf(vcf, gt_default, conf, args.output, args, snp_info=snp_inf, scenarios=scenarios, components=components, cache=cache)
+        logging.info("Used " + str(sum(used.values())) + " variants from " + vcf)
+
+    try:
+        args.output.close()
+    except:
+        pass
+
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser("Inject, simulate, call, compare until accuracy estimates converge", parents=[injectvar.make_parser()], conflict_handler='resolve')
+    parser.add_argument("--target-width", help="Stop sampling a class of variants once the confidence intervals of all callers' match rates are narrower than this (default 0.1)", default=0.1, type=float)
+    parser.add_argument("--round-size", help="Number of variants of each class to process per round (default 100)", default=100, type=int)
+    parser.add_argument("--min-variants", help="Minimum number of variants of a class to process before it can converge (default 50)", default=50, type=int)
+    parser.add_argument("--confidence", help="Confidence level of intervals (default 0.95)", default=0.95, type=float)
+    parser.add_argument("--ci-normalizer", help="Normalizer whose results are used for match rates (default nonorm)", default=parse_results_json.NO_NORM)
+    parser.add_argument("--ci-comparator", help="Comparator whose results are used for match rates (default vgraph)", default=parse_results_json.VGRAPH)
+    args = parser.parse_args()
+
+    main(args)
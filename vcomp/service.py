@@ -0,0 +1,230 @@
+"""
+Long running varcomp service. Starting injectvar for every small VCF means importing and loading all plugins,
+opening the reference and building an empty memoization cache each time, and for small jobs this startup work is
+a large part of the total. A service started with
+
+    python service.py serve -c comp.conf --socket /tmp/varcomp.sock
+
+does all of this once and then accepts jobs over a UNIX socket, one at a time. Jobs are submitted with
+
+    python service.py submit --socket /tmp/varcomp.sock -v input.vcf [injectvar options...]
+
+which takes the same options as injectvar.py and writes the same output, streamed back from the service as each
+batch completes. Normalizer and comparator results are memoized across all jobs handled by a service.
+
+Protocol: the client sends a single line containing a json object of injectvar option values. The service replies
+with the usual injectvar output lines followed by a final line '#status {json}', where the json object has keys
+'ok', 'error' and 'seconds'.
+"""
+
+import ConfigParser as cp
+import SocketServer
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import time
+import traceback
+
+import injectvar
+import memo
+import util
+from vcomp import runner
+
+STATUS_PREFIX = "#status "
+
+#Options that only make sense for a local injectvar run, they can't be part of a job
+CLIENT_ONLY_OPTIONS = ('conf', 'output', 'socket')
+
+
+class VarcompService(object):
+    """
+    Holds everything that can be reused across jobs: configuration, loaded plugins and the memoization cache
+    """
+
+    def __init__(self, conf, bwa_shm=False):
+        """
+        :param conf: Configuration object
+        :param bwa_shm: Load the bwa index of the reference into shared memory for as long as the service runs
+        """
+        self.conf = conf
+        self.components = injectvar.load_all_components(conf)
+        self.cache = memo.InvocationCache()
+        self.bwa_shm = bwa_shm
+        self.jobs = 0
+
+        ref = conf.get('main', 'ref_genome')
+        util.get_fasta(ref)
+        if self.bwa_shm:
+            runner.check_call([conf.get('main', 'bwa_path'), 'shm', ref], conf, tool="bwa-shm")
+        logging.info("Service ready with callers: " + ", ".join(sorted(self.components[0])))
+
+    def close(self):
+        if self.bwa_shm:
+            runner.call([self.conf.get('main', 'bwa_path'), 'shm', '-d'], self.conf, tool="bwa-shm")
+        self.cache.log_stats()
+
+    def job_args(self, options):
+        """
+        Turn the option values sent by a client into an argparse namespace, as injectvar.main would see it
+        :param options: Dict of option values, keyed by injectvar argument dest
+        """
+        args = injectvar.make_parser().parse_args([])
+        for key, value in options.iteritems():
+            if key in CLIENT_ONLY_OPTIONS:
+                continue
+            if not hasattr(args, key):
+                raise ValueError("Unknown option " + key)
+            setattr(args, key, value)
+        if not args.vcf:
+            raise ValueError("No input vcf given")
+        if args.generate_fqs or args.columnar or args.sqlite:
+            raise ValueError("--generate-fqs, --columnar and --sqlite are not supported by the service, use injectvar.py")
+        return args
+
+    def run_job(self, options, output):
+        """
+        Process a single job, writing results to output
+        :param options: Dict of option values, keyed by injectvar argument dest
+        :param output: File-like object to which formatted output will be written
+        """
+        args = self.job_args(options)
+        if args.seed is not None:
+            random.seed(args.seed)
+        gt_default, snp_inf, scenarios = injectvar.simulation_options(args)
+        self.jobs += 1
+        for vcf in args.vcf:
+            logging.info("Job " + str(self.jobs) + ": processing vcf file " + vcf)
+            injectvar.process_vcf(vcf, gt_default, self.conf, output, injectvar.split_names(args.callers), normalizers=injectvar.split_names(args.normalizers), comparators=injectvar.split_names(args.comparators), fqs=args.fqs, snp_info=snp_inf, single_batch=args.batch, keep_tmpdir=args.keep, read_depth=args.readdepth, memoize=not args.no_memo, fast_path=args.fast_path, audit_fraction=args.audit_fraction, shards=args.shards, scenarios=scenarios, components=self.components, cache=self.cache)
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads one job from the connection, streams its output back and finishes with a status line
+    """
+
+    def handle(self):
+        service = self.server.service
+        started = time.time()
+        status = {"ok": True, "error": None}
+        cwd = os.getcwd()
+        try:
+            options = json.loads(self.rfile.readline())
+            service.run_job(options, self.wfile)
+        except Exception as ex:
+            logging.error("Job failed: " + str(ex))
+            logging.error(traceback.format_exc())
+            status = {"ok": False, "error": str(ex)}
+        finally:
+            #Failed jobs may leave us in a tmpdir
+            os.chdir(cwd)
+        status["seconds"] = time.time() - started
+        try:
+            self.wfile.write(STATUS_PREFIX + json.dumps(status) + "\n")
+            self.wfile.flush()
+        except socket.error:
+            logging.warning("Client went away before job finished")
+
+
+class VarcompServer(SocketServer.UnixStreamServer):
+    """
+    Handles jobs one at a time (each job already uses as many resources as the configuration allows)
+    """
+
+    def __init__(self, socket_path, service):
+        self.service = service
+        SocketServer.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+
+def serve(args):
+    conf = cp.SafeConfigParser()
+    conf.read(args.conf)
+    if args.workdir is not None:
+        os.chdir(args.workdir)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    service = VarcompService(conf, bwa_shm=args.bwa_shm)
+    server = VarcompServer(args.socket, service)
+    logging.info("Listening on " + args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        os.remove(args.socket)
+
+
+def submit(args):
+    """
+    Send a job to a running service and copy its output to args.output
+    :return: True if the job completed successfully
+    """
+    options = {}
+    for key, value in vars(args).iteritems():
+        if key in CLIENT_ONLY_OPTIONS or key == 'command':
+            continue
+        options[key] = value
+    #The service doesn't share our working directory
+    options['vcf'] = [os.path.abspath(vcf) for vcf in args.vcf]
+    if args.fqs is not None:
+        options['fqs'] = [os.path.abspath(fq) for fq in args.fqs]
+
+    output = args.output
+    if type(output) is str:
+        output = open(output, "w")
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(args.socket)
+    conn.sendall(json.dumps(options) + "\n")
+    status = None
+    for line in conn.makefile("r"):
+        if line.startswith(STATUS_PREFIX):
+            status = json.loads(line[len(STATUS_PREFIX):])
+            break
+        output.write(line)
+        output.flush()
+    conn.close()
+    if output is not sys.stdout:
+        output.close()
+
+    if status is None:
+        logging.error("Connection to service closed before job completed")
+        return False
+    if not status["ok"]:
+        logging.error("Job failed: " + str(status["error"]))
+        return False
+    logging.info("Job completed in %.1f seconds" % status["seconds"])
+    return True
+
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser("Long running varcomp service")
+    commands = parser.add_subparsers(dest="command")
+
+    serve_parser = commands.add_parser("serve", help="Start the service")
+    serve_parser.add_argument("-c", "--conf", help="Path to configuration file", default="./comp.conf")
+    serve_parser.add_argument("--socket", help="Path of UNIX socket to listen on", required=True)
+    serve_parser.add_argument("--workdir", help="Working directory of the service", default=None)
+    serve_parser.add_argument("--bwa-shm", help="Keep the bwa index of the reference in shared memory while running", action='store_true')
+
+    submit_parser = commands.add_parser("submit", help="Submit a job to a running service", parents=[injectvar.make_parser()], add_help=False, conflict_handler='resolve')
+    submit_parser.add_argument("--socket", help="Path of UNIX socket the service listens on", required=True)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        if not args.vcf:
+            parser.error("At least one input vcf is required")
+        if not submit(args):
+            sys.exit(1)
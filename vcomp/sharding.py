@@ -0,0 +1,109 @@
+"""
+Run a variant caller over several shards of a bed file at once. Regions in a batch are independent by construction
+(see util.batch_variants), so any caller can be run separately on disjoint subsets of them and the resulting
+vcfs merged without changing the result.
+"""
+
+import logging
+import multiprocessing
+import os
+import traceback
+
+import util
+from vcomp import runner
+
+
+class ShardedCaller(object):
+    """
+    Wraps a variant caller function so that it is executed concurrently over a number of shards of the bed file,
+    each in its own working directory. The wrapper has the same signature and contract as the caller itself: it
+    returns the path to a single bgzipped, indexed vcf.
+    """
+
+    def __init__(self, caller, shards):
+        """
+        :param caller: Variant caller function, taking (bam, orig_genome_path, bed, conf)
+        :param shards: Maximum number of shards to split the bed file into
+        """
+        self.caller = caller
+        self.shards = shards
+        self.__name__ = getattr(caller, '__name__', 'sharded_caller')
+        self.multisample = util.is_multisample_caller(caller)
+
+    def __call__(self, bam, orig_genome_path, bed, conf=None):
+        regions = list(util.read_regions(bed))
+        shards = min(self.shards, len(regions))
+        if shards < 2:
+            return self.caller(bam, orig_genome_path, bed, conf)
+
+        bam = os.path.abspath(bam)
+        orig_genome_path = os.path.abspath(orig_genome_path)
+        queue = multiprocessing.Queue()
+        procs = []
+        for i, shard in enumerate(split_regions(regions, shards)):
+            shard_dir = os.path.abspath("shard-" + str(i) + "-" + util.randstr())
+            os.mkdir(shard_dir)
+            shard_bed = os.path.abspath(os.path.join(shard_dir, "shard.bed"))
+            with open(shard_bed, "w") as fh:
+                for region in shard:
+                    fh.write("\t".join([region.chr, str(region.start), str(region.end)]) + "\n")
+            proc = multiprocessing.Process(target=_run_shard, args=(self.caller, bam, orig_genome_path, shard_bed, conf, shard_dir, i, queue))
+            proc.start()
+            procs.append(proc)
+
+        #Drain the queue before joining so that children never block on a full pipe
+        outputs = {}
+        errors = []
+        timeout = None
+        for _ in procs:
+            i, vcf, err, metrics = queue.get()
+            runner.collected.extend(metrics)
+            if isinstance(err, runner.ToolTimeout):
+                timeout = err
+            elif err is not None:
+                errors.append("Shard " + str(i) + ": " + err)
+            else:
+                outputs[i] = vcf
+        for proc in procs:
+            proc.join()
+
+        if timeout is not None:
+            raise timeout
+        if len(errors)>0:
+            raise ValueError('Error running sharded variant caller ' + self.__name__ + ":\n" + "\n".join(errors))
+
+        logging.info("Merging output from " + str(len(outputs)) + " shards of " + self.__name__)
+        return util.merge_vcfs([outputs[i] for i in sorted(outputs)], "output-sharded-" + util.randstr() + ".vcf", conf)
+
+
+def split_regions(regions, shards):
+    """
+    Split the list of regions into the given number of contiguous, nearly equal sized chunks
+    :param regions: List of regions
+    :param shards: Number of chunks to create
+    :return: List of lists of regions
+    """
+    chunks = []
+    start = 0
+    for i in range(shards):
+        end = start + (len(regions) - start) / (shards - i)
+        chunks.append(regions[start:end])
+        start = end
+    return [c for c in chunks if len(c)>0]
+
+
+def _run_shard(caller, bam, orig_genome_path, bed, conf, shard_dir, index, queue):
+    """
+    Executed in a child process: run the caller on a single shard and report the (absolute) path of its output,
+    along with the metrics of the tools it ran
+    """
+    #Metrics collected by the parent before the fork are the parent's to report
+    runner.drain_metrics()
+    try:
+        os.chdir(shard_dir)
+        vcf = caller(bam, orig_genome_path, bed, conf)
+        queue.put( (index, os.path.abspath(vcf), None, runner.drain_metrics()) )
+    except runner.ToolTimeout as ex:
+        queue.put( (index, None, ex, runner.drain_metrics()) )
+    except Exception:
+        queue.put( (index, None, traceback.format_exc(), runner.drain_metrics()) )
@@ -1,35 +1,41 @@
 import os
-import subprocess
 from collections import defaultdict
 
 import pysam
 
 import read_simulator as rs
 import vcomp.util as util
+import vcomp.geometry as geometry
+import vcomp.resources as resources
+import vcomp.runner as runner
 
 ALL_HETS="all hets"
 CIS = "cis"
 TRANS = "trans"
 ALL_HOMS="all homs"
+PHASED="phased"
 
-def gen_alt_genome(chrom, pvars, orig_genome_path, dest_filename, overwrite=False, window_size=2000):
+#Sample name given to simulated reads, unless a scenario name is used instead
+DEFAULT_SAMPLE="sample"
+
+def gen_alt_genome(chrom, pvars, orig_genome_path, dest_filename, overwrite=False, window_size=None, geom=geometry.DEFAULT_GEOMETRY):
     """
     Generate a new genome fasta that contains the given variant
     :param variant: Tuple of (chr, pos, ref, alt)
     :param orig_genome_path:
     :param dest_filename:
     :param overwrite: OK to overwrite existing dest_filename
-    :param window_size: Number of ref genome bases to include
+    :param window_size: Number of ref genome bases to include (default: determined by the geometry from the span
+    of the variants)
+    :param geom: WindowGeometry used to size the window
     :return: Length of genome created
     """
     if os.path.exists(dest_filename) and not overwrite:
         raise ValueError("Destination " + dest_filename + " exists and overwrite is set to False")
 
     pvars = sorted(pvars, key=lambda x: x[0], reverse=True)
-    ref_genome = pysam.FastaFile(orig_genome_path)
-    mod_var_start = pvars[0][0] + 1 #Start position of first variant
-    window_start = mod_var_start-window_size/2
-    window_end = mod_var_start+window_size/2
+    ref_genome = util.get_fasta(orig_genome_path)
+    window_start, window_end = alt_window(pvars, window_size, geom)
     seq = ref_genome.fetch(chrom, window_start, window_end)
     newseq = seq
 
@@ -48,15 +54,46 @@ def gen_alt_genome(chrom, pvars, orig_genome_path, dest_filename, overwrite=Fals
     dest_index.close()
     return len(newseq)
 
-def generate_reads(alt_genome_path, chr, pos, read_count=250, prefix="test-reads", read1_fh=None, read2_fh=None):
+def alt_window(pvars, window_size=None, geom=geometry.DEFAULT_GEOMETRY):
+    """
+    Reference window that an alternate genome for the given haplotype is built from, centered on the start of the
+    last variant
+    :param pvars: List of (start, ref, alt) tuples
+    :param window_size: Number of ref genome bases to include (default: determined by the geometry)
+    :return: Tuple of window start, window end
+    """
+    mod_var_start = max(start for start, ref, alt in pvars) + 1
+    if window_size is None:
+        span = max(start + len(ref) for start, ref, alt in pvars) - min(start for start, ref, alt in pvars)
+        window_size = geom.window_size(span)
+    return mod_var_start-window_size/2, mod_var_start+window_size/2
+
+def alt_position(pvars, window_start, pos):
+    """
+    Translate a reference position into a position in the alternate genome built from the given haplotype
+    :param pvars: List of (start, ref, alt) tuples
+    :param window_start: Start of the reference window the alternate genome was built from
+    :param pos: Reference position
+    :return: Offset in alternate genome
+    """
+    shift = sum(len(alt) - len(ref) for start, ref, alt in pvars if start < pos)
+    return pos - window_start + shift
+
+def generate_reads(alt_genome_path, chr, pos, read_count=250, prefix="test-reads", read1_fh=None, read2_fh=None, geom=geometry.DEFAULT_GEOMETRY):
     """
     Generate reads in fastq format from the altered genome, return paths to the files generated
     :param alt_genome_path:
     :param read_count: Total number of read pairs to generate
     :param prefix: filename prefix for output files
+    :param geom: WindowGeometry describing template size and position distributions
     :return: Paths to two fastq files containing reads
     """
-    generator = rs.ReadSimulator(alt_genome_path, chr, pos)
+    generator = rs.ReadSimulator(alt_genome_path, chr, pos,
+                                 mean_template_size=geom.mean_template_size,
+                                 stdev_template_size=geom.stdev_template_size,
+                                 read_len=geom.read_len,
+                                 target_pos_stdev=geom.pos_stdev,
+                                 flanking_bases=geom.reach() + geom.margin)
     r1_filename = prefix + "_R1.fastq"
     r2_filename = prefix + "_R2.fastq"
     close = False
@@ -77,14 +114,15 @@ def generate_reads(alt_genome_path, chr, pos, read_count=250, prefix="test-reads
     return (r1_filename, r2_filename)
 
 
-def create_bam(ref_genome, reads1, reads2, bwapath, samtoolspath):
+def create_bam(ref_genome, reads1, reads2, bwapath, samtoolspath, threads=1, conf=None, geom=geometry.DEFAULT_GEOMETRY, sample=DEFAULT_SAMPLE):
     dest = reads1.replace("_1.fq", "") + ".bam"
-    cmd = bwapath + " mem " + " -I 250.0,50,500 -R \'" + "\t".join(['@RG', 'ID:test', 'SM:sample', 'PL:Illumina']) + "\' " + ref_genome + " " + reads1 + " " + reads2 + " | " + samtoolspath + " sort -T sorttmp -O bam - > " + dest + "\n" + samtoolspath + " index " + dest + "\n"
+    insert_size = ",".join([str(float(geom.mean_template_size)), str(geom.stdev_template_size), str(2*geom.mean_template_size)])
+    cmd = bwapath + " mem -t " + str(threads) + " -I " + insert_size + " -R \'" + "\t".join(['@RG', 'ID:' + ('test' if sample == DEFAULT_SAMPLE else sample), 'SM:' + sample, 'PL:Illumina']) + "\' " + ref_genome + " " + reads1 + " " + reads2 + " | " + samtoolspath + " sort -@ " + str(threads) + " -T sorttmp -O bam - > " + dest + "\n" + samtoolspath + " index " + dest + "\n"
     script_path = "./align.sh"
     with open(script_path, "w") as script_fh:
         script_fh.write(cmd)
     os.chmod(script_path, 0755)
-    subprocess.check_call(script_path, shell=True)
+    runner.check_call(script_path, conf, tool="align", shell=True)
     return dest
 
 def gen_bam_stats(bamfile, region=None):
@@ -154,6 +192,14 @@ def collect_alts(vset):
                     hap2.append( (var.start, var.ref, alt) )
                     hap1.append( (var.start, var.ref, var.ref) )
                 first = not first
+        elif policy == PHASED:
+            #Alleles are placed according to the variant's own genotype, first allele on hap1 and second on hap2
+            alleles = [var.ref] + list(var.alts)
+            gt = var.gt.replace('|', '/').split('/')
+            if len(gt) != 2:
+                raise ValueError('Cant handle haploid / polyploid variants')
+            hap1.append( (var.start, var.ref, alleles[int(gt[0])]) )
+            hap2.append( (var.start, var.ref, alleles[int(gt[1])]) )
         elif policy == ALL_HETS:
             if len(var.alts)==1:
                 hap1.append( (var.start, var.ref, var.alts[0]) )
@@ -168,13 +214,30 @@ def collect_alts(vset):
 
     return hap1, hap2
 
-def gen_alt_fq(ref_path, variant_sets, read_count, dest_prefix="input"):
+def read_centers(vset, hap, alt_genome_size, geom=geometry.DEFAULT_GEOMETRY):
+    """
+    Positions in an alternate genome around which reads should be simulated. Reads for most variant sets are
+    centered on the middle of the alternate genome, but clusters of variants get a full set of reads centered on
+    each variant in the cluster (so regions between nearby variants in a cluster get extra coverage)
+    :param vset: Variant set
+    :param hap: Haplotype the alternate genome was built from
+    :param alt_genome_size: Length of the alternate genome
+    :return: List of positions
+    """
+    if not vset.get('cluster', False):
+        return [alt_genome_size / 2]
+    window_start = alt_window(hap, geom=geom)[0]
+    return [alt_position(hap, window_start, var.start) for var in vset['vars']]
+
+def gen_alt_fq(ref_path, variant_sets, read_count, dest_prefix="input", geom=geometry.DEFAULT_GEOMETRY):
     """
     Generate a batch of simulated reads independently for the variants in each variant_set
-    Each set contains a list of variants and a policy describing cis / trans configuration
+    Each set contains a list of variants and a policy describing cis / trans configuration. Clusters of nearby
+    input variants are simulated jointly, on the haplotypes given by their genotypes
     :param ref_path: Path to reference fasta
     :param variant_sets: List of sets of variants to inject into reference
     :param read_count:
+    :param geom: WindowGeometry used to size alternate genomes and simulate reads
     :return:
     """
     reads1 = dest_prefix + "_r1.fq"
@@ -185,37 +248,49 @@ def gen_alt_fq(ref_path, variant_sets, read_count, dest_prefix="input"):
         chrom = vset['vars'][0].chrom
         hap1, hap2 = collect_alts(vset)
 
-        alt_genome_path = 'alt_genome' + util.randstr() + '.fa'
-        alt_genome_size = gen_alt_genome(chrom, hap1, ref_path, alt_genome_path, overwrite=True)
-        generate_reads(alt_genome_path, chrom, alt_genome_size / 2, read_count=read_count / 2, read1_fh=read1_fh, read2_fh=read2_fh)
-        os.remove(alt_genome_path)
-        os.remove(alt_genome_path + ".fai")
-
-        alt_genome_path = 'alt_genome' + util.randstr() + '.fa'
-        alt_genome_size = gen_alt_genome(chrom, hap2, ref_path, alt_genome_path, overwrite=True)
-        generate_reads(alt_genome_path, chrom, alt_genome_size / 2, read_count=read_count / 2, read1_fh=read1_fh, read2_fh=read2_fh)
-        os.remove(alt_genome_path)
-        os.remove(alt_genome_path + ".fai")
+        for hap in (hap1, hap2):
+            alt_genome_path = 'alt_genome' + util.randstr() + '.fa'
+            alt_genome_size = gen_alt_genome(chrom, hap, ref_path, alt_genome_path, overwrite=True, geom=geom)
+            for center in read_centers(vset, hap, alt_genome_size, geom):
+                generate_reads(alt_genome_path, chrom, center, read_count=read_count / 2, read1_fh=read1_fh, read2_fh=read2_fh, geom=geom)
+            os.remove(alt_genome_path)
+            os.remove(alt_genome_path + ".fai")
 
     read1_fh.close()
     read2_fh.close()
     return (reads1, reads2)
 
-def gen_alt_bam(ref_path, conf, reads):
+@resources.requires(cpus=4, mem_mb=6144)
+def gen_alt_bam(ref_path, conf, reads, sample=DEFAULT_SAMPLE):
     """
     Align reads to reference, sort them, and generate an indexed .bam file. This assumes
     BWA, but we should allow this to be defined in a configuration.
     :param ref_path: Path to reference genome
     :param conf: Configuration containing paths to BWA, samtools, etc
     :param reads: Paths to reads to align (assumes paired-end)
+    :param sample: Sample name (and read group ID) for the reads
     :return: Path to bam file
     """
     #TODO: Allow different alignment tools
     reads1, reads2 = reads
-    bam = create_bam(ref_path, reads1, reads2, conf.get('main', 'bwa_path'), conf.get('main', 'samtools_path'))
+    bam = create_bam(ref_path, reads1, reads2, conf.get('main', 'bwa_path'), conf.get('main', 'samtools_path'), threads=resources.threads(gen_alt_bam, conf), conf=conf, sample=sample)
     verify_reads(reads1, reads2, bam, conf)
     return bam
 
+def merge_bams(bams, dest, conf):
+    """
+    Merge several sorted bam files (for instance, one per simulated sample) into a single indexed bam, keeping
+    the read groups of each
+    :param bams: List of bam files
+    :param dest: Destination bam file name
+    :param conf: Configuration containing path to samtools
+    :return: Path to merged bam file
+    """
+    samtools = conf.get('main', 'samtools_path')
+    runner.check_call([samtools, "merge", "-f", dest] + list(bams), conf, tool="samtools-merge")
+    runner.check_call([samtools, "index", dest], conf, tool="samtools-index")
+    return dest
+
 def verify_reads(fq1, fq2, bam, conf):
     """
     Verify that all reads in the input fastq file are present in the bam file
@@ -223,7 +298,7 @@ def verify_reads(fq1, fq2, bam, conf):
     r1 = len(list([line for line in open(fq1, "r") if line.strip()=='+']))
     r2 = len(list([line for line in open(fq2, "r") if line.strip()=='+']))
     cmd = conf.get('main', 'samtools_path') + " flagstat " + bam
-    info = subprocess.check_output(cmd, shell=True, executable="/bin/bash")
+    info = runner.check_output(cmd, conf, tool="samtools", shell=True, executable="/bin/bash")
     tot_line = info.split('\n')[0]
     bc = int(tot_line.split(' ')[0])
     if (r1 + r2) > bc:
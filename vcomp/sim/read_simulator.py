@@ -21,7 +21,7 @@ class ReadSimulator(object):
      keywords args to the constructor. This creates coverage histograms that look like hybrid capture data.
     """
 
-    def __init__(self, ref_genome, target_chr, target_mid, mean_template_size=250, stdev_template_size=50, read_len=100):
+    def __init__(self, ref_genome, target_chr, target_mid, mean_template_size=250, stdev_template_size=50, read_len=100, target_pos_stdev=50, flanking_bases=2000):
         """
         Create a new ReadSimulator
         :param ref_genome: Path to fasta file containing 'reference' to simulate from
@@ -30,13 +30,15 @@ class ReadSimulator(object):
         :param mean_template_size: Mean size in bp of templates
         :param stdev_template_size: Stdev of template size
         :param read_len: Read length
+        :param target_pos_stdev: Stdev of template midpoints around target_mid
+        :param flanking_bases: Number of bases on either side of target_mid to simulate reads from
         """
         self.target_chr = target_chr
         self.target_pos = target_mid #Mean midpoint of templates, typically a simulated variant is close to here
-        self.target_pos_stdev = 50
+        self.target_pos_stdev = target_pos_stdev
         self.mean_template_size = mean_template_size
         self.stdev_template_size = stdev_template_size
-        self.flanking_bases=2000
+        self.flanking_bases=flanking_bases
         self.read_len=read_len
         ref = pysam.FastaFile(ref_genome)
         self.seq_start = max(0, target_mid - self.flanking_bases)
@@ -54,7 +56,7 @@ class ReadSimulator(object):
         templ_seq = self.seq[template_pos-template_size/2:template_pos+template_size/2]
         first_read = templ_seq[0:self.read_len]
         second_read = revcomp(templ_seq[-self.read_len:])
-        ref_templ_mid = self.target_pos-self.flanking_bases+template_pos
+        ref_templ_mid = self.seq_start+template_pos
         ref_read_start = ref_templ_mid-template_size/2
         rnd = "".join([ random.choice(string.ascii_lowercase + string.ascii_uppercase) for _ in range(8)])
         first_read_name = '@' + str(self.counter) + ":" + self.target_chr + ":" + rnd + ":" + str(ref_read_start)
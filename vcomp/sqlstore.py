@@ -0,0 +1,273 @@
+"""
+SQLite results store. Results written by injectvar.py --sqlite DB are inserted into a local SQLite database, one
+transaction per batch (or scenario of a batch), so any number of injectvar processes can write to the same database
+at once. Tables:
+
+    variants   one row per input variant (and scenario): variant string, scenario, variant type, allele lengths and
+               size, and bam statistics
+    results    one row per (variant, caller, normalizer, comparator) cell with the result and the caller's quality
+    metrics    the tool metrics of each batch
+
+Every dimension is indexed, so specific questions are answered without scanning everything, for instance the
+variants gatk-hc missed under vt + vcfeval:
+
+    python vcomp/sqlstore.py results.db select --caller gatk-hc --normalizer vt --comparator vcfeval --result "No variants identified"
+
+and the parse_results_json operations can be run against a database with
+
+    python vcomp/sqlstore.py results.db ops --ops summary,bysize
+
+Existing json results can be loaded with `python vcomp/sqlstore.py results.db load my_output.txt`.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from itertools import groupby
+
+import columnar
+import stats
+
+#Seconds a writer waits for another one to finish its transaction
+BUSY_TIMEOUT = 600
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS variants (
+        id INTEGER PRIMARY KEY,
+        variant TEXT NOT NULL,
+        scenario TEXT NOT NULL,
+        vartype TEXT,
+        ref_len INTEGER,
+        alt_len INTEGER,
+        size INTEGER,
+        """ + ",\n        ".join(stat + " INTEGER" for stat in columnar.BAMSTATS) + """,
+        UNIQUE (variant, scenario))""",
+    """CREATE TABLE IF NOT EXISTS results (
+        variant_id INTEGER NOT NULL REFERENCES variants(id),
+        caller TEXT NOT NULL,
+        normalizer TEXT NOT NULL,
+        comparator TEXT NOT NULL,
+        result TEXT NOT NULL,
+        qual REAL,
+        PRIMARY KEY (variant_id, caller, normalizer, comparator))""",
+    "CREATE TABLE IF NOT EXISTS metrics (batch TEXT, metrics TEXT)",
+    "CREATE INDEX IF NOT EXISTS variants_vartype ON variants(vartype)",
+    "CREATE INDEX IF NOT EXISTS results_caller ON results(caller, normalizer, comparator, result)",
+    "CREATE INDEX IF NOT EXISTS results_normalizer ON results(normalizer, comparator)",
+    "CREATE INDEX IF NOT EXISTS results_comparator ON results(comparator)",
+    "CREATE INDEX IF NOT EXISTS results_result ON results(result)",
+]
+
+
+def connect(path):
+    """
+    Open (and if necessary create) a results database. Write ahead logging lets readers run while batches are
+    being written
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+class SqliteReporter(object):
+    """
+    An output reporter (see injectvar.JsonReporter) that inserts results into a SQLite database. Results computed
+    again for a variant (for instance by resume.py) replace the earlier ones
+    """
+
+    def __init__(self, path):
+        self.conn = connect(path)
+
+    def write_output(self, results, quals, bamstats, scenario=None):
+        records = []
+        for var, vresults in results.iteritems():
+            records.append({"variant": var, "caller_quals": quals[var], "bamstats": bamstats[var], "results": vresults, "scenario": scenario})
+        insert_records(self.conn, records)
+
+    def write_metrics(self, batchname, metrics):
+        with transaction(self.conn):
+            self.conn.execute("INSERT INTO metrics VALUES (?, ?)", (batchname, json.dumps([m._asdict() for m in metrics])))
+
+    def close(self):
+        self.conn.close()
+
+
+class transaction(object):
+    """
+    Context manager for a write transaction. BEGIN IMMEDIATE takes the write lock up front, so concurrent writers
+    queue up (for up to BUSY_TIMEOUT seconds) instead of failing halfway through
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+
+def insert_records(conn, records):
+    """
+    Insert results dicts (as written by injectvar.JsonReporter) in a single transaction
+    """
+    with transaction(conn):
+        for record in records:
+            var = record["variant"]
+            scenario = record.get("scenario") or ""
+            ref, alt = columnar.variant_alleles(var)
+            bamstats = record.get("bamstats", {})
+            stats = [int(bamstats.get(stat, 0)) for stat in columnar.BAMSTATS]
+            conn.execute("INSERT OR IGNORE INTO variants (variant, scenario) VALUES (?, ?)", (var, scenario))
+            conn.execute("UPDATE variants SET vartype=?, ref_len=?, alt_len=?, size=?, " + ", ".join(stat + "=?" for stat in columnar.BAMSTATS) + " WHERE variant=? AND scenario=?",
+                         [columnar.variant_type(ref, alt), len(ref), len(alt), len(alt) - len(ref)] + stats + [var, scenario])
+            variant_id = conn.execute("SELECT id FROM variants WHERE variant=? AND scenario=?", (var, scenario)).fetchone()[0]
+
+            quals = record.get("caller_quals", {})
+            rows = []
+            for caller, caller_results in record["results"].iteritems():
+                for normalizer, norm_results in caller_results.iteritems():
+                    for comparator, result in norm_results.iteritems():
+                        rows.append((variant_id, caller, normalizer, comparator, result, quals.get(caller)))
+            conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def load(conn, path, chunk=1000):
+    """
+    Load a json results file into the database, committing every chunk records
+    """
+    records = []
+    with open(path) as fh:
+        for line in fh:
+            if line.startswith("#metrics"):
+                metrics = json.loads(line[len("#metrics"):])
+                with transaction(conn):
+                    conn.execute("INSERT INTO metrics VALUES (?, ?)", (metrics.get("batch"), json.dumps(metrics.get("tools"))))
+            elif len(line.strip())>0 and line[0] != '#':
+                records.append(json.loads(line))
+                if len(records) >= chunk:
+                    insert_records(conn, records)
+                    records = []
+    if len(records)>0:
+        insert_records(conn, records)
+
+
+def where_clause(filters):
+    """
+    Build a WHERE clause from a dict of column -> value (or list of values), skipping None values
+    :return: Tuple of clause string (possibly empty) and list of parameters
+    """
+    clauses = []
+    params = []
+    for column, value in sorted(filters.iteritems()):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            clauses.append(column + " IN (" + ", ".join("?" for _ in value) + ")")
+            params.extend(value)
+        else:
+            clauses.append(column + " = ?")
+            params.append(value)
+    if len(clauses)==0:
+        return "", params
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def select(conn, **filters):
+    """
+    Generate (variant, scenario, caller, normalizer, comparator, result, qual) rows matching the filters, which may
+    be any of variant, scenario, vartype, caller, normalizer, comparator and result
+    """
+    clause, params = where_clause(filters)
+    return conn.execute("SELECT variant, scenario, caller, normalizer, comparator, result, qual FROM results JOIN variants ON variants.id = results.variant_id" + clause, params)
+
+
+def read_records(conn):
+    """
+    Rebuild the results dicts (as written by injectvar.JsonReporter) from the database, one at a time
+    """
+    rows = conn.execute("SELECT variants.*, caller, normalizer, comparator, result, qual FROM variants JOIN results ON variants.id = results.variant_id ORDER BY variants.id")
+    names = [d[0] for d in rows.description]
+    for _, var_rows in groupby(rows, key=lambda row: row[0]):
+        record = None
+        for row in var_rows:
+            row = dict(zip(names, row))
+            if record is None:
+                record = {
+                    "variant": row["variant"],
+                    "bamstats": dict((stat, row[stat]) for stat in columnar.BAMSTATS),
+                    "caller_quals": {},
+                    "results": {}
+                }
+                if row["scenario"]:
+                    record["scenario"] = row["scenario"]
+            record["caller_quals"][row["caller"]] = row["qual"]
+            record["results"].setdefault(row["caller"], {}).setdefault(row["normalizer"], {})[row["comparator"]] = row["result"]
+        yield record
+
+
+def perform_ops(conn, operations):
+    """
+    Run parse_results_json operations on the database. Operations with a perform_sql() method compute their
+    aggregates with queries, the others are given every rebuilt results dict
+    """
+    streamed = [op for op in operations if not hasattr(op, 'perform_sql')]
+    for op in operations:
+        if hasattr(op, 'perform_sql'):
+            op.perform_sql(conn)
+    if len(streamed)>0:
+        for record in read_records(conn):
+            for op in streamed:
+                op.perform_op(record)
+    for op in operations:
+        print "\n"
+        op.finalize()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Load and query varcomp results in a SQLite database")
+    parser.add_argument("db", help="Path to results database")
+    commands = parser.add_subparsers(dest="command")
+
+    load_parser = commands.add_parser("load", help="Load json results files into the database")
+    load_parser.add_argument("results", help="Json results file(s)", nargs="+")
+
+    select_parser = commands.add_parser("select", help="Print results matching all of the given values, tab delimited")
+    for column in ("variant", "scenario", "vartype", "caller", "normalizer", "comparator", "result"):
+        select_parser.add_argument("--" + column, help="Only results with this " + column + " (may be given more than once)", action='append')
+
+    ops_parser = commands.add_parser("ops", help="Run parse_results_json operations on the database")
+    ops_parser.add_argument("--ops", help="Comma separated list of operations to perform, default: summary", default="summary")
+    ops_parser.add_argument("--ci", help="Add confidence intervals for match rates to summaries, computed by one of: " + ", ".join(stats.METHODS), choices=stats.METHODS, default=None)
+    ops_parser.add_argument("--plot-dir", help="Write the plots of operations that make them as png files to this directory")
+
+    args = parser.parse_args()
+    conn = connect(args.db)
+    if args.command == "load":
+        for path in args.results:
+            load(conn, path)
+    elif args.command == "select":
+        filters = dict((column, getattr(args, column)) for column in ("variant", "scenario", "vartype", "caller", "normalizer", "comparator", "result"))
+        for row in select(conn, **filters):
+            print "\t".join(str(v) for v in row)
+    else:
+        import parse_results_json
+        if args.plot_dir is not None and not os.path.exists(args.plot_dir):
+            os.makedirs(args.plot_dir)
+        try:
+            ops = parse_results_json.make_operations(args.ops.split(","), ci=args.ci, plot_dir=args.plot_dir)
+        except ValueError as ex:
+            parser.error(str(ex))
+        perform_ops(conn, ops)
+    conn.close()
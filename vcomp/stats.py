@@ -0,0 +1,134 @@
+"""
+Confidence intervals for accuracy proportions (e.g. the fraction of a caller's assessments that matched). All
+functions take arrays of success and trial counts and compute every interval at once, so the intervals for all callers
+in all size bins of a summary are a single vectorized computation.
+"""
+
+import math
+
+import numpy as np
+
+BINOMIAL = "binomial"
+BOOTSTRAP = "bootstrap"
+METHODS = (BINOMIAL, BOOTSTRAP)
+
+#Bootstrap replicates drawn at once, bounds memory use for very many proportions
+BOOTSTRAP_CHUNK = 1000000
+
+
+#Iterations of the continued fraction for the incomplete beta function, and of the bisections inverting it
+BETA_ITERATIONS = 100000
+BISECTIONS = 60
+
+
+def log_beta(a, b):
+    lgamma = np.vectorize(math.lgamma, otypes=[np.float64])
+    return lgamma(a) + lgamma(b) - lgamma(a + b)
+
+
+def beta_cdf(x, a, b):
+    """
+    Regularized incomplete beta function I_x(a, b), the cdf of the beta distribution, for arrays of 0 < x < 1 and
+    a, b > 0. The continued fraction (modified Lentz's method, as in Numerical Recipes' betacf) is evaluated for all
+    values at once, until every one of them has converged
+    """
+    x, a, b = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    #The fraction converges quickly below the mean, above it use I_x(a, b) = 1 - I_1-x(b, a)
+    flip = x > (a + 1) / (a + b + 2)
+    x, a, b = np.where(flip, 1 - x, x), np.where(flip, b, a), np.where(flip, a, b)
+    tiny = 1e-300
+    c = np.ones_like(x)
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+    h = d.copy()
+    for m in xrange(1, BETA_ITERATIONS):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)), -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 + numerator * d
+            d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+            c = 1 + numerator / c
+            c = np.where(np.abs(c) < tiny, tiny, c)
+            delta = c * d
+            h *= delta
+        if np.all(np.abs(delta - 1) < 1e-15):
+            break
+    cdf = np.exp(a * np.log(x) + b * np.log1p(-x) - log_beta(a, b)) * h / a
+    return np.where(flip, 1 - cdf, cdf)
+
+
+def beta_quantile(q, a, b):
+    """
+    Quantile q of the beta distribution with parameters a, b (arrays), by bisection of beta_cdf
+    """
+    q, a, b = np.broadcast_arrays(np.asarray(q, dtype=np.float64), np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    lower = np.zeros(q.shape)
+    upper = np.ones(q.shape)
+    for i in xrange(BISECTIONS):
+        mid = (lower + upper) / 2
+        below = beta_cdf(mid, a, b) < q
+        lower = np.where(below, mid, lower)
+        upper = np.where(below, upper, mid)
+    return (lower + upper) / 2
+
+
+def binomial_interval(successes, trials, confidence=0.95):
+    """
+    Exact (Clopper-Pearson) binomial confidence intervals for proportions, the quantiles of beta distributions,
+    computed without scipy so that results don't depend on what is installed
+    :param successes: Array of success counts
+    :param trials: Array of trial counts
+    :return: Tuple of arrays of lower and upper bounds (nan where there were no trials)
+    """
+    k = np.asarray(successes, dtype=np.float64)
+    n = np.asarray(trials, dtype=np.float64)
+    alpha = 1.0 - confidence
+    #Bounds of 0 and 1 at the extremes are exact, elsewhere the beta parameters are positive
+    has_lower = (k > 0) & (n > 0)
+    has_upper = (k < n) & (n > 0)
+    lower = np.where(has_lower, beta_quantile(alpha / 2, np.where(has_lower, k, 1), np.where(has_lower, n - k + 1, 1)), 0.0)
+    upper = np.where(has_upper, beta_quantile(1 - alpha / 2, np.where(has_upper, k + 1, 1), np.where(has_upper, n - k, 1)), 1.0)
+    lower = np.where(n > 0, lower, np.nan)
+    upper = np.where(n > 0, upper, np.nan)
+    return lower, upper
+
+
+def bootstrap_interval(successes, trials, confidence=0.95, iterations=2000, seed=None):
+    """
+    Percentile bootstrap confidence intervals for proportions. Resampling the n individual outcomes behind a
+    proportion k/n with replacement gives a number of successes that is Binomial(n, k/n) distributed, so replicates
+    are drawn directly from the counts, for every proportion at once
+    :param successes: Array of success counts
+    :param trials: Array of trial counts
+    :param iterations: Number of bootstrap replicates
+    :param seed: Optional random seed, for reproducible intervals
+    :return: Tuple of arrays of lower and upper bounds (nan where there were no trials)
+    """
+    k = np.asarray(successes, dtype=np.int64).ravel()
+    n = np.asarray(trials, dtype=np.int64).ravel()
+    rng = np.random.RandomState(seed)
+    safe_n = np.maximum(n, 1)
+    p = k / safe_n.astype(np.float64)
+    alpha = 1.0 - confidence
+
+    lower = np.empty(len(k))
+    upper = np.empty(len(k))
+    step = max(1, BOOTSTRAP_CHUNK / max(1, iterations))
+    for start in range(0, len(k), step):
+        end = start + step
+        replicates = rng.binomial(safe_n[start:end], p[start:end], size=(iterations, len(p[start:end]))) / safe_n[start:end].astype(np.float64)
+        lower[start:end], upper[start:end] = np.percentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    shape = np.shape(successes)
+    lower = np.where(n > 0, lower, np.nan).reshape(shape)
+    upper = np.where(n > 0, upper, np.nan).reshape(shape)
+    return lower, upper
+
+
+def interval(successes, trials, method=BINOMIAL, confidence=0.95):
+    """
+    Confidence intervals by the given method, one of METHODS
+    """
+    if method == BINOMIAL:
+        return binomial_interval(successes, trials, confidence)
+    if method == BOOTSTRAP:
+        return bootstrap_interval(successes, trials, confidence)
+    raise ValueError("Unknown confidence interval method " + str(method))
+
@@ -1,11 +1,13 @@
 
-import subprocess
 import gzip
+import os
 import random
 import string
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import pysam
 import gzip
+from vcomp import runner
+from vcomp import geometry
 
 HOM_REF_GT = "Hom ref."
 HET_GT = "Het"
@@ -19,6 +21,13 @@ ALL_HOMALT_GTS = ["1/1", "1|1"]
 
 DEFAULT_CONTIG_ORDER=['1', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '2', '20', '21', '22', '3', '4', '5', '6', '7', '8','9', 'MT', 'X','Y']
 
+#Variants closer than this can't be simulated on the same haplotypes, callers are likely to merge them into a
+#single complex call
+DEFAULT_MIN_JOIN_GAP = 20
+
+#Largest number of variants simulated together as a single cluster
+DEFAULT_MAX_CLUSTER_SIZE = 50
+
 Variant = namedtuple('Variant', ['chrom', 'start', 'ref', 'alts', 'gt'])
 ErrorVariant = namedtuple('ErrorVariant', ['chrom', 'start', 'msg'])
 
@@ -67,6 +76,48 @@ def sort_vcf(vcf, conf):
     fh.close()
     return bgz_tabix(tmpfile, conf)
 
+def merge_vcfs(vcfs, dest, conf):
+    """
+    Merge several vcfs containing the same samples (for instance, output of the same caller on different regions)
+    into a single sorted, compressed and indexed vcf. The header is taken from the first vcf
+    :param vcfs: List of vcf files to merge (may be gzipped)
+    :param dest: Name of uncompressed destination vcf
+    :param conf: Configuration (needed for paths to tabix, bgzip)
+    :return: Filename of merged, compressed vcf
+    """
+    vars = []
+    ofh = open(dest, "w")
+    for i, vcf in enumerate(vcfs):
+        if vcf.endswith(".gz"):
+            fh = gzip.open(vcf)
+        else:
+            fh = open(vcf)
+        for line in fh:
+            if len(line)>0 and line[0]=='#':
+                if i==0:
+                    ofh.write(line)
+            else:
+                vars.append(line.split('\t'))
+        fh.close()
+    for var in sorted(vars, cmp=var_comp):
+        ofh.write('\t'.join(var))
+    ofh.close()
+    return compress_vcf(dest, conf)
+
+#Open FastaFile handles, keyed by process id and path so forked workers never share a handle with their parent
+_fasta_handles = {}
+
+def get_fasta(path):
+    """
+    Return an open pysam.FastaFile for the given path, reusing an already open handle if there is one. Opening the
+    reference (and reading its index) each time it's needed adds up when many batches are processed by one process,
+    as in the long running service (see service.py)
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _fasta_handles:
+        _fasta_handles[key] = pysam.FastaFile(path)
+    return _fasta_handles[key]
+
 def randstr(length=8):
     return "".join([random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(length)])
 
@@ -78,10 +129,10 @@ def bgz_tabix(path, conf):
 
     if not path.endswith(".gz"):
         cmd = conf.get('main', 'bgzip_path') + " " + path
-        subprocess.check_call(cmd.split())
+        runner.check_call(cmd.split(), conf, tool="bgzip")
         path = path + ".gz"
     cmd = conf.get('main', 'tabix_path') + " -f " + path
-    subprocess.check_call(cmd.split())
+    runner.check_call(cmd.split(), conf, tool="tabix")
     return path
 
 def pysamVar_to_Variant(pvar, default_gt):
@@ -158,28 +209,81 @@ def region_to_bedfile(region):
     :param region:
     :return:
     """
+    return regions_to_bedfile([region])
+
+def regions_to_bedfile(regions):
+    """
+    Write the given regions to a new bed file, return the filename
+    :param regions: List of regions
+    :return: Name of bed file created
+    """
     filename = "tmpbed-" + randstr() + ".bed"
     with open(filename, "w") as fh:
-        fh.write("\t".join([region.chr, str(region.start), str(region.end)]) + "\n")
+        for region in regions:
+            fh.write("\t".join([region.chr, str(region.start), str(region.end)]) + "\n")
     return filename
 
-def vars_to_bed(variants, window=500):
+def merge_beds(beds):
+    """
+    Write a new bed file containing the union of the regions in the given bed files, sorted and with overlapping
+    regions merged
+    :param beds: List of bed files
+    :return: Name of bed file created
     """
-    Generate a bed file containing regions that span each variant, each region is centered
-    on the variant start position and extends 'window' bp in each direction
+    regions = sorted(r for bed in beds for r in read_regions(bed))
+    merged = []
+    for region in regions:
+        if len(merged)>0 and merged[-1].chr == region.chr and region.start <= merged[-1].end:
+            merged[-1] = merged[-1]._replace(end=max(merged[-1].end, region.end))
+        else:
+            merged.append(region)
+    return regions_to_bedfile(merged)
+
+def vars_to_bed(variants, window=None, geom=geometry.DEFAULT_GEOMETRY):
+    """
+    Generate a bed file containing a region for each variant set. By default each region covers the span of the
+    variants in the set plus the distance simulated reads can reach beyond it (see geometry.WindowGeometry). Sets
+    that are clusters of input variants (see cluster_variants) get one region per variant, split at the midpoints
+    between them, so results are still reported separately for each input variant
     The resulting file is NOT sorted by
-    :param variants: List of variants to create a bed file for
-    :param window:Number of bases to extend (from variant start position) in each direction
+    :param variants: List of variant sets to create a bed file for
+    :param window: If given, instead use regions centered on the start of the first variant in each set and
+    extending this many bp in each direction
+    :param geom: WindowGeometry used to size regions
     :return: Name of bed file created
     """
     bedfilename = "var_regions" + randstr() + ".bed"
     with open(bedfilename, "w") as bfh:
         for vset in variants:
-            var = vset['vars'][0]
-            bfh.write("\t".join([var.chrom, str(var.start-window), str(var.start+window)]) + "\n")
+            if window is not None:
+                var = vset['vars'][0]
+                regions = [geometry.Span(var.chrom, var.start-window, var.start+window)]
+            elif vset.get('cluster', False):
+                regions = split_cluster_region(vset['vars'], geom.bed_region(geometry.set_span(vset['vars'])))
+            else:
+                regions = [geom.bed_region(geometry.set_span(vset['vars']))]
+            for region in regions:
+                bfh.write("\t".join([region.chrom, str(region.start), str(region.end)]) + "\n")
 
     return bedfilename
 
+def split_cluster_region(vars, region):
+    """
+    Split a region containing a cluster of variants into one region per variant, with boundaries at the midpoints
+    between the end of one variant and the start of the next
+    :param vars: Variants in the cluster, sorted by position
+    :param region: Region containing all of the variants
+    :return: List of regions
+    """
+    regions = []
+    start = region.start
+    for prev, nxt in zip(vars[:-1], vars[1:]):
+        mid = (prev.start + len(prev.ref) + nxt.start) / 2
+        regions.append(geometry.Span(region.chrom, start, mid))
+        start = mid
+    regions.append(geometry.Span(region.chrom, start, region.end))
+    return regions
+
 def read_regions(bedfile):
     """
     Generator for iterating over
@@ -205,11 +309,22 @@ def find_matching_var(vars, region):
     matches = [var for var in vars if var.chrom==region.chr and var.start >= region.start and var.start <= region.end]
     return matches
 
-def gen_snp(chrom, pos, gt, ref_genome):
+def gen_snp(chrom, pos, gt, ref_genome, snp_alts=None):
+    """
+    Create a SNP at the given position, with an alt base chosen at random
+    :param snp_alts: Optional dict of (chrom, pos) -> alt base chosen earlier, shared by scenarios simulated
+    together (e.g. cis and trans) so that they add the same SNP and callers genotyping them jointly don't report a
+    multi-allelic site. New choices are added to it
+    """
     currentbase = ref_genome.fetch(chrom, pos, pos+1)
     bases = ['A', 'C', 'G', 'T']
     bases.remove(currentbase)
-    newbase = random.choice(bases)
+    if snp_alts is None:
+        newbase = random.choice(bases)
+    else:
+        if (chrom, pos) not in snp_alts:
+            snp_alts[(chrom, pos)] = random.choice(bases)
+        newbase = snp_alts[(chrom, pos)]
     newvar = Variant(chrom, pos, currentbase, (newbase,), gt)
     return newvar
 
@@ -252,13 +367,140 @@ def compress_vcf(input_vcf, conf):
     """
     if not input_vcf.endswith(".gz"):
         cmd = conf.get('main', 'bgzip_path') + " -f " + input_vcf
-        subprocess.check_call(cmd, shell=True)
+        runner.check_call(cmd, conf, tool="bgzip", shell=True)
         cmd = conf.get('main', 'tabix_path') + " -f " + input_vcf + ".gz"
-        subprocess.check_call(cmd, shell=True)
+        runner.check_call(cmd, conf, tool="tabix", shell=True)
         input_vcf = input_vcf + '.gz'
     return input_vcf
 
 
+def ensure_indexed(vcf, conf):
+    """
+    Make sure the given vcf is bgzipped and has an up-to-date tabix index, doing as little work as possible.
+    Unlike bgz_tabix, an existing index that is at least as new as the vcf itself is left alone
+    :param vcf: Path to vcf file (may or may not be compressed)
+    :param conf: Configuration (needed for paths to tabix, bgzip)
+    :return: Name of compressed, indexed vcf file
+    """
+    if not vcf.endswith(".gz"):
+        return compress_vcf(vcf, conf)
+    index = vcf + ".tbi"
+    if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(vcf):
+        cmd = conf.get('main', 'tabix_path') + " -f " + vcf
+        runner.check_call(cmd.split(), conf, tool="tabix")
+    return vcf
+
+
+def identity_normalizer(normalizer):
+    """
+    Decorator for normalizers that never change the variants they are given. The framework will not execute
+    these at all, instead it just passes the (compressed and indexed) input vcf through
+    :param normalizer: Normalizer function
+    :return: The same function, flagged as an identity normalizer
+    """
+    normalizer.identity = True
+    return normalizer
+
+
+def is_identity_normalizer(normalizer):
+    return getattr(normalizer, 'identity', False)
+
+
+def multisample_caller(caller):
+    """
+    Decorator for variant callers that genotype each sample (read group SM tag) of a bam file separately, writing
+    one sample column per sample. When several scenarios are simulated into one bam these are run just once
+    :param caller: Variant caller function
+    :return: The same function, flagged as multi-sample capable
+    """
+    caller.multisample = True
+    return caller
+
+
+def is_multisample_caller(caller):
+    return getattr(caller, 'multisample', False)
+
+
+def subset_alleles(value, number, keep):
+    """
+    Subset a per-allele FORMAT value to the given alleles
+    :param value: Comma separated value string
+    :param number: Number of the FORMAT field in the header ('A', 'R', 'G' or other)
+    :param keep: Sorted list of original allele indices to keep, starting with 0 (the ref allele)
+    :return: Subset value string, '.' if it can't be subset
+    """
+    if value == "." or number not in ("A", "R", "G"):
+        return value
+    vals = value.split(",")
+    if number == "A":
+        indices = [i - 1 for i in keep[1:]]
+    elif number == "R":
+        indices = keep
+    else:
+        #Diploid genotype ordering: (j, k) with j <= k is at k*(k+1)/2 + j
+        indices = [k * (k + 1) / 2 + j for ki, k in enumerate(keep) for j in keep[0:ki+1]]
+    if max(indices) >= len(vals):
+        return "."
+    return ",".join(vals[i] for i in indices)
+
+def extract_sample(vcf, sample, conf):
+    """
+    Create a single-sample vcf from one sample column of a multi-sample vcf, as it would look had the sample been
+    called on its own: records in which the sample has no alt allele are dropped, alt alleles not in the sample's
+    genotype are removed (and GT and per-allele FORMAT fields adjusted to match), and the site INFO, which describes
+    all samples, is cleared. The site QUAL is kept, so the quality reported for the sample is on the same scale as
+    for callers run on a single sample
+    :param vcf: Multi-sample vcf (possibly gzipped)
+    :param sample: Name of sample to extract
+    :param conf: Configuration (needed for paths to tabix, bgzip)
+    :return: Name of compressed, indexed vcf containing just the given sample
+    """
+    dest = vcf.replace(".gz", "").replace(".vcf", "") + "." + sample + ".vcf"
+    if vcf.endswith(".gz"):
+        fh = gzip.open(vcf)
+    else:
+        fh = open(vcf)
+
+    col = None
+    numbers = {}
+    with open(dest, "w") as out:
+        for line in fh:
+            if line.startswith("##"):
+                if line.startswith("##FORMAT=<"):
+                    fields = dict(f.split("=", 1) for f in line[len("##FORMAT=<"):].rstrip().rstrip(">").split(",") if "=" in f)
+                    numbers[fields.get("ID")] = fields.get("Number")
+                out.write(line)
+                continue
+            toks = line.rstrip("\n").split("\t")
+            if line.startswith("#"):
+                if sample not in toks[9:]:
+                    raise ValueError('Sample ' + sample + ' not found in ' + vcf)
+                col = toks.index(sample, 9)
+                out.write("\t".join(toks[0:9] + [sample]) + "\n")
+                continue
+            fmt = toks[8].split(":")
+            values = toks[col].split(":")
+            if "GT" in fmt and fmt.index("GT") < len(values):
+                gt = values[fmt.index("GT")]
+                sep = "|" if "|" in gt else "/"
+                alleles = gt.replace("|", "/").split("/")
+                if all(a in ("0", ".") for a in alleles):
+                    continue
+                keep = [0] + sorted(set(int(a) for a in alleles if a not in ("0", ".")))
+                remap = dict((str(old), str(new)) for new, old in enumerate(keep))
+                alts = toks[4].split(",")
+                toks[4] = ",".join(alts[i - 1] for i in keep[1:])
+                for i, key in enumerate(fmt[0:len(values)]):
+                    if key == "GT":
+                        values[i] = sep.join(remap.get(a, a) for a in alleles)
+                    else:
+                        values[i] = subset_alleles(values[i], numbers.get(key), keep)
+            toks[7] = "."
+            out.write("\t".join(toks[0:9] + [":".join(values)]) + "\n")
+    fh.close()
+    return compress_vcf(dest, conf)
+
+
 def get_first_gt(var):
     """
     Returns string version of GT field.. Hack until we can get pysam to work..
@@ -267,7 +509,15 @@ def get_first_gt(var):
     sample = var.samples[0]
     if 'GT' not in sample:
         return None
-    gts = sample['GT']
+    return genotype_class(sample['GT'])
+
+def genotype_class(gts):
+    """
+    Classify a GT as one of HOM_REF_GT, HET_GT, HOM_ALT_GT, HET_NONREF or HET_WITHREF
+    :param gts: Tuple of allele indices, or None
+    """
+    if gts is None:
+        return None
     refcount = len([g for g in gts if g==0])
     altcount = len(gts)-refcount
     alt_types = set([g for g in gts if g!=0])
@@ -289,29 +539,77 @@ def get_first_gt(var):
             return HET_WITHREF
 
 
-def canadd(var, batch, max_batch_size, min_safe_dist=2000):
+def cluster_variants(vars, geom=geometry.DEFAULT_GEOMETRY, min_gap=DEFAULT_MIN_JOIN_GAP, max_size=DEFAULT_MAX_CLUSTER_SIZE):
+    """
+    Group variants that are too close to be simulated independently (see geometry.WindowGeometry) into clusters
+    that can be simulated together on the same haplotypes. A variant that overlaps, or is closer than min_gap to,
+    the previous variant can't be joined to it and starts a new cluster, as does one that would make the cluster
+    larger than max_size. Contigs keep the order in which they first appear
+    :param vars: List of variants (pysam records or Variants)
+    :param geom: WindowGeometry used to determine which variants are too close to simulate independently
+    :param min_gap: Minimum number of bases between the end of one variant and the start of the next in a cluster
+    :param max_size: Maximum number of variants in a cluster
+    :return: List of clusters, each a list of variants sorted by position
+    """
+    by_chrom = OrderedDict()
+    for var in vars:
+        by_chrom.setdefault(var.chrom, []).append(var)
+
+    clusters = []
+    for chrom_vars in by_chrom.values():
+        cluster = []
+        for var in sorted(chrom_vars, key=lambda v: v.start):
+            if len(cluster)>0:
+                prev = cluster[-1]
+                gap = var.start - (prev.start + len(prev.ref))
+                if gap < min_gap or len(cluster) >= max_size or geom.compatible(geometry.var_span(prev), geometry.var_span(var)):
+                    clusters.append(cluster)
+                    cluster = []
+            cluster.append(var)
+        clusters.append(cluster)
+    return clusters
+
+def cluster_span(cluster, upstream=0):
+    span = geometry.set_span(cluster)
+    return geometry.Span(span.chrom, max(0, span.start - upstream), span.end)
+
+def canadd(var, batch, max_batch_size, min_safe_dist=None, geom=geometry.DEFAULT_GEOMETRY, upstream=0):
     """
     Helper for variant batching function
-    :param var: Single variant
-    :param batch: A batch to consider adding the variant to
-    :param max_batch_size: Maximum size of a batch
-    :param min_safe_dist: Minimum distance required between variants in the batch
+    :param var: Single variant, or a cluster (list) of variants that must be added together
+    :param batch: A batch to consider adding the variant to, as a list of clusters
+    :param max_batch_size: Maximum number of variants in a batch
+    :param min_safe_dist: If given, fixed minimum distance required between variant start positions in the batch,
+    otherwise the safe distance is determined by the geometry from the spans of the clusters
+    :param geom: WindowGeometry used to determine safe distances
+    :param upstream: Number of bases upstream of each variant that will also be simulated (e.g. for extra SNPs)
     :return:
     """
-    if len(batch)>=max_batch_size:
+    cluster = var if isinstance(var, list) else [var]
+    if sum(len(c) for c in batch) + len(cluster) > max_batch_size:
         return False
-    for b in batch:
-        if var.chrom == b.chrom and abs(b.start - var.start)<min_safe_dist:
+    span = cluster_span(cluster, upstream)
+    for c in batch:
+        if min_safe_dist is not None:
+            for v in cluster:
+                for b in c:
+                    if v.chrom == b.chrom and abs(b.start - v.start)<min_safe_dist:
+                        return False
+        elif not geom.compatible(span, cluster_span(c, upstream)):
             return False
     return True
 
-def batch_variants(vcf, max_batch_size=1000, min_safe_dist=2000):
+def batch_variants(vcf, max_batch_size=1000, min_safe_dist=None, geom=geometry.DEFAULT_GEOMETRY, upstream=0, cluster=False):
     """
-    Given a list of variants, group them into batches such that no batch contains two variants
-    whose start positions are within min_safe_dist bases of each other
+    Given a list of variants, group them into batches such that no batch contains two variants close enough
+    to interfere with each other's simulation (as determined by the geometry, or by min_safe_dist if given)
     :param vcf: VCF file containing variants to batch
     :param max_batch_size: Maximum number of variants per batch
-    :param min_safe_dist: Min permissible distance between two variants in batch
+    :param min_safe_dist: Fixed min permissible distance between two variants in batch
+    :param geom: WindowGeometry used to determine safe distances
+    :param upstream: Number of bases upstream of each variant that will also be simulated (e.g. for extra SNPs)
+    :param cluster: Keep clusters of nearby variants (see cluster_variants) together in the same batch, so they
+    can be simulated jointly, instead of spreading them across batches
     :return: List of VCF files containing subsets of variants
     """
 
@@ -332,13 +630,17 @@ def batch_variants(vcf, max_batch_size=1000, min_safe_dist=2000):
                 break
     name = vcf.split('/')[-1].strip('.gz').strip('.vcf')
     vars = list(pysam.VariantFile(vcf))
+    if cluster and min_safe_dist is None:
+        clusters = cluster_variants(vars, geom)
+    else:
+        clusters = [[var] for var in vars]
 
-    while len(vars)>0:
-        var = vars.pop(0)
-        unfilled_batches = [b for b in batches if len(b)<max_batch_size]
+    while len(clusters)>0:
+        var = clusters.pop(0)
+        unfilled_batches = [b for b in batches if sum(len(c) for c in b)<max_batch_size]
         found = False
         for b in unfilled_batches:
-            if canadd(var, b, max_batch_size, min_safe_dist=min_safe_dist):
+            if canadd(var, b, max_batch_size, min_safe_dist=min_safe_dist, geom=geom, upstream=upstream):
                 b.append(var)
                 found = True
                 break
@@ -356,8 +658,9 @@ def batch_variants(vcf, max_batch_size=1000, min_safe_dist=2000):
         with open(batchname, 'w') as out:
             for x in header:
                 out.write(x)
-            for x in batch:
-                out.write(str(x))
+            for c in batch:
+                for x in c:
+                    out.write(str(x))
         files.append(batchname)
     return files
 